@@ -0,0 +1,247 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# Action graph, a drop-in for ActionList where actions declare what they
+# depend on. Independent branches run at the same time on a bounded pool,
+# and initwaits are scheduled rather than slept on a worker, so the graph
+# takes as long as its critical path:
+#
+#   graph = ActionGraph(workers=4)
+#   graph.add('login', do_login, initwait=WaitValue(1, 3))
+#   graph.add('orders', fetch_orders, after=['login'])
+#   graph.add('prices', fetch_prices, after=['login'], initwait=2)
+#   graph.add('report', make_report, after=['orders', 'prices'], results=True)
+#   rules.add(identify, 'Daily report', graph)
+#
+# With results=True a node's func is called with the results of the nodes
+# in 'after'. Nodes that depend on a failed node are not run, and the first
+# error is raised once the running nodes are done. When the graph is
+# stopped, running nodes get 'drain_timeout' seconds to finish, the ones
+# still running after that are reported and left behind, and Cancelled is
+# raised. Added to Rules, a graph takes their stop event and clock unless it
+# was given its own. The countdown shown is for the next node due to run,
+# each node's wait and run time is emitted on the info signal as 'timing'.
+#
+
+import math
+import time
+import heapq
+import itertools
+from queue import Queue, Empty
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from utils import WaitValue, Cancelled
+from clock import SystemClock
+
+
+class ActionNode(object):
+    def __init__(self, name, func, after=(), cond=None, whentrue=None, whenfalse=None,
+                 initwait=None, results=False):
+        self.name = name
+        self.func = func
+        self.after = list(after)
+        self.cond = cond
+        self.whentrue = whentrue
+        self.whenfalse = whenfalse
+        self.initwait = initwait
+        self.results = results
+        self.reset()
+
+    def reset(self):
+        self.state = 'pending'      # then waiting, running, done, skipped, failed, blocked, cancelled
+        self.result = None
+        self.error = None
+        self.ready_at = None
+        self.started = None
+        self.finished = None
+
+    def wait_time(self, clock):
+        if isinstance(self.initwait, WaitValue):
+            return self.initwait.value(clock)
+        return self.initwait or 0
+
+
+class ActionGraph(QObject):
+    info = pyqtSignal(str, str)
+
+    def __init__(self, stop_event=None, clock=None, workers=4, drain_timeout=30):
+        super().__init__()
+        self.nodes = {}
+        self.stop_event = stop_event
+        self.clock = clock
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+
+    def add(self, name, func, after=(), cond=None, whentrue=None, whenfalse=None,
+            initwait=None, results=False):
+        if name in self.nodes:
+            raise Exception(f"Duplicate action '{name}' in graph")
+        self.nodes[name] = ActionNode(name, func, after, cond, whentrue, whenfalse,
+                                      initwait, results)
+
+    def connect(self, handler):
+        self.info.connect(handler)
+
+    def check(self):
+        # unknown dependencies and cycles, before anything runs
+        for node in self.nodes.values():
+            for dep in node.after:
+                if dep not in self.nodes:
+                    raise Exception(f"Action '{node.name}' depends on unknown action '{dep}'")
+
+        visiting, done = set(), set()
+
+        def visit(name, path):
+            if name in done:
+                return
+            if name in visiting:
+                raise Exception(f"Cycle in action graph: {' -> '.join(path + [name])}")
+            visiting.add(name)
+            for dep in self.nodes[name].after:
+                visit(dep, path + [name])
+            visiting.discard(name)
+            done.add(name)
+
+        for name in self.nodes:
+            visit(name, [])
+
+    def run(self):
+        self.check()
+        clock = self.clock or SystemClock
+        for node in self.nodes.values():
+            node.reset()
+        waiting_on = {name: set(node.after) for name, node in self.nodes.items()}
+        dependents = {name: [] for name in self.nodes}
+        for node in self.nodes.values():
+            for dep in node.after:
+                dependents[dep].append(node.name)
+
+        started = clock.monotonic()
+        due = []
+        seq = itertools.count()
+        completions = Queue()
+        running = 0
+        cancelled = False
+        shown = None
+
+        def make_ready(node):
+            wait_time = node.wait_time(clock)
+            node.state = 'waiting'
+            node.ready_at = clock.monotonic()
+            heapq.heappush(due, (node.ready_at + wait_time, next(seq), node.name))
+
+        def show_countdown(now):
+            # one countdown, for whichever node is due first
+            nonlocal shown
+            if due and due[0][1] != shown:
+                shown = due[0][1]
+                self.info.emit('initwait', str(math.ceil(max(0.0, due[0][0] - now))))
+
+        def block(name):
+            # dependents of a failed node don't run, nor do theirs
+            for child in dependents[name]:
+                if self.nodes[child].state == 'pending':
+                    self.nodes[child].state = 'blocked'
+                    block(child)
+
+        for name, deps in waiting_on.items():
+            if not deps:
+                make_ready(self.nodes[name])
+
+        pool = ThreadPoolExecutor(self.workers, thread_name_prefix='action')
+        try:
+            while due or running:
+                if self.stop_event is not None and self.stop_event.is_set():
+                    cancelled = True
+                    break
+
+                now = clock.monotonic()
+                while due and due[0][0] <= now:
+                    node = self.nodes[heapq.heappop(due)[2]]
+                    node.state = 'running'
+                    pool.submit(self.execute, node, clock, completions)
+                    running += 1
+                show_countdown(now)
+
+                if running:
+                    timeout = min(due[0][0] - now, 0.5) if due else 0.5
+                    try:
+                        node = completions.get(timeout=max(0.0, timeout))
+                    except Empty:
+                        continue
+                    running -= 1
+                    self.emit_timing(node)
+                    if node.state in ('failed', 'cancelled'):
+                        cancelled = cancelled or node.state == 'cancelled'
+                        block(node.name)
+                        continue
+                    for child in dependents[node.name]:
+                        waiting_on[child].discard(node.name)
+                        if not waiting_on[child] and self.nodes[child].state == 'pending':
+                            make_ready(self.nodes[child])
+                elif due:
+                    if clock.wait(due[0][0] - now, self.stop_event):
+                        cancelled = True
+                        break
+
+            # let the nodes already running finish, for a while. Real time, a node
+            # stuck in the browser doesn't move a virtual clock
+            deadline = time.monotonic() + self.drain_timeout
+            while running:
+                try:
+                    node = completions.get(timeout=max(0.0, deadline - time.monotonic()))
+                except Empty:
+                    stuck = [n.name for n in self.nodes.values() if n.state == 'running']
+                    self.info.emit('status', f'Action graph stopped, still running: {", ".join(stuck)}')
+                    break
+                self.emit_timing(node)
+                running -= 1
+        finally:
+            pool.shutdown(wait=not running)
+
+        elapsed = clock.monotonic() - started
+        serial = sum((n.finished - n.ready_at) for n in self.nodes.values() if n.finished)
+        self.info.emit('timing', f'Action graph finished in {elapsed:.2f}s '
+                                 f'(one after another: {serial:.2f}s)')
+        if cancelled:
+            raise Cancelled
+        for node in self.nodes.values():
+            if node.error is not None:
+                raise node.error
+        return True
+
+    def execute(self, node, clock, completions):
+        # runs on a pool thread
+        node.started = clock.monotonic()
+        self.info.emit('status', f'Running action: "{node.name}"')
+        try:
+            if node.cond and not node.cond():
+                node.state = 'skipped'
+            else:
+                args = [self.nodes[dep].result for dep in node.after] if node.results else []
+                rv = node.func(*args)
+                node.result = rv
+                if node.whentrue and rv:
+                    node.whentrue()
+                elif node.whenfalse and not rv:
+                    node.whenfalse()
+                node.state = 'done'
+        except Cancelled:
+            node.state = 'cancelled'
+        except Exception as error:
+            node.error = error
+            node.state = 'failed'
+        node.finished = clock.monotonic()
+        completions.put(node)
+
+    def emit_timing(self, node):
+        waited = node.started - node.ready_at
+        ran = node.finished - node.started
+        self.info.emit('timing', f'"{node.name}" {node.state}: waited {waited:.2f}s, ran {ran:.3f}s')
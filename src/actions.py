@@ -5,10 +5,9 @@
 # GNU General Public License version 2, incorporated herein by reference.
 #
 
-import time
 import types
 import utils
-from utils import WaitValue
+from utils import WaitValue, Cancelled
 from PyQt5.QtCore import QObject, pyqtSignal
 
 
@@ -23,7 +22,8 @@ class Action(QObject):
     info = pyqtSignal(str, str)
 
     def __init__(self, func, name='unknown',
-                 cond=None, whentrue=None, whenfalse=None, initwait=None):
+                 cond=None, whentrue=None, whenfalse=None, initwait=None, stop_event=None,
+                 clock=None):
         super().__init__()
         self.func = func
         self.name = name
@@ -31,6 +31,8 @@ class Action(QObject):
         self.whentrue = whentrue
         self.whenfalse = whenfalse
         self.initwait = initwait
+        self.stop_event = stop_event
+        self.clock = clock
 
     def run(self):
         self.show_status()
@@ -39,14 +41,14 @@ class Action(QObject):
             return
 
         if isinstance(self.initwait, WaitValue):
-            wait_time = self.initwait.value()
+            wait_time = self.initwait.value(self.clock)
         elif self.initwait:
             wait_time = self.initwait
         else:
             wait_time = 0
 
         self.info.emit('initwait', str(wait_time))
-        time.sleep(wait_time)
+        utils.sleep(wait_time, self.stop_event, self.clock)
 
         rv = self.func()
         if self.whentrue and rv:
@@ -64,13 +66,15 @@ class Action(QObject):
 
 
 class ActionList:
-    def __init__(self):
+    def __init__(self, stop_event=None, clock=None):
         self.actionlist = []
-        pass
+        self.stop_event = stop_event
+        self.clock = clock
 
     def add(self, func, name='unknown', cond=None, whentrue=None,
             whenfalse=None, initwait=None):
-        action = Action(func, name, cond, whentrue, whenfalse, initwait)
+        action = Action(func, name, cond, whentrue, whenfalse, initwait,
+                        self.stop_event, self.clock)
         self.actionlist.append(action)
 
     def connect(self, handler):
@@ -78,5 +82,10 @@ class ActionList:
             act.info.connect(handler)
 
     def run(self):
-        for act in self.actionlist:
-            act.run()
+        try:
+            for act in self.actionlist:
+                utils.check_cancel(self.stop_event)
+                act.run()
+        except Cancelled:
+            return False
+        return True
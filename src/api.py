@@ -0,0 +1,280 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# Local control and status API, served on its own threads. Reads only look
+# at state the rule thread publishes, and commands are handed to the GUI
+# thread through web_queue, so the rule thread is never touched.
+#
+#   GET  /status                current rule and action, countdown, connection...
+#   GET  /flags                 rule flags
+#   GET  /events                WebSocket, streams log/status/progress/alert messages
+#   POST /control/start
+#   POST /control/stop
+#   POST /control/reload        reload the rule file
+#   POST /control/attach        body: {"session": "<executor url> <session id>"}
+#
+# Control requests must be sent as 'Content-Type: application/json', and
+# requests from browser pages other than the API's own origin are refused,
+# so pages opened in the automated browser can't drive the engine.
+# Configured in app.ini:
+#
+#   [api]
+#   enable = yes
+#   host = 127.0.0.1
+#   port = 8765             ; 0 picks a free port, shown in the log
+#   token = secret          ; sent as 'X-Selmate-Token' or '?token=', needed
+#                           ; unless the host is a loopback address
+#
+
+import hmac
+import json
+import base64
+import struct
+import hashlib
+import threading
+from collections import deque
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import settings
+
+ApiSection = 'api'
+Commands = ('start', 'stop', 'reload', 'attach')
+WebSocketGUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+LocalHosts = ('127.0.0.1', 'localhost', '::1')
+
+
+def enabled():
+    return settings.Config.getboolean(ApiSection, 'enable', fallback=False)
+
+
+class EventHub(object):
+    # fan-out of postal messages; slow subscribers lose their oldest events
+    # rather than holding up the sender
+    def __init__(self, backlog=1000):
+        self.backlog = backlog
+        self.subscribers = set()
+        self.latest = {}
+        self.sequence = {}          # bumped per message, tells a repeat from a new one
+        self.lock = threading.Lock()
+
+    def publish(self, mtype, text):
+        with self.lock:
+            self.latest[mtype] = text
+            self.sequence[mtype] = self.sequence.get(mtype, 0) + 1
+            subscribers = list(self.subscribers)
+        for sub in subscribers:
+            sub.put(mtype, text)
+
+    def last(self, mtype, default=''):
+        # the latest message of a type and its sequence number
+        with self.lock:
+            return self.latest.get(mtype, default), self.sequence.get(mtype, 0)
+
+    def subscribe(self):
+        sub = Subscription(self.backlog)
+        with self.lock:
+            self.subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            self.subscribers.discard(sub)
+
+
+class Subscription(object):
+    def __init__(self, backlog):
+        self.events = deque(maxlen=backlog)
+        self.ready = threading.Condition()
+
+    def put(self, mtype, text):
+        with self.ready:
+            self.events.append((mtype, text))
+            self.ready.notify()
+
+    def get(self, timeout):
+        with self.ready:
+            if not self.events:
+                self.ready.wait(timeout)
+            return self.events.popleft() if self.events else None
+
+
+class ControlServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, hub, status, flags, control, host=None, port=None, token=None):
+        cfg = settings.Config
+        host = host or cfg.get(ApiSection, 'host', fallback='127.0.0.1')
+        port = port if port is not None else cfg.getint(ApiSection, 'port', fallback=8765)
+        self.token = token if token is not None else cfg.get(ApiSection, 'token', fallback='')
+        if not self.token and host not in LocalHosts:
+            raise Exception(f"Control API on '{host}' needs a token in [{ApiSection}]")
+        self.hub = hub
+        self.status = status        # callables, run on the server's threads
+        self.flags = flags
+        self.control = control
+        self.stopping = threading.Event()
+        self.thread = None
+        super().__init__((host, port), ControlHandler)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='api', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.shutdown()
+        self.server_close()
+
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+
+class ControlHandler(BaseHTTPRequestHandler):
+    server_version = 'selmate-api'
+    protocol_version = 'HTTP/1.1'     # WebSocket clients insist on it
+
+    def log_message(self, format, *args):
+        pass    # no access log on stderr
+
+    def authorized(self):
+        token = self.server.token
+        if not token:
+            return True
+        query = parse_qs(urlparse(self.path).query)
+        given = [self.headers.get('X-Selmate-Token'), query.get('token', [None])[0]]
+        return any(hmac.compare_digest(token.encode(), g.encode()) for g in given if g)
+
+    def local_origin(self):
+        # browsers send Origin with cross-site requests, other clients don't
+        origin = self.headers.get('Origin')
+        if not origin:
+            return True
+        url = urlparse(origin)
+        return url.hostname in LocalHosts and url.port == self.server.server_address[1]
+
+    def refused(self):
+        if not self.local_origin():
+            self.send_json(403, {'error': 'origin not allowed'})
+            return True
+        if not self.authorized():
+            self.send_json(401, {'error': 'unauthorized'})
+            return True
+        return False
+
+    def send_json(self, code, data):
+        body = json.dumps(data, default=str).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.refused():
+            return
+
+        path = urlparse(self.path).path
+        if path == '/status':
+            self.send_json(200, self.server.status())
+        elif path == '/flags':
+            self.send_json(200, self.server.flags())
+        elif path == '/events':
+            self.stream_events()
+        else:
+            self.send_json(404, {'error': f'unknown path {path}'})
+
+    def do_POST(self):
+        if self.refused():
+            return
+
+        path = urlparse(self.path).path
+        command = path[len('/control/'):] if path.startswith('/control/') else None
+        if command not in Commands:
+            return self.send_json(404, {'error': f'unknown path {path}'})
+
+        # a page can post text/plain without a CORS preflight, not JSON
+        length = int(self.headers.get('Content-Length') or 0)
+        content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type != 'application/json':
+            self.rfile.read(length)
+            return self.send_json(415, {'error': 'Content-Type must be application/json'})
+        try:
+            args = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            return self.send_json(400, {'error': 'body is not valid JSON'})
+        if command == 'attach' and not args.get('session'):
+            return self.send_json(400, {'error': "attach needs 'session'"})
+
+        self.server.control(command, args)
+        self.send_json(202, {'accepted': command})
+
+    # WebSocket, server to client text frames only
+
+    def stream_events(self):
+        key = self.headers.get('Sec-WebSocket-Key')
+        if not key or self.headers.get('Upgrade', '').lower() != 'websocket':
+            return self.send_json(400, {'error': 'WebSocket upgrade expected'})
+
+        accept = base64.b64encode(hashlib.sha1((key + WebSocketGUID).encode()).digest())
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept.decode())
+        self.end_headers()
+        self.close_connection = True
+
+        sub = self.server.hub.subscribe()
+        closed = threading.Event()
+        threading.Thread(target=self.read_frames, args=(closed,), daemon=True).start()
+        try:
+            while not closed.is_set() and not self.server.stopping.is_set():
+                event = sub.get(timeout=1)
+                if event is None:
+                    self.send_frame(0x9, b'')     # ping, finds dead clients
+                    continue
+                mtype, text = event
+                self.send_frame(0x1, json.dumps({'type': mtype, 'text': text}).encode())
+        except OSError:
+            pass
+        finally:
+            self.server.hub.unsubscribe(sub)
+
+    def send_frame(self, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        self.wfile.write(header + payload)
+        self.wfile.flush()
+
+    def read_frames(self, closed):
+        # only looks for the client's close frame, everything else is dropped
+        try:
+            while True:
+                head = self.rfile.read(2)
+                if len(head) < 2:
+                    break
+                opcode, length = head[0] & 0x0f, head[1] & 0x7f
+                if length == 126:
+                    length = struct.unpack('!H', self.rfile.read(2))[0]
+                elif length == 127:
+                    length = struct.unpack('!Q', self.rfile.read(8))[0]
+                if head[1] & 0x80:
+                    self.rfile.read(4)    # mask
+                self.rfile.read(length)
+                if opcode == 0x8:
+                    break
+        except (OSError, struct.error):
+            pass
+        closed.set()
+
@@ -0,0 +1,620 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# Chrome DevTools Protocol backend. Talks to Chromium's DevTools websocket
+# directly instead of going through chromedriver, while exposing the subset
+# of the WebDriver API that MyWeb uses. Enabled per browser config:
+#
+#   [chromium]
+#   browser = chromium
+#   backend = cdp
+#   exe = /usr/bin/chromium
+#   user_data_dir = ~/.config/selmate-chromium
+#   debugging_port = 0      ; 0 picks a free port
+#
+# Sessions are recorded as 'cdp://127.0.0.1:<port> <target-id>'.
+#
+
+import json
+import time
+import base64
+import socket
+import itertools
+import threading
+import subprocess
+import urllib.request
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from selenium.webdriver.common.keys import Keys
+from selenium.common.exceptions import (
+    NoAlertPresentException,
+    NoSuchElementException,
+    StaleElementReferenceException,
+    WebDriverException,
+    TimeoutException as SeleniumTimeoutException,
+)
+
+import settings
+import launch
+import profiles
+
+Scheme = 'cdp://'
+
+FIND_JS = """function(root, by, query, many) {
+    const doc = root ? root.contentDocument : document;
+    if (!doc) return many ? [] : null;
+    if (by === 'xpath') {
+        if (!many)
+            return doc.evaluate(query, doc, null, XPathResult.FIRST_ORDERED_NODE_TYPE,
+                                null).singleNodeValue;
+        const snap = doc.evaluate(query, doc, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+        const out = [];
+        for (let i = 0; i < snap.snapshotLength; i++) out.push(snap.snapshotItem(i));
+        return out;
+    }
+    const found = doc.getElementsByTagName(query);
+    return many ? Array.from(found) : (found[0] || null);
+}"""
+
+SCRIPT_JS = """function() {
+    const args = Array.prototype.slice.call(arguments);
+    return (function() { %s }).apply(window, args);
+}"""
+
+
+def is_cdp_url(url):
+    return url.startswith(Scheme)
+
+
+def http_url(url):
+    return 'http://' + url[len(Scheme):] if is_cdp_url(url) else url
+
+
+def get_json(url, timeout=5, method='GET'):
+    request = urllib.request.Request(url, method=method)
+    with urllib.request.urlopen(request, timeout=timeout) as resp:
+        return json.loads(resp.read().decode('utf-8'))
+
+
+class CdpConnection(object):
+    # one websocket, many in-flight commands matched back to callers by id
+    def __init__(self, ws_url, timeout=None):
+        # need 'pip install websocket-client' for the CDP backend
+        import websocket
+
+        self.ws = websocket.create_connection(ws_url, enable_multithread=True,
+                                              suppress_origin=True, timeout=timeout)
+        self.ws.settimeout(None)    # only for connecting, the reader waits for events
+        self.ids = itertools.count(1)
+        self.pending = {}
+        self.listeners = {}
+        self.lock = threading.Lock()
+        self.closed = False
+        self.reader = threading.Thread(target=self.read_loop, name='cdp-reader', daemon=True)
+        self.reader.start()
+
+    def send(self, method, params=None):
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise WebDriverException('CDP connection closed')
+            msg_id = next(self.ids)
+            self.pending[msg_id] = future
+        try:
+            self.ws.send(json.dumps({'id': msg_id, 'method': method, 'params': params or {}}))
+        except Exception as error:
+            with self.lock:
+                self.pending.pop(msg_id, None)
+            raise WebDriverException(f'CDP send failed: {error}')
+        return future
+
+    def call(self, method, params=None, timeout=None):
+        future = self.send(method, params)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            raise SeleniumTimeoutException(f'CDP command {method} timed out')
+
+    def on(self, method, callback):
+        with self.lock:
+            self.listeners.setdefault(method, []).append(callback)
+
+    def read_loop(self):
+        while True:
+            try:
+                msg = json.loads(self.ws.recv())
+            except Exception:
+                break
+
+            if 'id' in msg:
+                with self.lock:
+                    future = self.pending.pop(msg['id'], None)
+                if future is None:
+                    continue
+                if 'error' in msg:
+                    future.set_exception(to_exception(msg['error']))
+                else:
+                    future.set_result(msg.get('result', {}))
+            elif 'method' in msg:
+                with self.lock:
+                    callbacks = list(self.listeners.get(msg['method'], ()))
+                for callback in callbacks:
+                    try:
+                        callback(msg.get('params', {}))
+                    except Exception:
+                        pass
+
+        with self.lock:
+            self.closed = True
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(WebDriverException('CDP connection closed'))
+
+    def close(self):
+        try:
+            self.ws.close()
+        except Exception:
+            pass
+
+
+def to_exception(error):
+    msg = error.get('message', str(error))
+    if 'Could not find object' in msg or 'Cannot find context' in msg \
+            or 'Node with given id does not' in msg:
+        return StaleElementReferenceException(msg)
+    return WebDriverException(f"CDP error {error.get('code')}: {msg}")
+
+
+class CdpElement(object):
+    def __init__(self, driver, object_id):
+        self.driver = driver
+        self.object_id = object_id
+        self.backend_id = None
+
+    def __del__(self):
+        # fire and forget, the renderer would otherwise hold every node we ever looked up
+        try:
+            self.driver.conn.send('Runtime.releaseObject', {'objectId': self.object_id})
+        except Exception:
+            pass
+
+    def __eq__(self, other):
+        if not isinstance(other, CdpElement):
+            return False
+        try:
+            return self.node_id() == other.node_id()
+        except StaleElementReferenceException:
+            return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.node_id())
+
+    def node_id(self):
+        if self.backend_id is None:
+            node = self.driver.execute('DOM.describeNode', {'objectId': self.object_id})
+            self.backend_id = node['node']['backendNodeId']
+        return self.backend_id
+
+    def call(self, func, *args):
+        return self.driver.call_function(func, args, object_id=self.object_id)
+
+    @property
+    def tag_name(self):
+        return self.call('function() { return this.tagName.toLowerCase(); }')
+
+    @property
+    def text(self):
+        return self.call('function() { return this.innerText || this.textContent || ""; }')
+
+    def get_attribute(self, name):
+        return self.call("""function(name) {
+            const prop = this[name];
+            if (prop !== undefined && prop !== null && typeof prop !== 'object'
+                    && typeof prop !== 'function')
+                return String(prop);
+            return this.getAttribute(name);
+        }""", name)
+
+    def clear(self):
+        self.call("""function() {
+            this.value = '';
+            this.dispatchEvent(new Event('input', {bubbles: true}));
+            this.dispatchEvent(new Event('change', {bubbles: true}));
+        }""")
+
+    def click(self):
+        self.call('function() { this.click(); }')
+
+    @property
+    def screenshot_as_png(self):
+        rect = self.driver.call_function("""function() {
+            const r = this.getBoundingClientRect();
+            return {x: r.left + window.scrollX, y: r.top + window.scrollY,
+                    width: r.width, height: r.height};
+        }""", object_id=self.object_id, by_value=True)
+        return self.driver.get_screenshot_as_png(clip=rect)
+
+    def send_keys(self, *values):
+        self.call('function() { this.focus(); }')
+        for text in values:
+            for idx, chunk in enumerate(str(text).split(Keys.ENTER)):
+                if idx:
+                    self.driver.press_enter()
+                if chunk:
+                    self.driver.execute('Input.insertText', {'text': chunk})
+
+
+class CdpSwitchTo(object):
+    def __init__(self, driver):
+        self.driver = driver
+
+    def default_content(self):
+        self.driver.frame = None
+
+    def frame(self, frame_reference):
+        if not isinstance(frame_reference, CdpElement):
+            raise WebDriverException('CDP backend only supports switching to frame elements')
+        self.driver.frame = frame_reference
+
+    def window(self, handle):
+        self.driver.attach_target(handle)
+
+    @property
+    def alert(self):
+        if self.driver.dialog is None:
+            raise NoAlertPresentException()
+        return CdpAlert(self.driver)
+
+
+class CdpAlert(object):
+    def __init__(self, driver):
+        self.driver = driver
+        self.text = driver.dialog.get('message', '')
+
+    def accept(self):
+        self.driver.execute('Page.handleJavaScriptDialog', {'accept': True})
+
+    def dismiss(self):
+        self.driver.execute('Page.handleJavaScriptDialog', {'accept': False})
+
+
+class CdpExecutor(object):
+    # stands in for WebDriver.command_executor, so '_url' works as before
+    def __init__(self, url):
+        self._url = url
+
+
+class CdpDriver(object):
+    def __init__(self, executor_url, target_id, process=None, browser_config=None, timeout=None):
+        self.command_executor = CdpExecutor(executor_url)
+        self.process = process
+        self.browser_config = browser_config
+        self.page_load_timeout = 300
+        self.script_timeout = timeout if timeout is not None else 30
+        self.page_load_strategy = (browser_config and launch.page_load_strategy(browser_config)) \
+            or 'normal'
+        self.frame = None
+        self.conn = None
+        self.commands = 0
+        self.switch_to = CdpSwitchTo(self)
+        self.attach_target(target_id)
+
+    def attach_target(self, target_id):
+        targets = get_json(f'{http_url(self.command_executor._url)}/json/list',
+                           timeout=min(5, self.script_timeout))
+        for target in targets:
+            if target['id'] == target_id:
+                break
+        else:
+            raise WebDriverException(f'No such CDP target: {target_id}')
+
+        if self.conn:
+            self.conn.close()
+        self.session_id = target_id
+        self.frame = None
+        self.dialog = None
+        self.contexts = {}
+        self.main_frame = None
+        self.loaded = threading.Event()
+        self.context_ready = threading.Condition()
+
+        self.conn = CdpConnection(target['webSocketDebuggerUrl'], self.script_timeout)
+        self.conn.on('Runtime.executionContextCreated', self.on_context_created)
+        self.conn.on('Runtime.executionContextDestroyed', self.on_context_destroyed)
+        self.conn.on('Runtime.executionContextsCleared', self.on_contexts_cleared)
+        self.conn.on('Page.javascriptDialogOpening', self.on_dialog_opening)
+        self.conn.on('Page.javascriptDialogClosed', self.on_dialog_closed)
+        self.conn.on('Page.loadEventFired', self.on_load_event)
+        self.conn.on('Page.domContentEventFired', self.on_dom_content_event)
+        self.conn.on('Page.frameNavigated', self.on_frame_navigated)
+
+        # enable the domains in one go, the replies come back in any order
+        pending = [self.conn.send(domain) for domain in
+                   ('Page.enable', 'Network.enable', 'Runtime.enable')]
+        tree = self.execute('Page.getFrameTree')
+        for future in pending:
+            future.result(self.script_timeout)
+        self.main_frame = tree['frameTree']['frame']['id']
+
+        # blocked urls only hold on the connection that set them, so every
+        # attach and every tab needs its own
+        urls = launch.blocked_urls(self.browser_config) if self.browser_config else []
+        if urls:
+            self.execute('Network.setBlockedURLs', {'urls': urls})
+
+    def on(self, method, callback):
+        # subscribe to raw CDP events, e.g. 'Network.responseReceived'
+        self.conn.on(method, callback)
+
+    def on_context_created(self, params):
+        ctx = params['context']
+        aux = ctx.get('auxData', {})
+        if aux.get('isDefault'):
+            with self.context_ready:
+                self.contexts[aux.get('frameId')] = ctx['id']
+                self.context_ready.notify_all()
+
+    def on_context_destroyed(self, params):
+        with self.context_ready:
+            for frame_id, ctx_id in list(self.contexts.items()):
+                if ctx_id == params['executionContextId']:
+                    del self.contexts[frame_id]
+
+    def on_contexts_cleared(self, params):
+        with self.context_ready:
+            self.contexts = {}
+
+    def on_dialog_opening(self, params):
+        self.dialog = params
+
+    def on_dialog_closed(self, params):
+        self.dialog = None
+
+    def on_load_event(self, params):
+        self.loaded.set()
+
+    def on_dom_content_event(self, params):
+        if self.page_load_strategy == 'eager':
+            self.loaded.set()
+
+    def on_frame_navigated(self, params):
+        frame = params['frame']
+        if not frame.get('parentId'):
+            self.main_frame = frame['id']
+            self.frame = None
+
+    def context_id(self):
+        deadline = time.time() + self.script_timeout
+        with self.context_ready:
+            while self.main_frame not in self.contexts:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise SeleniumTimeoutException('No JavaScript context for current page')
+                self.context_ready.wait(remaining)
+            return self.contexts[self.main_frame]
+
+    def execute(self, method, params=None):
+        self.commands += 1
+        return self.conn.call(method, params, self.script_timeout)
+
+    def execute_cdp_cmd(self, cmd, cmd_args):
+        return self.execute(cmd, cmd_args)
+
+    def to_argument(self, value):
+        if isinstance(value, CdpElement):
+            return {'objectId': value.object_id}
+        return {'value': value}
+
+    def from_result(self, result):
+        if 'exceptionDetails' in result:
+            details = result['exceptionDetails']
+            text = details.get('exception', {}).get('description') or details.get('text')
+            raise WebDriverException(f'javascript error: {text}')
+
+        obj = result['result']
+        if obj.get('subtype') == 'node':
+            return CdpElement(self, obj['objectId'])
+        elif obj.get('subtype') == 'null' or obj.get('type') == 'undefined':
+            return None
+        elif 'value' in obj:
+            return obj['value']
+        elif obj.get('subtype') == 'array':
+            return self.array_items(obj['objectId'])
+        elif 'objectId' in obj:
+            by_value = self.call_function('function() { return this; }', (),
+                                          object_id=obj['objectId'], by_value=True)
+            self.conn.send('Runtime.releaseObject', {'objectId': obj['objectId']})
+            return by_value
+        return None
+
+    def array_items(self, object_id):
+        props = self.execute('Runtime.getProperties', {'objectId': object_id,
+                                                       'ownProperties': True})
+        self.conn.send('Runtime.releaseObject', {'objectId': object_id})
+        items = [(int(p['name']), p['value']) for p in props['result']
+                 if p['name'].isdigit() and 'value' in p]
+        return [self.from_result({'result': value}) for _, value in sorted(items)]
+
+    def call_function(self, func, args=(), object_id=None, by_value=False):
+        params = {
+            'functionDeclaration': func,
+            'arguments': [self.to_argument(a) for a in args],
+            'returnByValue': by_value,
+        }
+        if object_id:
+            params['objectId'] = object_id
+        else:
+            params['executionContextId'] = self.context_id()
+        result = self.execute('Runtime.callFunctionOn', params)
+        if by_value:
+            if 'exceptionDetails' in result:
+                return self.from_result(result)
+            return result['result'].get('value')
+        return self.from_result(result)
+
+    def find(self, by, query, many=False):
+        found = self.call_function(FIND_JS, (self.frame, by, query, many))
+        if many:
+            return found or []
+        if found is None:
+            raise NoSuchElementException(f'Unable to locate element: {by}={query}')
+        return found
+
+    def find_element_by_xpath(self, xpath):
+        return self.find('xpath', xpath)
+
+    def find_elements_by_xpath(self, xpath):
+        return self.find('xpath', xpath, many=True)
+
+    def find_element_by_tag_name(self, name):
+        return self.find('tag', name)
+
+    def find_elements_by_tag_name(self, name):
+        return self.find('tag', name, many=True)
+
+    def execute_script(self, script, *args):
+        return self.call_function(SCRIPT_JS % script, args)
+
+    def evaluate(self, expression):
+        # top level document, regardless of the selected frame
+        result = self.execute('Runtime.evaluate', {'expression': expression,
+                                                   'returnByValue': True,
+                                                   'contextId': self.context_id()})
+        return result['result'].get('value')
+
+    def press_enter(self):
+        for event_type in ('keyDown', 'keyUp'):
+            self.execute('Input.dispatchKeyEvent', {
+                'type': event_type, 'key': 'Enter', 'code': 'Enter',
+                'windowsVirtualKeyCode': 13, 'text': '\r' if event_type == 'keyDown' else '',
+            })
+
+    @property
+    def current_url(self):
+        return self.evaluate('location.href')
+
+    @property
+    def title(self):
+        return self.evaluate('document.title')
+
+    @property
+    def page_source(self):
+        return self.evaluate('document.documentElement.outerHTML')
+
+    @property
+    def current_window_handle(self):
+        info = self.execute('Target.getTargetInfo', {'targetId': self.session_id})
+        return info['targetInfo']['targetId']
+
+    @property
+    def window_handles(self):
+        targets = get_json(f'{http_url(self.command_executor._url)}/json/list')
+        return [t['id'] for t in targets if t.get('type') == 'page']
+
+    def get(self, url):
+        self.loaded.clear()
+        result = self.execute('Page.navigate', {'url': url})
+        if result.get('errorText'):
+            raise WebDriverException(f"navigation failed: {result['errorText']}")
+        if self.page_load_strategy == 'none':
+            return
+        if not self.loaded.wait(self.page_load_timeout):
+            raise SeleniumTimeoutException(f'Timed out loading {url}')
+
+    def new_window(self):
+        # a blank tab, returns its handle
+        return self.execute('Target.createTarget', {'url': 'about:blank'})['targetId']
+
+    def close(self):
+        # close the current tab, switch_to.window() to carry on in another one
+        self.execute('Target.closeTarget', {'targetId': self.session_id})
+
+    def get_cookies(self):
+        return self.execute('Network.getCookies').get('cookies', [])
+
+    def get_screenshot_as_png(self, clip=None):
+        params = {'format': 'png'}
+        if clip:
+            params['clip'] = dict(clip, scale=1)
+        return base64.b64decode(self.execute('Page.captureScreenshot', params)['data'])
+
+    def set_page_load_timeout(self, seconds):
+        self.page_load_timeout = seconds
+
+    def set_script_timeout(self, seconds):
+        self.script_timeout = seconds
+
+    def quit(self):
+        try:
+            version = get_json(f'{http_url(self.command_executor._url)}/json/version')
+            browser = CdpConnection(version['webSocketDebuggerUrl'])
+            browser.call('Browser.close', timeout=5)
+            browser.close()
+        except Exception:
+            if self.process:
+                self.process.terminate()
+        finally:
+            self.conn.close()
+
+
+def detach(driver):
+    # drop a side connection (heartbeat, sampling...) without ending the session;
+    # attached WebDriver sessions share keep-alive connections, nothing to close
+    if isinstance(driver, CdpDriver) and driver.conn:
+        driver.conn.close()
+
+
+def find_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_endpoint(url, timeout=30):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return get_json(f'{url}/json/version', timeout=1)
+        except OSError:
+            if time.time() > deadline:
+                raise WebDriverException(f'DevTools endpoint {url} not responding')
+            time.sleep(0.1)
+
+
+def launch_args(browser_config, port):
+    exe = settings.Config[browser_config]['exe']
+    args = [exe, f'--remote-debugging-port={port}', '--no-first-run',
+            '--no-default-browser-check', '--allow-running-insecure-content',
+            '--ignore-certificate-errors']
+    return args + launch.chromium_arguments(browser_config)
+
+
+def start_cdp(browser_config):
+    port = settings.Config.getint(browser_config, 'debugging_port', fallback=0) or find_free_port()
+    args = launch_args(browser_config, port)
+    user_data_dir = profiles.user_data_dir(browser_config)
+    if user_data_dir:
+        args.append(f'--user-data-dir={user_data_dir}')
+    args.append('about:blank')
+    process = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    wait_for_endpoint(url)
+
+    targets = [t for t in get_json(f'{url}/json/list') if t.get('type') == 'page']
+    if not targets:
+        targets = [get_json(f'{url}/json/new?about:blank', method='PUT')]
+    driver = CdpDriver(f'{Scheme}127.0.0.1:{port}', targets[0]['id'], process=process,
+                       browser_config=browser_config)
+    return profiles.track(driver, user_data_dir)
+
+
+def attach_cdp(executor_url, target_id, timeout=None, browser_config=None):
+    return CdpDriver(executor_url, target_id, timeout=timeout,
+                     browser_config=browser_config or launch.browser_config())
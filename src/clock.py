@@ -0,0 +1,76 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# Time and randomness used by the waits in rules, actions and MyWeb. The
+# engine runs on SystemClock. VirtualClock advances instantly instead of
+# sleeping and draws wait times from a seeded generator, so long rule
+# scenarios can be replayed deterministically in a fraction of the time:
+#
+#   clk = VirtualClock(seed=1)
+#   myweb = MyWeb(postal, clock=clk)
+#   ...
+#   print(clk.elapsed())
+#
+
+import time
+import random
+import threading
+
+
+class Clock(object):
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def wait(self, seconds, event=None):
+        # sleep, or until the event is set. True if the event was set.
+        if event is None:
+            time.sleep(seconds)
+            return False
+        return event.wait(seconds)
+
+    def randint(self, a, b):
+        return random.randint(a, b)
+
+
+class VirtualClock(Clock):
+    def __init__(self, start=0.0, seed=None):
+        self.start = start
+        self.now = start
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.waits = []
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        with self.lock:
+            self.now += max(0.0, seconds)
+
+    def wait(self, seconds, event=None):
+        if event is not None and event.is_set():
+            return True
+        self.waits.append(seconds)
+        self.advance(seconds)
+        return event is not None and event.is_set()
+
+    def randint(self, a, b):
+        with self.lock:
+            return self.random.randint(a, b)
+
+    def elapsed(self):
+        return self.now - self.start
+
+
+SystemClock = Clock()
@@ -8,9 +8,11 @@
 import os.path
 import configparser
 from settings import ResourceDir
+from store import IniStore
 
 Cookies = configparser.ConfigParser()
 Cookiesfile = os.path.expanduser(f'{ResourceDir}/cookies.ini')
+Store = IniStore(Cookiesfile, Cookies)
 
 
 def init():
@@ -19,20 +21,35 @@ def init():
 
 def refresh():
     try:
-        with open(Cookiesfile) as f:
-            Cookies.read_file(f)
+        Store.read()
     except FileNotFoundError:
         pass
 
 
 def update(section, key, value):
-    try:
-        Cookies.add_section(section)
-    except configparser.DuplicateSectionError:
-        pass
-    Cookies.set(section, key, value)
-    with open(Cookiesfile, 'w') as f:
-        Cookies.write(f)
+    Store.update(section, key, value)
+
+
+def remove(section, key):
+    Store.remove(section, key)
+
+
+def session_section(name=None):
+    # each worker keeps its own session record, the GUI uses [browser]
+    return f'session.{name}' if name else 'browser'
+
+
+def save_session(connection, name=None):
+    update(session_section(name), 'session', connection)
+
+
+def get_session(name=None):
+    return Cookies.get(session_section(name), 'session', fallback=None)
+
+
+def watch(handler):
+    Store.connect(handler)
+    Store.watch()
 
 
 if __name__ == '__main__':
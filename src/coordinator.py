@@ -0,0 +1,190 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# Lease based coordinator for running rule sets across several hosts. Rule
+# sets and nodes are kept in a SQLite database on storage all nodes can
+# reach. Each node's supervisor heartbeats, renews its leases and takes or
+# gives up rule sets until it holds its share, in proportion to its slots.
+# Leases of a node that stops heartbeating expire and are taken over by the
+# others. Rule sets are the [worker.<name>] sections of any node, or can be
+# added with the CLI below. Configured in app.ini:
+#
+#   [coordinator]
+#   enable = yes
+#   database = /mnt/shared/selmate/coordinator.db
+#   node = host1            ; defaults to the host name
+#   slots = 4               ; rule sets this node runs at most
+#   lease_seconds = 30      ; leases not renewed within this time expire
+#   heartbeat = 10          ; seconds between heartbeats
+#   share_flags = yes       ; workers keep their flags in the coordinator database,
+#                           ; one namespace per rule set, whichever node runs it
+#
+# The database uses rollback journaling, as WAL doesn't work on network file
+# systems. Node clocks are compared, so keep them in sync (NTP).
+#
+#   python coordinator.py status
+#   python coordinator.py register <name> rulefile=~/rules/a.json [browser=chrome1] [rules=A,B]
+#   python coordinator.py unregister <name>
+#
+
+import os
+import sys
+import json
+import math
+import socket
+import sqlite3
+
+import settings
+from clock import SystemClock
+
+CoordinatorSection = 'coordinator'
+
+
+def enabled():
+    return settings.Config.getboolean(CoordinatorSection, 'enable', fallback=False)
+
+
+class Coordinator(object):
+    def __init__(self, path=None, node=None, slots=None, lease_seconds=None, clock=None):
+        cfg = settings.Config
+        self.clock = clock or SystemClock
+        self.path = os.path.expanduser(path or cfg.get(
+            CoordinatorSection, 'database', fallback=f'{settings.ResourceDir}/coordinator.db'))
+        self.node = node or cfg.get(CoordinatorSection, 'node', fallback=socket.gethostname())
+        self.slots = slots if slots is not None \
+            else cfg.getint(CoordinatorSection, 'slots', fallback=4)
+        self.lease_seconds = lease_seconds if lease_seconds is not None \
+            else cfg.getfloat(CoordinatorSection, 'lease_seconds', fallback=30)
+        self.heartbeat_interval = cfg.getfloat(CoordinatorSection, 'heartbeat', fallback=10)
+        self.share_flags = cfg.getboolean(CoordinatorSection, 'share_flags', fallback=True)
+        self.last_heartbeat = 0
+        self.db = self.connect()
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.execute('PRAGMA journal_mode=DELETE')
+        db.execute('CREATE TABLE IF NOT EXISTS nodes '
+                   '(name TEXT PRIMARY KEY, slots INTEGER, heartbeat REAL)')
+        db.execute('CREATE TABLE IF NOT EXISTS rulesets '
+                   '(name TEXT PRIMARY KEY, options TEXT)')
+        db.execute('CREATE TABLE IF NOT EXISTS leases '
+                   '(ruleset TEXT PRIMARY KEY, node TEXT, expires REAL)')
+        return db
+
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two nodes can't
+        # both see a rule set as free and claim it
+        return Transaction(self.db)
+
+    def register_ruleset(self, name, options):
+        with self.transaction():
+            self.db.execute('INSERT OR REPLACE INTO rulesets VALUES (?, ?)',
+                            (name, json.dumps(options, sort_keys=True)))
+
+    def unregister_ruleset(self, name):
+        with self.transaction():
+            self.db.execute('DELETE FROM rulesets WHERE name = ?', (name,))
+            self.db.execute('DELETE FROM leases WHERE ruleset = ?', (name,))
+
+    def heartbeat_due(self):
+        return self.clock.time() - self.last_heartbeat >= self.heartbeat_interval
+
+    def heartbeat(self):
+        # renew, expire and rebalance; returns {ruleset: options} leased to this node
+        now = self.clock.time()
+        self.last_heartbeat = now
+        with self.transaction():
+            db = self.db
+            db.execute('INSERT OR REPLACE INTO nodes VALUES (?, ?, ?)',
+                       (self.node, self.slots, now))
+            db.execute('UPDATE leases SET expires = ? WHERE node = ?',
+                       (now + self.lease_seconds, self.node))
+            db.execute('DELETE FROM leases WHERE expires < ?', (now,))
+            db.execute('DELETE FROM leases WHERE ruleset NOT IN (SELECT name FROM rulesets)')
+
+            rulesets = dict(db.execute('SELECT name, options FROM rulesets').fetchall())
+            leases = dict(db.execute('SELECT ruleset, node FROM leases').fetchall())
+            nodes = db.execute('SELECT name, slots FROM nodes WHERE heartbeat >= ?',
+                               (now - self.lease_seconds,)).fetchall()
+
+            share = self.share(len(rulesets), nodes)
+            mine = sorted(r for r, n in leases.items() if n == self.node)
+            if len(mine) > share:
+                # give some back, nodes below their share pick them up
+                for ruleset in mine[share:]:
+                    db.execute('DELETE FROM leases WHERE ruleset = ? AND node = ?',
+                               (ruleset, self.node))
+                mine = mine[:share]
+            else:
+                free = sorted(r for r in rulesets if r not in leases)
+                for ruleset in free[:share - len(mine)]:
+                    db.execute('INSERT INTO leases VALUES (?, ?, ?)',
+                               (ruleset, self.node, now + self.lease_seconds))
+                    mine.append(ruleset)
+
+        return {name: json.loads(rulesets[name]) for name in mine}
+
+    def share(self, total, nodes):
+        total_slots = sum(slots for _, slots in nodes) or 1
+        return min(self.slots, math.ceil(total * self.slots / total_slots))
+
+    def leave(self):
+        # hand our rule sets over straight away instead of waiting for expiry
+        with self.transaction():
+            self.db.execute('DELETE FROM leases WHERE node = ?', (self.node,))
+            self.db.execute('DELETE FROM nodes WHERE name = ?', (self.node,))
+
+    def status(self):
+        now = self.clock.time()
+        nodes = self.db.execute('SELECT name, slots, heartbeat FROM nodes ORDER BY name').fetchall()
+        leases = self.db.execute('SELECT ruleset, node, expires FROM leases').fetchall()
+        rulesets = [r for r, in self.db.execute('SELECT name FROM rulesets ORDER BY name')]
+        held = {ruleset: (node, expires) for ruleset, node, expires in leases}
+        return {
+            'nodes': [{'name': name, 'slots': slots, 'age': now - heartbeat,
+                       'alive': now - heartbeat <= self.lease_seconds,
+                       'rulesets': sorted(r for r, (n, _) in held.items() if n == name)}
+                      for name, slots, heartbeat in nodes],
+            'unassigned': [r for r in rulesets if r not in held],
+        }
+
+    def close(self):
+        self.db.close()
+
+
+class Transaction(object):
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+if __name__ == '__main__':
+    settings.init()
+    coordinator = Coordinator()
+    command = sys.argv[1] if len(sys.argv) > 1 else 'status'
+    if command == 'register' and len(sys.argv) > 2:
+        options = dict(arg.split('=', 1) for arg in sys.argv[3:])
+        coordinator.register_ruleset(sys.argv[2], options)
+    elif command == 'unregister' and len(sys.argv) > 2:
+        coordinator.unregister_ruleset(sys.argv[2])
+    elif command == 'status':
+        st = coordinator.status()
+        for node in st['nodes']:
+            state = 'alive' if node['alive'] else 'dead'
+            print(f"  {node['name']:<16} {state:<6} slots={node['slots']} "
+                  f"heartbeat={node['age']:.0f}s ago | {', '.join(node['rulesets'])}")
+        print(f"  unassigned: {', '.join(st['unassigned']) or '-'}")
+    else:
+        print(f'usage: {sys.argv[0]} status | register <name> key=value... | unregister <name>')
+        sys.exit(1)
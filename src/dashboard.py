@@ -0,0 +1,487 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# Dashboard for many engines at once: the workers of a local supervisor (see
+# workers.py) and single session windows with the control API on (see api.py).
+# Messages are folded into per-engine state as they arrive, and the table is
+# repainted at a fixed rate, only for the rows that changed. Each engine keeps
+# a bounded log, shown when its row is double-clicked.
+#
+#   python dashboard.py [--no-workers] [--api http://host:8765 ...]
+#
+# Configured in app.ini:
+#
+#   [dashboard]
+#   refresh_ms = 250        ; table repaint interval
+#   log_lines = 1000        ; log lines kept per engine
+#   remotes = http://127.0.0.1:8765, http://host2:8765
+#   remote_interval = 2     ; seconds between /status polls
+#   remote_token = secret   ; the remotes' [api] token
+#
+
+import sys
+import json
+import time
+import argparse
+import threading
+import urllib.request
+from queue import Queue, Empty
+from collections import deque
+
+from PyQt5.QtWidgets import (
+    QApplication, QDialog, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit,
+    QTableView, QHeaderView, QAbstractItemView, QPlainTextEdit, QMenu
+)
+from PyQt5.QtGui import QColor
+from PyQt5.QtCore import (
+    QThread, Qt, QTimer, QAbstractTableModel, QModelIndex, QSortFilterProxyModel
+)
+
+import settings
+import cookies
+import workers
+import coordinator
+from settings import AppName
+
+DashboardSection = 'dashboard'
+ErrorMarkers = ('ERROR', 'Detected', 'TIMEOUT', 'crashed')
+
+Columns = (
+    ('name', 'Engine'),
+    ('state', 'State'),
+    ('rule', 'Rule'),
+    ('action', 'Action'),
+    ('countdown', 'Initwait'),
+    ('rate', 'Passes/s'),
+    ('notifications', 'Notified'),
+    ('last_error', 'Last error'),
+)
+
+
+class Engine(object):
+    def __init__(self, name, source, log_lines):
+        self.name = name
+        self.source = source        # 'local' or the API url
+        self.state = ''
+        self.status = ''
+        self.rule = ''
+        self.action = ''
+        self.countdown_end = 0
+        self.countdown_seq = None
+        self.passes = None
+        self.passes_at = 0
+        self.rate = 0.0
+        self.notifications = 0
+        self.last_error = ''
+        self.logs = deque(maxlen=log_lines)
+        self.log_total = 0
+
+    def countdown(self, now):
+        return max(0, int(self.countdown_end - now + 0.999))
+
+    def add_log(self, text):
+        text = text.rstrip('\n')
+        self.logs.append(text)
+        self.log_total += 1
+        if any(marker in text for marker in ErrorMarkers):
+            self.last_error = text
+
+    def update(self, snapshot, now):
+        # snapshot is MyWeb.snapshot(), from a worker or an API /status
+        self.rule = snapshot.get('rule', '')
+        self.action = snapshot.get('action', '')
+        self.notifications = snapshot.get('notifications', 0)
+        if snapshot.get('last_error'):
+            self.last_error = snapshot['last_error']
+        passes = snapshot.get('passes')
+        if passes is not None:
+            if self.passes is not None and now > self.passes_at:
+                self.rate = max(0.0, (passes - self.passes) / (now - self.passes_at))
+            self.passes, self.passes_at = passes, now
+
+    def cell(self, key, now):
+        if key == 'countdown':
+            return self.countdown(now) or ''
+        if key == 'rate':
+            return f'{self.rate:.1f}'
+        return getattr(self, key)
+
+
+class EngineBoard(object):
+    # engine state, written by the feeder threads and read by the GUI thread
+    def __init__(self, log_lines):
+        self.log_lines = log_lines
+        self.engines = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    def engine(self, name, source):
+        # the supervisor and remote threads may both see a new name first
+        with self.lock:
+            engine = self.engines.get(name)
+            if engine is None:
+                engine = self.engines[name] = Engine(name, source, self.log_lines)
+        return engine
+
+    def all_engines(self):
+        with self.lock:
+            return list(self.engines.values())
+
+    def touch(self, name):
+        with self.lock:
+            self.dirty.add(name)
+
+    def take_changes(self):
+        with self.lock:
+            names = sorted(self.engines)
+            dirty, self.dirty = self.dirty, set()
+        return names, dirty
+
+    def handle(self, name, mtype, text):
+        # Supervisor listener, runs on the supervisor thread
+        if name == 'supervisor':
+            name = f'({name})'
+        engine = self.engine(name, 'local')
+        if mtype == 'log':
+            engine.add_log(text)
+        elif mtype == 'status':
+            engine.status = text
+        elif mtype == 'progress':
+            engine.countdown_end = time.time() + int(text)
+        elif mtype == 'state':
+            engine.update(json.loads(text), time.time())
+        elif mtype == 'alert':
+            engine.state = 'alert'
+        self.touch(name)
+
+    def update_workers(self, status):
+        for st in status:
+            engine = self.engine(st['name'], 'local')
+            if engine.state != st['state']:
+                engine.state = st['state']
+                engine.add_log(f"-- {st['state']} (restarts: {st['restarts']})")
+                self.touch(st['name'])
+
+    def update_remote(self, url, status, error=None):
+        now = time.time()
+        engine = self.engine(url, url)
+        if error is not None:
+            state = 'unreachable'
+            if engine.state != state:
+                engine.add_log(f'ERROR polling {url}: {error}')
+        else:
+            state = 'running' if status.get('running') else \
+                'connected' if status.get('started') else 'idle'
+            engine.update(status, now)
+            if status.get('status') and status['status'] != engine.status:
+                engine.status = status['status']
+                engine.add_log(engine.status)
+            # the remote repeats its last countdown, only a new one re-arms it
+            sequence = status.get('countdown_seq')
+            if sequence != engine.countdown_seq:
+                engine.countdown_seq = sequence
+                countdown = int(status.get('countdown') or 0)
+                if countdown:
+                    engine.countdown_end = now + countdown
+        engine.state = state
+        self.touch(url)
+
+
+def row_runs(rows):
+    # contiguous (first, last) runs of row numbers
+    runs = []
+    for row in sorted(set(rows)):
+        if runs and row == runs[-1][1] + 1:
+            runs[-1][1] = row
+        else:
+            runs.append([row, row])
+    return [tuple(run) for run in runs]
+
+
+class EngineTableModel(QAbstractTableModel):
+    def __init__(self, board):
+        super().__init__()
+        self.board = board
+        self.names = []
+        self.rows = {}
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.names)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(Columns)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return Columns[section][1]
+        return None
+
+    def engine_at(self, row):
+        return self.board.engines.get(self.names[row])
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        engine = self.engine_at(index.row())
+        key = Columns[index.column()][0]
+        if role == Qt.DisplayRole:
+            return engine.cell(key, time.time())
+        elif role == Qt.ToolTipRole:
+            return engine.status if key != 'last_error' else engine.last_error
+        elif role == Qt.ForegroundRole and engine.state in ('alert', 'exited', 'unreachable'):
+            return QColor(Qt.red)
+        elif role == Qt.UserRole:
+            return engine.name
+        return None
+
+    def refresh(self):
+        # one repaint per tick, however many messages came in since
+        names, dirty = self.board.take_changes()
+        if names != self.names:
+            self.beginResetModel()
+            self.names = names
+            self.rows = {name: row for row, name in enumerate(names)}
+            self.endResetModel()
+            return
+
+        now = time.time()
+        rows = [self.rows[name] for name in dirty if name in self.rows]
+        rows += [row for row, name in enumerate(self.names)
+                 if self.board.engines[name].countdown_end > now - 1]
+        # a range from the first to the last changed row would repaint
+        # every row in between, and the sort proxy would resort them all
+        for first, last in row_runs(rows):
+            self.dataChanged.emit(self.index(first, 0), self.index(last, len(Columns) - 1))
+
+
+class SupervisorThread(QThread):
+    # owns the supervisor; commands from the GUI are run between polls
+    def __init__(self, supervisor, board):
+        super().__init__()
+        self.supervisor = supervisor
+        self.board = board
+        self.commands = Queue()
+        self.stopping = threading.Event()
+
+    def run(self):
+        self.supervisor.connect(self.board.handle)
+        self.supervisor.start()
+        while not self.stopping.is_set():
+            self.supervisor.poll()
+            self.board.update_workers(self.supervisor.status())
+            while True:
+                try:
+                    command, name = self.commands.get_nowait()
+                except Empty:
+                    break
+                if name not in self.supervisor.workers:
+                    continue
+                if command == 'restart':
+                    self.supervisor.restart_worker(name)
+                elif command == 'stop':
+                    self.supervisor.stop_worker(name)
+        self.supervisor.stop()
+        self.board.update_workers(self.supervisor.status())
+
+
+class RemoteThread(QThread):
+    def __init__(self, urls, board):
+        super().__init__()
+        cfg = settings.Config
+        self.urls = urls
+        self.board = board
+        self.interval = cfg.getfloat(DashboardSection, 'remote_interval', fallback=2)
+        self.token = cfg.get(DashboardSection, 'remote_token', fallback='')
+        self.stopping = threading.Event()
+
+    def fetch(self, url):
+        request = urllib.request.Request(f'{url}/status')
+        if self.token:
+            request.add_header('X-Selmate-Token', self.token)
+        with urllib.request.urlopen(request, timeout=self.interval) as response:
+            return json.loads(response.read())
+
+    def run(self):
+        while not self.stopping.is_set():
+            for url in self.urls:
+                try:
+                    self.board.update_remote(url, self.fetch(url))
+                except (OSError, ValueError) as error:
+                    self.board.update_remote(url, None, error)
+            self.stopping.wait(self.interval)
+
+
+class LogDialog(QDialog):
+    def __init__(self, engine, parent=None):
+        super().__init__(parent)
+        self.engine = engine
+        self.setWindowTitle(f'{AppName} log: {engine.name}')
+        self.setGeometry(450, 450, 700, 400)
+        vbox = QVBoxLayout()
+        self.text = QPlainTextEdit()
+        self.text.setReadOnly(True)
+        self.text.setMaximumBlockCount(engine.logs.maxlen)
+        vbox.addWidget(self.text)
+        self.setLayout(vbox)
+        self.seen = engine.log_total - len(engine.logs)
+        self.refresh()
+
+    def refresh(self):
+        logs = list(self.engine.logs)
+        new = min(self.engine.log_total - self.seen, len(logs))
+        if new > 0:
+            self.text.appendPlainText('\n'.join(logs[-new:]))
+            self.seen = self.engine.log_total
+
+
+class Dashboard(QDialog):
+    def __init__(self, supervisor=None, remotes=()):
+        super().__init__()
+        cfg = settings.Config
+        self.board = EngineBoard(cfg.getint(DashboardSection, 'log_lines', fallback=1000))
+        self.model = EngineTableModel(self.board)
+        self.log_windows = {}
+        self.make_window()
+
+        self.supervisor_thread = None
+        if supervisor:
+            self.supervisor_thread = SupervisorThread(supervisor, self.board)
+            self.supervisor_thread.start()
+        self.remote_thread = None
+        if remotes:
+            self.remote_thread = RemoteThread(list(remotes), self.board)
+            self.remote_thread.start()
+
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(cfg.getint(DashboardSection, 'refresh_ms', fallback=250))
+
+    def make_window(self):
+        project = settings.Config.get('web', 'project', fallback='untitled')
+        self.setWindowTitle(f"{AppName} dashboard [{project}]")
+        self.setGeometry(300, 300, 1000, 600)
+        vbox = QVBoxLayout()
+
+        hbox = QHBoxLayout()
+        vbox.addLayout(hbox)
+        hbox.addWidget(QLabel("Filter:"))
+        self.filter = QLineEdit("")
+        hbox.addWidget(self.filter)
+
+        self.proxy = QSortFilterProxyModel()
+        self.proxy.setSourceModel(self.model)
+        self.proxy.setFilterKeyColumn(-1)
+        self.proxy.setFilterCaseSensitivity(Qt.CaseInsensitive)
+        self.filter.textChanged.connect(self.proxy.setFilterFixedString)
+
+        # fixed row heights, so the view only lays out the rows on screen
+        self.table = QTableView()
+        self.table.setModel(self.proxy)
+        self.table.setSortingEnabled(True)
+        self.table.sortByColumn(0, Qt.AscendingOrder)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.setWordWrap(False)
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.table.verticalHeader().setDefaultSectionSize(
+            self.table.fontMetrics().height() + 6)
+        self.table.verticalHeader().hide()
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.doubleClicked.connect(self.open_log)
+        self.table.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.table.customContextMenuRequested.connect(self.generate_context_menu)
+        vbox.addWidget(self.table)
+
+        self.summary = QLabel()
+        vbox.addWidget(self.summary)
+        self.setLayout(vbox)
+        self.show()
+
+    def refresh(self):
+        self.model.refresh()
+        for window in self.log_windows.values():
+            window.refresh()
+
+        engines = self.board.all_engines()
+        running = sum(1 for e in engines if e.state == 'running')
+        troubled = sum(1 for e in engines if e.state in ('alert', 'exited', 'unreachable'))
+        rate = sum(e.rate for e in engines)
+        self.summary.setText(f'{len(engines)} engine(s), {running} running, '
+                             f'{troubled} need attention, {rate:.1f} passes/s')
+
+    def engine_name(self, index):
+        return self.proxy.data(index, Qt.UserRole)
+
+    def open_log(self, index):
+        name = self.engine_name(index)
+        window = self.log_windows.get(name)
+        if window is None:
+            window = LogDialog(self.board.engines[name], self)
+            window.finished.connect(lambda _, name=name: self.log_windows.pop(name, None))
+            self.log_windows[name] = window
+        window.show()
+        window.raise_()
+
+    def generate_context_menu(self, location):
+        index = self.table.indexAt(location)
+        if not index.isValid():
+            return
+        name = self.engine_name(index)
+        menu = QMenu(self)
+        menu.addAction("Open log", lambda: self.open_log(index))
+        if self.supervisor_thread and self.board.engines[name].source == 'local':
+            menu.addSeparator()
+            menu.addAction("Restart worker",
+                           lambda: self.supervisor_thread.commands.put(('restart', name)))
+            menu.addAction("Stop worker",
+                           lambda: self.supervisor_thread.commands.put(('stop', name)))
+        menu.exec_(self.table.viewport().mapToGlobal(location))
+
+    def closeEvent(self, event):
+        self.timer.stop()
+        if self.remote_thread:
+            self.remote_thread.stopping.set()
+            self.remote_thread.wait()
+        if self.supervisor_thread:
+            self.summary.setText('Stopping workers...')
+            self.supervisor_thread.stopping.set()
+            self.supervisor_thread.wait()
+        event.accept()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Dashboard for workers and remote sessions')
+    parser.add_argument('--no-workers', action='store_true',
+                        help="don't run the [worker.*] sections here, only watch remotes")
+    parser.add_argument('--api', action='append', default=[],
+                        help='control API url of a session window, may be repeated')
+    args = parser.parse_args(argv)
+
+    settings.init()
+    cookies.init()
+    remotes = args.api or [u.strip() for u in settings.Config.get(
+        DashboardSection, 'remotes', fallback='').split(',') if u.strip()]
+
+    supervisor = None
+    has_workers = any(s.startswith(workers.WorkerSectionPrefix)
+                      for s in settings.Config.sections())
+    if not args.no_workers and (has_workers or coordinator.enabled()):
+        supervisor = workers.Supervisor()
+        supervisor.watch_config()
+    if not supervisor and not remotes:
+        print(f"ERROR: no '[{workers.WorkerSectionPrefix}<name>]' sections or remotes "
+              f"defined in {settings.Configfile}")
+        return 1
+
+    app = QApplication(sys.argv)
+    _dashboard = Dashboard(supervisor, remotes)
+    return app.exec()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
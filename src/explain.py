@@ -0,0 +1,280 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# Static cost analysis of a rule file, without running it:
+#
+#   python explain.py [rulefile] [--rules A,B] [--frames 2]
+#                     [--latency-ms 20 | --calibrate] [--json]
+#
+# For each rule it estimates the WebDriver round trips MyWeb makes on a pass
+# where the page hasn't changed (steady), on a pass where it has (fire) and
+# on a pass where the page is for another rule (miss, the url is looked up in
+# each of --frames frames), the worst case initWait, and flags patterns known
+# to be slow. The steady pass of a tab assumes the page costing the most. With a
+# per-command latency, measured against the saved browser session with
+# --calibrate or given with --latency-ms, the counts become time per pass.
+#
+
+import re
+import sys
+import json
+import time
+import argparse
+import statistics
+
+import settings
+import cookies
+import rulefile
+import tabs
+from utils import WaitValue, dict_gets
+
+RegexOperators = ('search', '~', 'notsearch', '!~')
+HugeTextXpaths = re.compile(r'^\s*(/html|//html|/html/body|//body|//\*)\s*$', re.IGNORECASE)
+NestedQuantifier = re.compile(r'\((?:[^()\\]|\\.)*[+*]\)[+*{]')
+MaxFlagDepth = 3
+
+# round trips of each step, see MyWeb.run_rule/run_action
+UrlCheck = 1            # current_url
+UrlCheckFrames = 3      # current_url, default_content, find frames, when the url doesn't match
+FrameUrl = 1            # url of each frame
+PageCheck = 1           # find <head>, compared locally
+PagePolls = 2           # page checks per second of initWait
+ElementValue = 2        # tag_name + text/value
+Click = 3               # tag_name, type, click script
+SendKeys = 2            # clear + send_keys
+
+
+def max_wait(spec):
+    if isinstance(spec, int):
+        return spec
+    arr = [a for a in re.split(r'[e\s]+', str(spec).strip()) if a]
+    if not arr or len(arr) > 2:
+        return 0
+    return max(WaitValue(*arr).range())
+
+
+def flag_depth(flag):
+    depth = 0
+    while flag:
+        depth += 1
+        flag = flag.get('and') or flag.get('or')
+    return depth
+
+
+class RuleCost(object):
+    def __init__(self, rule, frames=0):
+        self.rule = rule
+        self.name = rule.get('name', '(unknown)')
+        self.url = rule.get('url', '')
+        self.tab = tabs.rule_tab(rule)
+        self.steady = UrlCheck + PageCheck
+        self.miss = UrlCheckFrames + frames * FrameUrl
+        self.wait = max_wait(rule.get('initWait', ''))
+        # check, then keep the new <head>, and poll it while waiting
+        self.fire = UrlCheck + 2 * PageCheck + int(self.wait * PagePolls)
+        self.actions = []
+        self.warnings = []
+        self.errors = []
+        for idx, action in enumerate(rule.get('actions', [])):
+            self.actions.append(self.action_cost(idx, action))
+        self.fire += sum(a['trips'] for a in self.actions)
+        self.wait += sum(a['wait'] for a in self.actions)
+
+    def warn(self, idx, text):
+        self.warnings.append(f'action #{idx}: {text}' if idx is not None else text)
+
+    def action_cost(self, idx, action):
+        name = action.get('name', '(unknown)')
+        if not action.get('enable', True):
+            return {'index': idx, 'name': name, 'trips': 0, 'wait': 0, 'enabled': False}
+
+        wait = max_wait(action.get('initWait', ''))
+        # page checks around the wait, plus one every 0.5s while waiting
+        trips = PageCheck + (PageCheck + int(wait * PagePolls) if wait else 0)
+        trips += 1      # find the action element
+
+        addon = action.get('addon', {})
+        xpath = dict_gets(addon, ('xpath', 'elementFinder'))
+        if xpath:
+            trips += 1 + ElementValue
+            self.check_criteria(idx, xpath, addon)
+
+        spec = action.get('visual')
+        if spec:
+            trips += 2 if dict_gets(spec, ('xpath', 'elementFinder')) else 1
+            self.warn(idx, 'visual condition takes a screenshot on every pass')
+
+        flag = action.get('flag')
+        if flag:
+            self.check_flag(idx, flag)
+
+        if action.get('trigger') == 'change' and not xpath:
+            trips += ElementValue
+
+        value = action.get('value', '')
+        if 'UserEvent::Extract' in value:
+            trips += len(action.get('extract', {})) * (1 + ElementValue)
+        elif 'UserEvent::Notify' in value:
+            trips += ElementValue
+        elif value:
+            trips += SendKeys
+        else:
+            trips += Click
+
+        if not wait and not max_wait(self.rule.get('initWait', '')) \
+                and action.get('trigger', 'level') == 'level' and 'UserEvent::' not in value:
+            self.warn(idx, 'no initWait and level trigger, fires on every page change')
+        return {'index': idx, 'name': name, 'trips': trips, 'wait': wait, 'enabled': True}
+
+    def check_criteria(self, idx, xpath, addon):
+        op = str(addon.get('condition', '')).lower()
+        if op not in RegexOperators:
+            return
+        pattern = addon.get('value', '')
+        try:
+            re.compile(pattern)
+        except re.error as error:
+            self.errors.append(f'action #{idx}: invalid regex {pattern!r}: {error}')
+            return
+        if HugeTextXpaths.match(xpath):
+            self.warn(idx, f'regex criteria on the text of {xpath!r}, the whole page')
+        if NestedQuantifier.search(pattern):
+            self.warn(idx, f'nested quantifier in {pattern!r} may backtrack badly')
+
+    def check_flag(self, idx, flag):
+        depth = flag_depth(flag)
+        if depth > MaxFlagDepth:
+            self.warn(idx, f'flag chain {depth} deep, consider splitting it')
+        node = flag
+        while node:
+            if 'and' in node and 'or' in node:
+                self.errors.append(f"action #{idx}: flag has both 'and' and 'or'")
+            op = str(node.get('condition', '')).lower()
+            if op in RegexOperators:
+                try:
+                    re.compile(node.get('value', ''))
+                except re.error as error:
+                    self.errors.append(f"action #{idx}: invalid flag regex: {error}")
+            node = node.get('and') or node.get('or')
+
+    def as_dict(self, latency=None):
+        d = {'name': self.name, 'tab': self.tab, 'enabled': bool(self.rule.get('enable')),
+             'steady_trips': self.steady, 'fire_trips': self.fire, 'miss_trips': self.miss,
+             'worst_wait': self.wait,
+             'actions': self.actions, 'warnings': self.warnings, 'errors': self.errors}
+        if latency is not None:
+            d['steady_ms'] = self.steady * latency
+            d['miss_ms'] = self.miss * latency
+            d['fire_ms'] = self.fire * latency + self.wait * 1000
+        return d
+
+
+def tab_steady(costs):
+    # a tab shows one page, the rules for other urls pay for the frame scan
+    return max(sum(c.steady if c.url in page else c.miss for c in costs)
+               for page in set(c.url for c in costs))
+
+
+def analyze(rules, latency=None, frames=0):
+    costs = [RuleCost(rule, frames) for rule in rules]
+    batches = tabs.batches(rules)
+    tab_count = len(batches)
+    steady = 1      # check_alert, then the rules of each tab
+    for _, batch in batches:
+        steady += tab_steady([c for c in costs if any(c.rule is r for r in batch)])
+    steady += tab_count if tab_count > 1 else 0
+    report = {
+        'rules': [c.as_dict(latency) for c in costs],
+        'tabs': tab_count,
+        'steady_trips': steady,
+        'latency_ms': latency,
+    }
+    if latency:
+        report['steady_ms'] = steady * latency
+        report['passes_per_second'] = 1000 / (steady * latency + 100)   # WebThread sleeps 0.1s
+    return report
+
+
+def calibrate(samples=20):
+    # time a cheap command against the saved browser session
+    from web import attach_to_session
+
+    session = cookies.get_session()
+    if not session:
+        raise Exception('ERROR: no saved browser session to calibrate against')
+    exe_url, session_id = session.split()
+    driver = attach_to_session(exe_url, session_id)
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        driver.current_url
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def print_report(report):
+    latency = report['latency_ms']
+    for rule in report['rules']:
+        state = '' if rule['enabled'] else ' (disabled)'
+        print(f"Rule '{rule['name']}'{state} [tab {rule['tab']}]")
+        line = f"  steady: {rule['steady_trips']} trips, on change: {rule['fire_trips']} trips, " \
+               f"other page: {rule['miss_trips']} trips"
+        if latency:
+            line += f" (~{rule['steady_ms']:.0f}ms / ~{rule['fire_ms']:.0f}ms incl. waits / " \
+                    f"~{rule['miss_ms']:.0f}ms)"
+        print(line + f", worst initWait {rule['worst_wait']}s")
+        for action in rule['actions']:
+            if action['enabled']:
+                print(f"    #{action['index']} '{action['name']}': {action['trips']} trips, "
+                      f"initWait up to {action['wait']}s")
+        for text in rule['errors']:
+            print(f'  ERROR: {text}')
+        for text in rule['warnings']:
+            print(f'  WARNING: {text}')
+
+    print(f"Steady pass: {report['steady_trips']} round trips over {report['tabs']} tab(s)")
+    if latency:
+        print(f"  at {latency:.1f}ms per command: ~{report['steady_ms']:.0f}ms per pass, "
+              f"~{report['passes_per_second']:.1f} passes/s per worker")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Estimate the cost of a rule file')
+    parser.add_argument('rulefile', nargs='?', help="defaults to [rules] rulefile in app.ini")
+    parser.add_argument('--rules', help='comma separated subset of rules, as for workers')
+    parser.add_argument('--frames', type=int, default=0,
+                        help='frames on the page, searched for rules whose url does not match')
+    parser.add_argument('--latency-ms', type=float, help='time per WebDriver command')
+    parser.add_argument('--calibrate', action='store_true',
+                        help='measure the latency against the saved browser session')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args(argv)
+
+    try:
+        settings.init()
+        cookies.init()
+    except FileNotFoundError:
+        if not args.rulefile:
+            raise   # the rule file comes from app.ini
+    path = args.rulefile or settings.Config['rules']['rulefile']
+    rules = rulefile.load(path)
+    if args.rules:
+        names = [r.strip() for r in args.rules.split(',') if r.strip()]
+        rules = [r for r in rules if r.get('name') in names]
+
+    latency = calibrate() if args.calibrate else args.latency_ms
+    report = analyze(rules, latency, args.frames)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 1 if any(r['errors'] for r in report['rules']) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
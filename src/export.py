@@ -0,0 +1,231 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# Export pipeline for values scraped by 'UserEvent::Extract' actions:
+#
+#   {"name": "Price", "xpath": "//body", "initWait": "",
+#    "value": "UserEvent::Extract(prices)",
+#    "extract": {"price": "//span[@id='price']", "queue": "//div[@id='pos']"}}
+#
+# Rows are queued and written in batches on a background thread. The sink
+# is configured in app.ini, in [export.<name>] or [export] for the default:
+#
+#   [export.prices]
+#   sink = csv              ; csv, jsonl or sqlite
+#   path = ~/.selmate/prices.csv
+#   batch_size = 100        ; write when this many rows are queued...
+#   flush_interval = 5      ; ...or after this many seconds
+#   dedup = yes             ; skip rows whose values haven't changed
+#   queue_size = 10000      ; rows waiting to be written, beyond it rows are dropped
+#
+# A CSV file has one header. When rows bring fields the header doesn't have,
+# the file is moved aside as <name>-<time>.csv and a new one is started with
+# the wider header.
+#
+
+import os
+import csv
+import json
+import time
+import queue
+import atexit
+import sqlite3
+import threading
+from datetime import datetime
+
+import settings
+
+ExportSection = 'export'
+Pipelines = {}
+PipelinesLock = threading.Lock()
+
+
+class CsvSink(object):
+    def __init__(self, path):
+        self.path = path
+        self.fields = None
+
+    def write(self, rows):
+        if self.fields is None and os.path.exists(self.path) and os.path.getsize(self.path):
+            with open(self.path, newline='') as f:
+                self.fields = next(csv.reader(f), None)
+
+        fields = list(self.fields or [])
+        for row in rows:
+            fields.extend(field for field in row if field not in fields)
+        if fields != self.fields:
+            self.rotate(fields)
+
+        with open(self.path, 'a', newline='') as f:
+            writer = csv.DictWriter(f, self.fields)
+            writer.writerows(rows)
+
+    def rotate(self, fields):
+        if self.fields:
+            base, ext = os.path.splitext(self.path)
+            os.replace(self.path, f'{base}-{datetime.now().strftime("%Y%m%d-%H%M%S-%f")}{ext}')
+        self.fields = fields
+        with open(self.path, 'w', newline='') as f:
+            csv.writer(f).writerow(self.fields)
+
+    def close(self):
+        pass
+
+
+class JsonlSink(object):
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, rows):
+        with open(self.path, 'a') as f:
+            for row in rows:
+                f.write(json.dumps(row) + '\n')
+
+    def close(self):
+        pass
+
+
+class SqliteSink(object):
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+
+    def write(self, rows):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS extract '
+                            '(time TEXT, rule TEXT, action TEXT, field TEXT, value TEXT)')
+        with self.db:
+            self.db.executemany('INSERT INTO extract VALUES (?, ?, ?, ?, ?)', [
+                (row['time'], row['rule'], row['action'], field, value)
+                for row in rows
+                for field, value in row.items() if field not in ('time', 'rule', 'action')
+            ])
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+
+Sinks = {
+    'csv': CsvSink,
+    'jsonl': JsonlSink,
+    'sqlite': SqliteSink,
+}
+
+
+class Pipeline(threading.Thread):
+    def __init__(self, sink, batch_size=100, flush_interval=5, dedup=True, log=print,
+                 queue_size=10000):
+        super().__init__(name='export', daemon=True)
+        self.sink = sink
+        self.log = log
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dedup = dedup
+        self.queue = queue.Queue(queue_size)
+        self.last_values = {}
+        self.written = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.overflowing = False
+        self.start()
+
+    def put(self, rule, action, values):
+        # called on the rule thread, never blocks
+        key = (rule, action)
+        if self.dedup and self.last_values.get(key) == values:
+            self.skipped += 1
+            return
+
+        row = {'time': datetime.now().isoformat(timespec='seconds'), 'rule': rule, 'action': action}
+        row.update(values)
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            # the sink can't keep up, say so once per overflow
+            self.dropped += 1
+            if not self.overflowing:
+                self.overflowing = True
+                self.log(f'ERROR export queue full, dropping rows ({self.dropped} so far)')
+            return
+        self.overflowing = False
+        if self.dedup:
+            self.last_values[key] = dict(values)
+
+    def run(self):
+        batch = []
+        deadline = time.time() + self.flush_interval
+        while True:
+            try:
+                row = self.queue.get(timeout=max(0.0, deadline - time.time()))
+            except queue.Empty:
+                row = False
+
+            if row is None:     # closing
+                self.write(batch)
+                self.sink.close()
+                return
+            if row:
+                batch.append(row)
+
+            if len(batch) >= self.batch_size or time.time() >= deadline:
+                self.write(batch)
+                batch = []
+                deadline = time.time() + self.flush_interval
+
+    def write(self, batch):
+        if not batch:
+            return
+        try:
+            self.sink.write(batch)
+            self.written += len(batch)
+        except Exception as error:
+            # a bad batch is lost, the thread carries on with the next
+            self.log(f'ERROR writing extracted values: {type(error).__name__}: {error}')
+
+    def close(self):
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+
+
+def create_pipeline(name=None, log=print):
+    section = f'{ExportSection}.{name}' if name else ExportSection
+    cfg = settings.Config
+    kind = cfg.get(section, 'sink', fallback='jsonl').lower()
+    if kind not in Sinks:
+        raise SyntaxError(f"Unknown export sink '{kind}' in [{section}]")
+    default_path = f'{settings.ResourceDir}/{name or "extract"}.{"db" if kind == "sqlite" else kind}'
+    path = os.path.expanduser(cfg.get(section, 'path', fallback=default_path))
+    return Pipeline(Sinks[kind](path),
+                    batch_size=cfg.getint(section, 'batch_size', fallback=100),
+                    flush_interval=cfg.getfloat(section, 'flush_interval', fallback=5),
+                    dedup=cfg.getboolean(section, 'dedup', fallback=True),
+                    log=log,
+                    queue_size=cfg.getint(section, 'queue_size', fallback=10000))
+
+
+def get_pipeline(name=None, log=print):
+    with PipelinesLock:
+        if name not in Pipelines:
+            Pipelines[name] = create_pipeline(name, log)
+        return Pipelines[name]
+
+
+def close_all():
+    with PipelinesLock:
+        pipelines = list(Pipelines.values())
+        Pipelines.clear()
+    for pipeline in pipelines:
+        pipeline.close()
+
+
+atexit.register(close_all)
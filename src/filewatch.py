@@ -0,0 +1,118 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# Watch files or directories for changes and call back once things have
+# settled down. Uses inotify when the 'inotify_simple' package is available
+# (pip install inotify_simple), otherwise falls back to polling mtimes.
+#
+
+import os
+import time
+import threading
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+def snapshot(path):
+    # mtimes of the path, or of each entry when it's a directory
+    stamps = {}
+    try:
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                full = os.path.join(path, name)
+                stamps[full] = os.path.getmtime(full)
+        else:
+            stamps[path] = os.path.getmtime(path)
+    except FileNotFoundError:
+        pass
+    return stamps
+
+
+class FileWatcher(threading.Thread):
+    def __init__(self, paths, callback, debounce=0.5, poll_interval=1.0):
+        super().__init__(name='filewatch', daemon=True)
+        self.paths = [os.path.abspath(os.path.expanduser(p)) for p in paths]
+        self.callback = callback
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        if inotify_simple is not None:
+            self.run_inotify()
+        else:
+            self.run_polling()
+
+    def notify(self, changed):
+        try:
+            self.callback(sorted(changed))
+        except Exception:
+            pass    # the callback is responsible for reporting its own errors
+
+    def watch_dirs(self):
+        # watch the directory of each file too, editors often save by rename
+        dirs = {}
+        for path in self.paths:
+            if os.path.isdir(path):
+                dirs[path] = None
+            else:
+                dirs.setdefault(os.path.dirname(path), set()).add(os.path.basename(path))
+        return dirs
+
+    def run_inotify(self):
+        inotify = inotify_simple.INotify()
+        mask = (inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO |
+                inotify_simple.flags.CREATE | inotify_simple.flags.DELETE |
+                inotify_simple.flags.MOVED_FROM)
+        watches = {}
+        for dirname, names in self.watch_dirs().items():
+            try:
+                watches[inotify.add_watch(dirname, mask)] = (dirname, names)
+            except OSError:
+                pass
+
+        pending = set()
+        deadline = None
+        while not self.stop_event.is_set():
+            timeout = self.poll_interval if deadline is None \
+                else max(0.0, deadline - time.time())
+            for event in inotify.read(timeout=int(timeout * 1000)):
+                dirname, names = watches.get(event.wd, (None, None))
+                if dirname is None or (names is not None and event.name not in names):
+                    continue
+                pending.add(os.path.join(dirname, event.name))
+                deadline = time.time() + self.debounce
+
+            if deadline is not None and time.time() >= deadline:
+                changed, pending, deadline = pending, set(), None
+                self.notify(changed)
+        inotify.close()
+
+    def run_polling(self):
+        stamps = {p: snapshot(p) for p in self.paths}
+        pending = set()
+        deadline = None
+        while not self.stop_event.wait(self.poll_interval if deadline is None else 0.1):
+            for path in self.paths:
+                current = snapshot(path)
+                if current != stamps[path]:
+                    changed = set(current) ^ set(stamps[path])
+                    changed |= {p for p in current if current[p] != stamps[path].get(p)}
+                    stamps[path] = current
+                    pending |= changed
+                    deadline = time.time() + self.debounce
+
+            if deadline is not None and time.time() >= deadline:
+                changed, pending, deadline = pending, set(), None
+                self.notify(changed)
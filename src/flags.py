@@ -0,0 +1,286 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# Typed store for rule flags. Values are parsed once when set and kept both
+# as a number (when numeric) and in their text form, so flag checks and
+# incr/decr don't re-parse strings. The value as set is kept too, as the
+# equals/contains checks compare it like the plain dict of old did. Optional
+# write-behind persistence to SQLite, configured in app.ini:
+#
+#   [flags]
+#   persist = yes
+#   database = ~/.selmate/flags.db
+#   namespace = default     ; processes sharing a namespace share their flags
+#   flush_interval = 1      ; seconds between writes to the database
+#   journal_mode = WAL      ; DELETE for databases on network file systems
+#
+
+import os
+import json
+import atexit
+import sqlite3
+import functools
+import threading
+
+import settings
+from utils import to_value
+from clock import SystemClock
+
+FlagsSection = 'flags'
+TombstoneSeconds = 3600     # deletes are kept this long for other processes to see
+
+
+def to_number(src):
+    if isinstance(src, (int, float)):
+        return src
+    return parse_number(src)
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_number(src):
+    return to_value(src)
+
+
+def decode(stored):
+    # values are stored as JSON, to keep numbers numbers
+    try:
+        return json.loads(stored)
+    except (TypeError, ValueError):
+        return stored
+
+
+class Flag(object):
+    __slots__ = ('value', 'text', 'number', 'expires')
+
+    def __init__(self, value, expires=None):
+        self.value = value
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            self.number = value
+            self.text = str(value)
+        else:
+            self.text = str(value)
+            try:
+                self.number = to_number(self.text)
+            except ValueError:
+                self.number = None
+        self.expires = expires
+
+
+class FlagStore(object):
+    def __init__(self, path=None, namespace=None, persist=None, flush_interval=None, clock=None):
+        cfg = settings.Config
+        self.clock = clock or SystemClock
+        if persist is None:
+            persist = cfg.getboolean(FlagsSection, 'persist', fallback=False)
+        self.persist = persist
+        self.path = os.path.expanduser(path or cfg.get(
+            FlagsSection, 'database', fallback=f'{settings.ResourceDir}/flags.db'))
+        self.namespace = namespace or cfg.get(FlagsSection, 'namespace', fallback='default')
+        self.flush_interval = flush_interval if flush_interval is not None \
+            else cfg.getfloat(FlagsSection, 'flush_interval', fallback=1)
+        self.writer = f'{os.getpid()}-{id(self)}'
+        self.flags = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.synced = 0         # highest version seen in the database
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        if self.persist:
+            self.db = self.connect()
+            self.load()
+            self.thread = threading.Thread(target=self.write_behind, name='flag-store', daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    # dict style access, as rule_flags used to be a plain dict of strings
+
+    def __getitem__(self, name):
+        flag = self.lookup(name)
+        if flag is None:
+            raise KeyError(name)
+        return flag.value
+
+    def __setitem__(self, name, value):
+        self.set(name, value)
+
+    def __contains__(self, name):
+        return self.lookup(name) is not None
+
+    def __len__(self):
+        return len(self.snapshot())
+
+    def get(self, name, default=None):
+        # the value as set, a number set from a rule file stays a number
+        flag = self.lookup(name)
+        return default if flag is None else flag.value
+
+    def keys(self):
+        return self.snapshot().keys()
+
+    def items(self):
+        return self.snapshot().items()
+
+    def lookup(self, name):
+        flag = self.flags.get(name)
+        if flag is not None and flag.expires is not None and flag.expires <= self.clock.time():
+            with self.lock:
+                if self.flags.get(name) is flag:
+                    del self.flags[name]
+                    self.dirty.add(name)
+            return None
+        return flag
+
+    def text(self, name):
+        flag = self.lookup(name)
+        return '' if flag is None else flag.text
+
+    def number(self, name):
+        flag = self.lookup(name)
+        if flag is None:
+            return 0
+        if flag.number is None:
+            raise ValueError(f"could not convert flag '{name}' to number: '{flag.text}'")
+        return flag.number
+
+    def set(self, name, value, ttl=None):
+        expires = self.clock.time() + float(ttl) if ttl else None
+        with self.lock:
+            self.flags[name] = Flag(value, expires)
+            self.dirty.add(name)
+
+    def incr(self, name, delta, ttl=None):
+        flag = self.lookup(name)
+        if flag is None:
+            raise KeyError(name)
+        if flag.number is None:
+            raise ValueError(f"could not convert flag '{name}' to number: '{flag.text}'")
+        if ttl is None and flag.expires is not None:
+            ttl = flag.expires - self.clock.time()
+        self.set(name, str(flag.number + to_number(delta)), ttl)
+
+    def decr(self, name, delta, ttl=None):
+        self.incr(name, -to_number(delta), ttl)
+
+    def clear(self):
+        with self.lock:
+            self.dirty.update(self.flags)
+            self.flags = {}
+
+    def snapshot(self, expiry=False):
+        # {name: text}, or {name: (value, expires)} to restore() later
+        now = self.clock.time()
+        with self.lock:
+            return {name: (flag.value, flag.expires) if expiry else flag.text
+                    for name, flag in self.flags.items()
+                    if flag.expires is None or flag.expires > now}
+
+    def restore(self, snapshot):
+        now = self.clock.time()
+        with self.lock:
+            self.dirty.update(self.flags)
+            self.flags = {name: Flag(value, expires)
+                          for name, (value, expires) in snapshot.items()
+                          if expires is None or expires > now}
+            self.dirty.update(self.flags)
+
+    # persistence
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        mode = settings.Config.get(FlagsSection, 'journal_mode', fallback='WAL')
+        db.execute(f'PRAGMA journal_mode={mode}')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS flags ('
+                   'namespace TEXT, name TEXT, value TEXT, expires REAL, '
+                   'updated REAL, writer TEXT, version INTEGER DEFAULT 0, '
+                   'PRIMARY KEY (namespace, name))')
+        if 'version' not in [row[1] for row in db.execute('PRAGMA table_info(flags)')]:
+            db.execute('ALTER TABLE flags ADD COLUMN version INTEGER DEFAULT 0')
+        # one version per flush, counted up and never reused, so a reader
+        # can't miss a write that commits after its last look
+        db.execute('CREATE TABLE IF NOT EXISTS flag_versions '
+                   '(namespace TEXT PRIMARY KEY, version INTEGER)')
+        db.commit()
+        return db
+
+    def load(self):
+        # the version first, rows written meanwhile are read again on the next sync
+        row = self.db.execute('SELECT version FROM flag_versions WHERE namespace = ?',
+                              (self.namespace,)).fetchone()
+        self.synced = row[0] if row else 0
+        rows = self.db.execute('SELECT name, value, expires FROM flags '
+                               'WHERE namespace = ? AND value IS NOT NULL',
+                               (self.namespace,)).fetchall()
+        now = self.clock.time()
+        with self.lock:
+            for name, value, expires in rows:
+                if expires is None or expires > now:
+                    self.flags[name] = Flag(decode(value), expires)
+
+    def flush(self):
+        if not self.persist:
+            return
+
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            changes = [(name, self.flags.get(name)) for name in dirty]
+
+        now = self.clock.time()
+        with self.db_lock, self.db:
+            if changes:
+                version = self.next_version()
+            for name, flag in changes:
+                # a NULL value marks the delete, so other processes see it too
+                value = None if flag is None else json.dumps(flag.value)
+                expires = None if flag is None else flag.expires
+                self.db.execute('INSERT OR REPLACE INTO flags '
+                                '(namespace, name, value, expires, updated, writer, version) '
+                                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                (self.namespace, name, value, expires, now, self.writer, version))
+            self.sync()
+            self.db.execute('DELETE FROM flags WHERE value IS NULL AND updated < ?',
+                            (now - TombstoneSeconds,))
+
+    def next_version(self):
+        self.db.execute('INSERT OR IGNORE INTO flag_versions VALUES (?, 0)', (self.namespace,))
+        self.db.execute('UPDATE flag_versions SET version = version + 1 WHERE namespace = ?',
+                        (self.namespace,))
+        return self.db.execute('SELECT version FROM flag_versions WHERE namespace = ?',
+                               (self.namespace,)).fetchone()[0]
+
+    def sync(self):
+        # pick up flags written by other processes sharing the namespace
+        rows = self.db.execute('SELECT name, value, expires, version FROM flags '
+                               'WHERE namespace = ? AND version > ? AND writer != ?',
+                               (self.namespace, self.synced, self.writer)).fetchall()
+        self.synced = max([self.synced] + [row[3] for row in rows])
+        with self.lock:
+            for name, value, expires, _ in rows:
+                if name in self.dirty:
+                    continue
+                if value is None:
+                    self.flags.pop(name, None)
+                else:
+                    self.flags[name] = Flag(decode(value), expires)
+
+    def write_behind(self):
+        while not self.stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error:
+                pass    # try again on the next round
+
+    def close(self):
+        if not self.persist or self.stop_event.is_set():
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.flush()
+        self.db.close()
@@ -0,0 +1,107 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# Browser launch profiles, read from the browser config section in app.ini:
+#
+#   [chrome1]
+#   headless = yes
+#   block_images = yes
+#   block_css = yes
+#   block_fonts = yes
+#   blocked_urls = *doubleclick.net*, *google-analytics.com*
+#   disable_extensions = yes
+#   disable_gpu = yes
+#   page_load_strategy = eager      ; normal, eager or none
+#
+
+import re
+import settings
+
+CssPatterns = ['*.css', '*.css?*']
+FontPatterns = ['*.woff', '*.woff?*', '*.woff2', '*.woff2?*', '*.ttf', '*.ttf?*',
+                '*.otf', '*.otf?*', '*.eot', '*.eot?*']
+PageLoadStrategies = ('normal', 'eager', 'none')
+
+
+def browser_config():
+    # the browser config section in use
+    return settings.Config.get('web', 'browser', fallback='chrome').lower()
+
+
+def getboolean(browser_config, key):
+    return settings.Config.getboolean(browser_config, key, fallback=False)
+
+
+def chromium_arguments(browser_config):
+    args = []
+    if getboolean(browser_config, 'headless'):
+        args.append('--headless')
+    if getboolean(browser_config, 'disable_gpu'):
+        args.append('--disable-gpu')
+    if getboolean(browser_config, 'disable_extensions'):
+        args.append('--disable-extensions')
+    if getboolean(browser_config, 'block_images'):
+        args.append('--blink-settings=imagesEnabled=false')
+    return args
+
+
+def blocked_urls(browser_config):
+    spec = settings.Config.get(browser_config, 'blocked_urls', fallback='')
+    urls = [u for u in re.split(r'[,\s]+', spec) if u]
+    if getboolean(browser_config, 'block_css'):
+        urls += CssPatterns
+    if getboolean(browser_config, 'block_fonts'):
+        urls += FontPatterns
+    return urls
+
+
+def page_load_strategy(browser_config):
+    strategy = settings.Config.get(browser_config, 'page_load_strategy', fallback='').lower()
+    if strategy and strategy not in PageLoadStrategies:
+        raise Exception(f"ERROR: unknown page_load_strategy '{strategy}' in [{browser_config}]")
+    return strategy
+
+
+def apply_chromium_options(options, browser_config):
+    for arg in chromium_arguments(browser_config):
+        options.add_argument(arg)
+
+    capabilities = options.to_capabilities()
+    strategy = page_load_strategy(browser_config)
+    if strategy:
+        capabilities['pageLoadStrategy'] = strategy
+    return capabilities
+
+
+def apply_firefox_options(options, browser_config):
+    options.headless = getboolean(browser_config, 'headless')
+    if getboolean(browser_config, 'block_images'):
+        options.set_preference('permissions.default.image', 2)
+    if getboolean(browser_config, 'block_css'):
+        options.set_preference('permissions.default.stylesheet', 2)
+    if getboolean(browser_config, 'block_fonts'):
+        options.set_preference('gfx.downloadable_fonts.enabled', False)
+    if getboolean(browser_config, 'disable_gpu'):
+        options.set_preference('layers.acceleration.disabled', True)
+
+    capabilities = options.to_capabilities()
+    strategy = page_load_strategy(browser_config)
+    if strategy:
+        capabilities['pageLoadStrategy'] = strategy
+    return capabilities
+
+
+def apply_url_blocking(driver, browser_config):
+    # only Chromium based drivers understand CDP commands. The blocking holds
+    # for the current tab, on the DevTools connection it was sent over
+    urls = blocked_urls(browser_config)
+    browser = settings.Config.get(browser_config, 'browser', fallback='chrome').lower()
+    if not urls or browser == 'firefox' or not hasattr(driver, 'execute_cdp_cmd'):
+        return
+    driver.execute_cdp_cmd('Network.enable', {})
+    driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': urls})
@@ -0,0 +1,169 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# Browser memory governor. Samples the JS heap (CDP Performance.getMetrics)
+# and the RSS of the browser processes (needs 'pip install psutil') in the
+# background, and asks MyWeb to recycle the tab or the whole session once a
+# limit is reached. Configured in app.ini:
+#
+#   [memory]
+#   enable = yes
+#   interval = 60           ; seconds between samples
+#   heap_mb = 1024          ; JS heap limit, 0 = no limit
+#   rss_mb = 3072           ; browser RSS limit, 0 = no limit
+#   max_session_hours = 0   ; recycle sessions after this long, 0 = never
+#   recycle = tab           ; tab or session
+#   log_every = 10          ; log the trend every this many samples
+#
+
+import time
+import threading
+from collections import deque
+
+import cdp
+import settings
+
+MemorySection = 'memory'
+MB = 1024 * 1024
+
+
+def enabled():
+    return settings.Config.getboolean(MemorySection, 'enable', fallback=False)
+
+
+def process_rss(pid):
+    # RSS of the process and all its children (browser, renderers, GPU...)
+    try:
+        import psutil
+    except ImportError:
+        return None
+    try:
+        proc = psutil.Process(pid)
+        procs = [proc] + proc.children(recursive=True)
+    except psutil.Error:
+        return None
+    total = 0
+    for p in procs:
+        try:
+            total += p.memory_info().rss
+        except psutil.Error:
+            pass
+    return total
+
+
+def listening_pid(port):
+    # the local process serving a port: chromedriver, or the browser itself
+    # for a DevTools port. Its process tree holds the browser processes
+    try:
+        import psutil
+    except ImportError:
+        return None
+    try:
+        conns = psutil.net_connections(kind='tcp')
+    except (psutil.Error, OSError):
+        return None
+    for conn in conns:
+        if conn.status == psutil.CONN_LISTEN and conn.laddr and conn.laddr.port == port and conn.pid:
+            return conn.pid
+    return None
+
+
+def enable_metrics(driver):
+    # once per connection, the domain stays enabled
+    try:
+        driver.execute_cdp_cmd('Performance.enable', {})
+    except Exception:
+        pass
+
+
+def heap_size(driver):
+    try:
+        metrics = driver.execute_cdp_cmd('Performance.getMetrics', {})
+    except Exception:
+        return None
+    for metric in metrics.get('metrics', []):
+        if metric['name'] == 'JSHeapUsedSize':
+            return metric['value']
+    return None
+
+
+class MemoryGovernor(threading.Thread):
+    def __init__(self, driver_factory, browser_pid=None, log=print):
+        super().__init__(name='memory-governor', daemon=True)
+        cfg = settings.Config
+        self.interval = cfg.getfloat(MemorySection, 'interval', fallback=60)
+        self.heap_limit = cfg.getfloat(MemorySection, 'heap_mb', fallback=0) * MB
+        self.rss_limit = cfg.getfloat(MemorySection, 'rss_mb', fallback=0) * MB
+        self.max_age = cfg.getfloat(MemorySection, 'max_session_hours', fallback=0) * 3600
+        self.mode = cfg.get(MemorySection, 'recycle', fallback='tab').lower()
+        self.log_every = cfg.getint(MemorySection, 'log_every', fallback=10)
+        self.driver_factory = driver_factory
+        self.browser_pid = browser_pid
+        self.log = log
+        self.samples = deque(maxlen=1000)
+        self.started = time.time()
+        self.recycle_due = None
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        try:
+            driver = self.driver_factory()
+        except Exception as error:
+            self.log(f'Memory governor unable to attach: {error}')
+            return
+
+        count = 0
+        try:
+            enable_metrics(driver)
+            while not self.stop_event.wait(self.interval):
+                sample = (time.time(), heap_size(driver),
+                          process_rss(self.browser_pid) if self.browser_pid else None)
+                self.samples.append(sample)
+                count += 1
+                if self.log_every and count % self.log_every == 0:
+                    self.log(self.trend())
+                if self.recycle_due is None:
+                    self.recycle_due = self.check_limits(sample)
+        finally:
+            cdp.detach(driver)
+
+    def check_limits(self, sample):
+        now, heap, rss = sample
+        if self.heap_limit and heap and heap > self.heap_limit:
+            return f'JS heap {heap / MB:.0f}MB over limit'
+        if self.rss_limit and rss and rss > self.rss_limit:
+            return f'browser RSS {rss / MB:.0f}MB over limit'
+        if self.max_age and now - self.started > self.max_age:
+            return 'session age over limit'
+        return None
+
+    def latest(self):
+        if not self.samples:
+            return {}
+        now, heap, rss = self.samples[-1]
+        return {'time': now, 'heap_mb': heap and heap / MB, 'rss_mb': rss and rss / MB}
+
+    def growth(self, index):
+        # MB per hour over the samples we have
+        points = [(s[0], s[index]) for s in self.samples if s[index] is not None]
+        if len(points) < 2 or points[-1][0] == points[0][0]:
+            return 0.0
+        (t0, v0), (t1, v1) = points[0], points[-1]
+        return (v1 - v0) / MB / ((t1 - t0) / 3600)
+
+    def trend(self):
+        latest = self.latest()
+        parts = []
+        if latest.get('heap_mb') is not None:
+            parts.append(f"heap {latest['heap_mb']:.0f}MB ({self.growth(1):+.1f}MB/h)")
+        if latest.get('rss_mb') is not None:
+            parts.append(f"rss {latest['rss_mb']:.0f}MB ({self.growth(2):+.1f}MB/h)")
+        return 'Browser memory: ' + (', '.join(parts) if parts else 'no metrics available')
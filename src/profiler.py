@@ -0,0 +1,142 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# Sampling profiler for the rule engine thread. It can be switched on and
+# off while running, from the system log context menu or with
+#
+#   kill -USR1 <pid>
+#
+# It only starts while the engine thread is alive, and stops sampling when
+# the thread exits. Samples are written on stop as collapsed stacks, one
+# "frame;frame;... count" line per stack, under ~/.selmate/profiles/. Each
+# stack starts with the rule and action that were running, and the files can
+# be fed straight to flamegraph.pl or speedscope. Configured in app.ini:
+#
+#   [profiler]
+#   interval_ms = 10        ; time between samples
+#   max_seconds = 300       ; stop by itself after this long, 0 = never
+#
+
+import os
+import sys
+import time
+import signal
+import threading
+from collections import Counter
+from datetime import datetime
+
+import settings
+
+ProfilerSection = 'profiler'
+ProfileDir = f'{settings.ResourceDir}/profiles'
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class Profiler(threading.Thread):
+    def __init__(self, thread_id, tag=None, name='engine'):
+        super().__init__(name='profiler', daemon=True)
+        cfg = settings.Config
+        self.interval = cfg.getfloat(ProfilerSection, 'interval_ms', fallback=10) / 1000
+        self.max_seconds = cfg.getfloat(ProfilerSection, 'max_seconds', fallback=300)
+        self.thread_id = thread_id
+        self.tag = tag
+        self.profile_name = name
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = None
+        self.stop_event = threading.Event()
+
+    def run(self):
+        self.started = time.time()
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:       # the thread is gone
+                break
+            self.sample(frame)
+            if self.max_seconds and time.time() - self.started > self.max_seconds:
+                break
+
+    def sample(self, frame):
+        stack = []
+        while frame is not None:
+            stack.append(frame_name(frame))
+            frame = frame.f_back
+        stack.reverse()
+
+        if self.tag:
+            rule, action = self.tag()
+            stack[:0] = [f'rule: {rule or "-"}', f'action: {action or "-"}']
+        self.stacks[';'.join(s.replace(';', ',') for s in stack)] += 1
+        self.samples += 1
+
+    def stop(self):
+        self.stop_event.set()
+        if self.is_alive():
+            self.join()
+        return self.write()
+
+    def write(self):
+        folder = os.path.expanduser(ProfileDir)
+        os.makedirs(folder, exist_ok=True)
+        tm = datetime.fromtimestamp(self.started or time.time()).strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(folder, f'{self.profile_name}-{os.getpid()}-{tm}.folded')
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        return path
+
+
+class ProfilerSwitch(object):
+    # on/off switch shared by the GUI menu and the signal handler
+    def __init__(self, thread_id, tag=None, name='engine', log=print):
+        self.thread_id = thread_id
+        self.tag = tag
+        self.name = name
+        self.log = log
+        self.profiler = None
+        self.lock = threading.RLock()     # the signal handler may cut in
+
+    def is_running(self):
+        return self.profiler is not None and self.profiler.is_alive()
+
+    def start(self):
+        with self.lock:
+            if self.profiler is not None:
+                return
+            thread_id = self.thread_id() if callable(self.thread_id) else self.thread_id
+            if thread_id is None or thread_id not in sys._current_frames():
+                self.log('Profiler: engine thread is not running')
+                return
+            self.profiler = Profiler(thread_id, self.tag, self.name)
+            self.profiler.start()
+            self.log(f'Profiler started, sampling every {self.profiler.interval * 1000:.0f}ms')
+
+    def stop(self):
+        with self.lock:
+            if self.profiler is None:
+                return None
+            profiler, self.profiler = self.profiler, None
+        path = profiler.stop()
+        self.log(f'Profiler stopped, {profiler.samples} samples written to {path}')
+        return path
+
+    def toggle(self):
+        # a profiler that stopped by itself on max_seconds is written out here too
+        if self.profiler is not None:
+            self.stop()
+        else:
+            self.start()
+
+    def install_signal(self):
+        # SIGUSR1 toggles the profiler, not available on Windows
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.toggle())
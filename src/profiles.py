@@ -0,0 +1,197 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# Browser profile templates. Instead of sharing one user_data_dir, each
+# session gets its own clone of a pre-warmed "golden" profile. Files are
+# reflinked (copy-on-write, on btrfs, XFS, APFS...) where the filesystem
+# supports it and copied otherwise, leaving out caches and lock files.
+# Clones are removed when their session quits, and leftovers from crashed
+# processes are collected on the next clone. In the browser config section:
+#
+#   [chrome1]
+#   profile_template = ~/.config/selmate-golden
+#   profile_clones = ~/.selmate/profiles-clones     ; where the clones go
+#
+
+import os
+import errno
+import atexit
+import shutil
+import socket
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import settings
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None    # Windows: plain copies
+
+FICLONE = 0x40049409     # linux/fs.h
+CloneMarker = '.selmate-clone'
+CloneRoot = f'{settings.ResourceDir}/profile-clones'
+
+# regenerated by the browser, not worth copying
+SkipDirs = {'Cache', 'Code Cache', 'GPUCache', 'ShaderCache', 'GrShaderCache',
+            'DawnCache', 'CacheStorage', 'ScriptCache', 'Crashpad', 'BrowserMetrics',
+            'component_crx_cache', 'Safe Browsing', 'optimization_guide_model_store'}
+SkipFiles = {'SingletonLock', 'SingletonSocket', 'SingletonCookie', 'lockfile',
+             'RunningChromeVersion', CloneMarker}
+
+Active = set()
+ActiveLock = threading.Lock()
+
+
+def user_data_dir(browser_config):
+    # a fresh clone when a template is configured, otherwise the fixed directory
+    cfg = settings.Config
+    template = cfg.get(browser_config, 'profile_template', fallback='')
+    if not template:
+        return cfg.get(browser_config, 'user_data_dir', fallback='')
+
+    root = os.path.expanduser(cfg.get(browser_config, 'profile_clones', fallback=CloneRoot))
+    collect(root)
+    return clone(os.path.expanduser(template), root)
+
+
+def reflink(src, dst):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+class Cloner(object):
+    def __init__(self, workers=8):
+        self.use_reflink = fcntl is not None
+        self.workers = workers
+
+    def copy_file(self, src, dst):
+        if self.use_reflink:
+            try:
+                reflink(src, dst)
+                shutil.copystat(src, dst)
+                return
+            except OSError as error:
+                if error.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+                                       errno.EINVAL, errno.ENOSYS, errno.EBADF):
+                    raise
+                self.use_reflink = False    # not on this filesystem, stop trying
+        shutil.copy2(src, dst)
+
+    def copy_tree(self, src, dst):
+        files = []
+        for dirpath, dirnames, filenames in os.walk(src):
+            dirnames[:] = [d for d in dirnames if d not in SkipDirs]
+            target = os.path.join(dst, os.path.relpath(dirpath, src))
+            os.makedirs(target, exist_ok=True)
+            for name in filenames:
+                if name in SkipFiles:
+                    continue
+                path = os.path.join(dirpath, name)
+                if os.path.islink(path):
+                    os.symlink(os.readlink(path), os.path.join(target, name))
+                else:
+                    files.append((path, os.path.join(target, name)))
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            for future in [executor.submit(self.copy_file, s, d) for s, d in files]:
+                future.result()
+
+
+def clone(template, root):
+    if not os.path.isdir(template):
+        raise Exception(f"ERROR: profile template '{template}' not found")
+
+    os.makedirs(root, exist_ok=True)
+    path = tempfile.mkdtemp(prefix='clone-', dir=root)
+    with ActiveLock:
+        Active.add(path)
+    try:
+        with open(os.path.join(path, CloneMarker), 'w') as f:
+            f.write(f'{os.getpid()}\n')
+        Cloner().copy_tree(template, path)
+    except BaseException:
+        release(path)
+        raise
+    return path
+
+
+def release(path):
+    with ActiveLock:
+        Active.discard(path)
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def track(driver, path):
+    # clones go away with the driver's quit, see release_driver()
+    with ActiveLock:
+        if path in Active:
+            driver.profile_clone = path
+    return driver
+
+
+def release_driver(driver):
+    path = getattr(driver, 'profile_clone', None)
+    if path:
+        release(path)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+
+def browser_running(path):
+    # Chrome's SingletonLock is a symlink to '<hostname>-<pid>'
+    try:
+        host, _, pid = os.readlink(os.path.join(path, 'SingletonLock')).rpartition('-')
+        pid = int(pid)
+    except OSError:
+        return os.path.exists(os.path.join(path, 'lockfile'))
+    except ValueError:
+        return True
+    return host != socket.gethostname() or pid_alive(pid)
+
+
+def collect(root):
+    # remove clones nobody uses any more: the owner is gone (or it's us and we
+    # dropped it) and no browser holds the profile lock
+    try:
+        entries = os.listdir(root)
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        path = os.path.join(root, entry)
+        try:
+            with open(os.path.join(path, CloneMarker)) as f:
+                owner = int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+        with ActiveLock:
+            in_use = path in Active
+        if in_use or (owner != os.getpid() and pid_alive(owner)):
+            continue
+        if not browser_running(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def release_all():
+    with ActiveLock:
+        paths = list(Active)
+    for path in paths:
+        if not browser_running(path):
+            release(path)
+
+
+atexit.register(release_all)
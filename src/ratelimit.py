@@ -0,0 +1,121 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# Per-site rate governor for actions that change the page (click, send_keys)
+# or reach the outside world (notify). Each site, and optionally each rule,
+# gets a token bucket. When it runs dry the rest of the rule is deferred and
+# picked up again on a later pass, the engine thread never sleeps on it.
+# Configured in app.ini:
+#
+#   [ratelimit]
+#   enable = yes
+#   rate = 1            ; actions per second, refilled continuously
+#   burst = 5           ; actions allowed back to back
+#   per_rule = no       ; separate buckets for each rule on the site
+#
+#   [ratelimit.www.example.com]
+#   rate = 0.2          ; per site overrides
+#   burst = 2
+#
+
+import threading
+
+import settings
+from clock import SystemClock
+
+RateSection = 'ratelimit'
+
+
+class RateLimited(Exception):
+    # raised by RateGovernor.acquire(), retry_at is when a token is available
+    def __init__(self, key, retry_at):
+        super().__init__(f'Rate limited: {key}')
+        self.key = key
+        self.retry_at = retry_at
+
+
+def enabled():
+    return settings.Config.getboolean(RateSection, 'enable', fallback=False)
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def next_token(self, now):
+        # seconds until the next token, forever if the bucket never refills
+        if self.tokens >= 1:
+            return 0.0
+        if self.rate <= 0:
+            return float('inf')
+        return (1 - self.tokens) / self.rate
+
+
+class RateGovernor(object):
+    def __init__(self, clock=None):
+        cfg = settings.Config
+        self.clock = clock or SystemClock
+        self.rate = cfg.getfloat(RateSection, 'rate', fallback=1)
+        self.burst = cfg.getfloat(RateSection, 'burst', fallback=5)
+        self.per_rule = cfg.getboolean(RateSection, 'per_rule', fallback=False)
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.allowed = {}
+        self.deferred = {}
+
+    def key(self, site, rule=None):
+        return (site, rule) if self.per_rule else (site, None)
+
+    def bucket(self, key, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            section = f'{RateSection}.{key[0]}'
+            cfg = settings.Config
+            bucket = TokenBucket(cfg.getfloat(section, 'rate', fallback=self.rate),
+                                 cfg.getfloat(section, 'burst', fallback=self.burst), now)
+            self.buckets[key] = bucket
+        return bucket
+
+    def acquire(self, site, rule=None):
+        key = self.key(site, rule)
+        with self.lock:
+            now = self.clock.monotonic()
+            bucket = self.bucket(key, now)
+            if bucket.take(now):
+                self.allowed[key] = self.allowed.get(key, 0) + 1
+                return
+            self.deferred[key] = self.deferred.get(key, 0) + 1
+            retry_at = self.clock.time() + bucket.next_token(now)
+        raise RateLimited(key, retry_at)
+
+    def counters(self):
+        with self.lock:
+            keys = set(self.allowed) | set(self.deferred)
+            return {key: {'allowed': self.allowed.get(key, 0),
+                          'deferred': self.deferred.get(key, 0)}
+                    for key in keys}
+
+    def reset(self):
+        with self.lock:
+            self.buckets = {}
+            self.allowed = {}
+            self.deferred = {}
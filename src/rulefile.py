@@ -0,0 +1,70 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# Reading rule files. 'rulefile' in app.ini may name a single JSON file or a
+# directory of them (e.g. one file per site), which are loaded in name order.
+#
+
+import os
+import json
+
+
+def rule_files(path):
+    if os.path.isdir(path):
+        return [os.path.join(path, name) for name in sorted(os.listdir(path))
+                if name.endswith('.json')]
+    return [path]
+
+
+def load(path):
+    rules = []
+    for file in rule_files(path):
+        with open(file) as f:
+            data = json.load(f)
+        if not isinstance(data, list):
+            raise json.decoder.JSONDecodeError('expected a list of rules', file, 0)
+        rules += data
+    return rules
+
+
+def mtime(path):
+    stamps = [os.path.getmtime(path)]
+    stamps += [os.path.getmtime(file) for file in rule_files(path) if file != path]
+    return max(stamps)
+
+
+def rule_keys(rules):
+    # rules are matched by name; repeated names are told apart by occurrence
+    seen = {}
+    keys = []
+    for rule in rules:
+        name = rule.get('name', '(unknown)')
+        seen[name] = seen.get(name, 0) + 1
+        keys.append((name, seen[name]))
+    return keys
+
+
+def diff(old_rules, new_rules):
+    old = dict(zip(rule_keys(old_rules), old_rules))
+    new = dict(zip(rule_keys(new_rules), new_rules))
+    added = [key[0] for key in new if key not in old]
+    removed = [key[0] for key in old if key not in new]
+    changed = [key[0] for key in new if key in old and new[key] != old[key]]
+    return added, changed, removed
+
+
+def merge(old_rules, new_rules):
+    # keep the existing rule objects for rules that haven't changed
+    old = dict(zip(rule_keys(old_rules), old_rules))
+    merged = []
+    for key, rule in zip(rule_keys(new_rules), new_rules):
+        if key in old and old[key] == rule:
+            merged.append(old[key])
+        else:
+            merged.append(rule)
+    return merged
@@ -5,36 +5,39 @@
 # GNU General Public License version 2, incorporated herein by reference.
 #
 
-import time
 import utils
-from utils import WaitValue
+from utils import WaitValue, Cancelled
+from actiongraph import ActionGraph
 from PyQt5.QtCore import QObject, pyqtSignal
 
 
 class Rule(QObject):
     info = pyqtSignal(str, str)
 
-    def __init__(self, identify, name='unknown', actions=None, initwait=None):
+    def __init__(self, identify, name='unknown', actions=None, initwait=None, stop_event=None,
+                 clock=None):
         super().__init__()
         self.actions = actions
         self.name = name
         self.identify = identify
         self.initwait = initwait
+        self.stop_event = stop_event
+        self.clock = clock
 
     def run(self):
         self.show_status()
 
-        if not self.id():
+        if not self.identify():
             return
 
         wait_time = self.getinitval()
         self.info.emit('initwait', str(wait_time))
-        time.sleep(wait_time)
+        utils.sleep(wait_time, self.stop_event, self.clock)
         self.actions.run()
 
     def getinitval(self):
         if isinstance(self.initwait, WaitValue):
-            return self.initwait.value()
+            return self.initwait.value(self.clock)
         elif self.initwait:
             return self.initwait
         else:
@@ -50,11 +53,19 @@ class Rule(QObject):
 
 
 class Rules:
-    def __init__(self):
+    def __init__(self, stop_event=None, clock=None):
         self.rules = []
+        self.stop_event = stop_event
+        self.clock = clock
 
     def add(self, identify, name='unknown', actions=None, initwait=None):
-        rule = Rule(identify, name, actions, initwait)
+        if isinstance(actions, ActionGraph):
+            # a graph reads these when it runs, an ActionList has them from its own add()
+            if actions.stop_event is None:
+                actions.stop_event = self.stop_event
+            if actions.clock is None:
+                actions.clock = self.clock
+        rule = Rule(identify, name, actions, initwait, self.stop_event, self.clock)
         self.rules.append(rule)
 
     def connect(self, handler):
@@ -64,5 +75,10 @@ class Rules:
                 rule.actions.connect(handler)
 
     def run(self):
-        for rule in self.rules:
-            rule.run()
+        try:
+            for rule in self.rules:
+                utils.check_cancel(self.stop_event)
+                rule.run()
+        except Cancelled:
+            return False
+        return True
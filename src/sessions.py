@@ -0,0 +1,211 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# Pool of pre-launched browser sessions. Configured in app.ini:
+#
+#   [pool]
+#   size = 2                ; number of warm sessions to keep ready
+#   max_age = 21600         ; recycle sessions older than this (seconds, 0 = never)
+#   max_commands = 0        ; recycle sessions after this many WebDriver commands,
+#                           ; as counted by the workers and windows that used them
+#   health_interval = 15    ; seconds between health checks of idle sessions
+#
+# Live sessions are recorded in the [pool] section of cookies.ini.
+#
+
+import time
+import threading
+import traceback
+
+import settings
+import cookies
+import profiles
+from web import start_browser
+
+PoolSection = 'pool'
+
+
+class PooledSession(object):
+    def __init__(self, driver):
+        self.driver = driver
+        self.executor_url = driver.command_executor._url
+        self.session_id = driver.session_id
+        self.created = time.time()
+        self.commands = 0       # reported back on release, users attach their own drivers
+        self.in_use = False
+
+    def connection(self):
+        return f'{self.executor_url} {self.session_id}'
+
+    def age(self):
+        return time.time() - self.created
+
+    def is_healthy(self):
+        try:
+            self.driver.current_window_handle
+        except Exception:
+            return False
+        return True
+
+    def quit(self):
+        try:
+            self.driver.quit()
+        except Exception:
+            pass
+        profiles.release_driver(self.driver)
+
+
+class SessionPool(object):
+    def __init__(self, size=None, max_age=None, max_commands=None, health_interval=None,
+                 launcher=start_browser, log=print):
+        cfg = settings.Config
+        self.size = size if size is not None else cfg.getint(PoolSection, 'size', fallback=2)
+        self.max_age = max_age if max_age is not None \
+            else cfg.getint(PoolSection, 'max_age', fallback=6 * 3600)
+        self.max_commands = max_commands if max_commands is not None \
+            else cfg.getint(PoolSection, 'max_commands', fallback=0)
+        self.health_interval = health_interval if health_interval is not None \
+            else cfg.getint(PoolSection, 'health_interval', fallback=15)
+        self.launcher = launcher
+        self.log = log
+        self.idle = []
+        self.busy = []
+        self.lock = threading.Condition()
+        self.keep_running = False
+        self.thread = None
+
+    def start(self):
+        self.keep_running = True
+        self.thread = threading.Thread(target=self.maintain, name='session-pool', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.keep_running = False
+            self.lock.notify_all()
+        if self.thread:
+            self.thread.join()
+
+        # sessions handed out stay alive, only the spare ones are closed
+        with self.lock:
+            spares, self.idle = self.idle, []
+        for session in spares:
+            self.unregister(session)
+            session.quit()
+
+    def acquire(self, timeout=None):
+        with self.lock:
+            deadline = None if timeout is None else time.time() + timeout
+            while not self.idle:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.lock.notify_all()     # wake the maintainer to launch more
+                self.lock.wait(remaining)
+            session = self.idle.pop(0)
+            session.in_use = True
+            self.busy.append(session)
+            self.lock.notify_all()         # start a replacement right away
+            return session
+
+    def find(self, connection):
+        with self.lock:
+            for session in self.idle + self.busy:
+                if session.connection() == connection:
+                    return session
+        return None
+
+    def release(self, session, healthy=True, commands=0):
+        with self.lock:
+            if session in self.busy:
+                self.busy.remove(session)
+            session.in_use = False
+            session.commands += commands
+            if healthy and not self.is_expired(session):
+                self.idle.append(session)
+                self.lock.notify_all()
+                return
+        self.retire(session)
+
+    def is_expired(self, session):
+        if self.max_age and session.age() > self.max_age:
+            return True
+        if self.max_commands and session.commands > self.max_commands:
+            return True
+        return False
+
+    def retire(self, session):
+        with self.lock:
+            for sessions in (self.idle, self.busy):
+                if session in sessions:
+                    sessions.remove(session)
+            self.lock.notify_all()
+        self.unregister(session)
+        # quitting can be slow, don't hold up the pool for it
+        threading.Thread(target=session.quit, daemon=True).start()
+
+    def register(self, session):
+        cookies.update(PoolSection, session.session_id,
+                       f'{session.executor_url} {int(session.created)}')
+
+    def unregister(self, session):
+        cookies.remove(PoolSection, session.session_id)
+
+    def launch(self):
+        try:
+            session = PooledSession(self.launcher())
+        except Exception as error:
+            self.log(f'ERROR when starting pooled browser: {error}')
+            self.log(traceback.format_exc())
+            return None
+
+        self.register(session)
+        self.log(f'Pooled browser ready: {session.connection()}')
+        return session
+
+    def check_idle(self):
+        with self.lock:
+            sessions = list(self.idle)
+        for session in sessions:
+            if self.is_expired(session) or not session.is_healthy():
+                self.log(f'Recycling pooled browser: {session.connection()}')
+                self.retire(session)
+
+    def maintain(self):
+        last_check = 0
+        while True:
+            with self.lock:
+                if not self.keep_running:
+                    return
+                missing = self.size - len(self.idle)
+
+            if missing > 0:
+                session = self.launch()
+                if session is None:
+                    with self.lock:
+                        self.lock.wait(5)  # back off before trying again
+                    continue
+                with self.lock:
+                    if self.keep_running:
+                        self.idle.append(session)
+                        self.lock.notify_all()
+                        continue
+                self.retire(session)
+                return
+
+            if time.time() - last_check >= self.health_interval:
+                self.check_idle()
+                last_check = time.time()
+
+            with self.lock:
+                if self.keep_running and len(self.idle) >= self.size:
+                    self.lock.wait(self.health_interval)
+
+
+def pool_enabled():
+    return settings.Config.getint(PoolSection, 'size', fallback=0) > 0
@@ -7,12 +7,14 @@
 
 import os
 import configparser
+from store import IniStore
 
 AppName = "Selmate"
 ResourceDir = f'~/.{AppName.lower()}'
 Config = configparser.ConfigParser()
 Configfile = os.path.expanduser(f'{ResourceDir}/app.ini')
 ConfigfileTime = None
+Store = IniStore(Configfile, Config)
 
 ConfigChecklist = [
     # (section, option, requirement)
@@ -49,20 +51,23 @@ def verify():
 def refresh():
     global ConfigfileTime
 
-    with open(Configfile) as f:
-        Config.read_file(f)
-        verify()
-    ConfigfileTime = os.path.getmtime(Configfile)
+    ConfigfileTime = Store.read()
+    verify()
 
 
 def update(section, key, value):
-    try:
-        Config.add_section(section)
-    except configparser.DuplicateSectionError:
-        pass
-    Config.set(section, key, value)
-    with open(Configfile, 'w') as f:
-        Config.write(f)
+    Store.update(section, key, value)
+
+
+def watch(handler):
+    # reload app.ini when it changes on disk and tell handler(path) about it
+    def reloaded(path):
+        global ConfigfileTime
+        ConfigfileTime = os.path.getmtime(path)
+        handler(path)
+
+    Store.connect(reloaded)
+    Store.watch()
 
 
 def check_file_modified():
@@ -0,0 +1,173 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# Failure snapshots. When MyWeb hits a browser error, the rule thread only
+# queues what it already knows (rule, action, url, frame path, flags). A
+# background thread attaches to the session with short timeouts, fetches the
+# page source and a screenshot within a time budget, and writes a zip file to
+# a ring under ~/.selmate/snapshots/, dropping the oldest beyond the limits.
+# The browser calls run on a helper thread and the recorder stops waiting for
+# them when the budget is up, whichever backend is in use.
+# Configured in app.ini:
+#
+#   [snapshots]
+#   enable = yes
+#   budget = 5              ; seconds a capture may take, whatever it got by then is kept
+#   max_mb = 200            ; ring size limits
+#   max_count = 50
+#   min_interval = 10       ; seconds between captures, errors often come in bursts
+#   screenshot = yes
+#
+
+import os
+import glob
+import json
+import time
+import queue
+import zipfile
+import threading
+from datetime import datetime
+
+import cdp
+import settings
+
+SnapshotSection = 'snapshots'
+SnapshotDir = f'{settings.ResourceDir}/snapshots'
+MB = 1024 * 1024
+
+
+def enabled():
+    return settings.Config.getboolean(SnapshotSection, 'enable', fallback=False)
+
+
+class SnapshotRecorder(threading.Thread):
+    def __init__(self, attach, path=None, log=print):
+        super().__init__(name='snapshots', daemon=True)
+        cfg = settings.Config
+        self.attach = attach        # attach(executor_url, session_id, timeout) -> driver
+        self.path = os.path.expanduser(path or cfg.get(SnapshotSection, 'dir', fallback=SnapshotDir))
+        self.budget = cfg.getfloat(SnapshotSection, 'budget', fallback=5)
+        self.max_bytes = cfg.getfloat(SnapshotSection, 'max_mb', fallback=200) * MB
+        self.max_count = cfg.getint(SnapshotSection, 'max_count', fallback=50)
+        self.min_interval = cfg.getfloat(SnapshotSection, 'min_interval', fallback=10)
+        self.screenshot = cfg.getboolean(SnapshotSection, 'screenshot', fallback=True)
+        self.log = log
+        self.queue = queue.Queue(maxsize=4)
+        self.last_capture = 0
+        self.dropped = 0
+        self.written = 0
+
+    def capture(self, info):
+        # called on the rule thread, never blocks
+        now = time.time()
+        if now - self.last_capture < self.min_interval:
+            self.dropped += 1
+            return False
+        try:
+            self.queue.put_nowait(dict(info, time=now))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.last_capture = now
+        if not self.is_alive():
+            self.start()
+        return True
+
+    def run(self):
+        while True:
+            info = self.queue.get()
+            try:
+                path = self.write(info, self.fetch(info))
+                self.trim()
+                self.written += 1
+                self.log(f'Failure snapshot saved to {path}')
+            except Exception as error:
+                self.log(f'ERROR saving failure snapshot: {error}')
+
+    def steps(self, driver):
+        steps = [('page.html', lambda: driver.page_source.encode('utf-8'))]
+        if self.screenshot:
+            steps.append(('screenshot.png', driver.get_screenshot_as_png))
+        steps.append(('current_url.txt', lambda: driver.current_url.encode('utf-8')))
+        return steps
+
+    def fetch(self, info):
+        # whatever we can get from the browser within the budget
+        deadline = time.time() + self.budget
+        results = queue.Queue()
+        threading.Thread(target=self.fetch_steps, args=(info, deadline, results),
+                         name='snapshot-fetch', daemon=True).start()
+
+        files = {}
+        missing = []
+        pending = ['attach', 'page.html'] + ['screenshot.png'] * self.screenshot + ['current_url.txt']
+        while pending:
+            try:
+                name, data, error = results.get(timeout=max(0.0, deadline - time.time()))
+            except queue.Empty:
+                break
+            pending.remove(name)
+            if error is None:
+                if name != 'attach':
+                    files[name] = data
+            elif name == 'attach':
+                return files, [f'attach: {error}']
+            else:
+                missing.append(f'{name}: {error}')
+        missing += [f'{name}: out of time' for name in pending]
+        return files, missing
+
+    def fetch_steps(self, info, deadline, results):
+        # runs on a helper thread, left behind if the browser doesn't answer in time
+        try:
+            driver = self.attach(info['executor_url'], info['session_id'], self.budget)
+        except Exception as error:
+            results.put(('attach', None, str(error)))
+            return
+        results.put(('attach', None, None))
+        try:
+            for name, step in self.steps(driver):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                if isinstance(driver, cdp.CdpDriver):
+                    driver.set_script_timeout(remaining)
+                try:
+                    results.put((name, step(), None))
+                except Exception as error:
+                    results.put((name, None, f'{type(error).__name__}: {str(error).strip()[:200]}'))
+        finally:
+            cdp.detach(driver)
+
+    def write(self, info, fetched):
+        files, missing = fetched
+        os.makedirs(self.path, exist_ok=True)
+        tm = datetime.fromtimestamp(info['time']).strftime('%Y%m%d-%H%M%S-%f')
+        path = os.path.join(self.path, f'snapshot-{tm}.zip')
+        meta = dict(info, missing=missing)
+        tmp = path + '.tmp'
+        with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('meta.json', json.dumps(meta, indent=2, default=str))
+            for name, data in files.items():
+                # PNG is compressed already
+                compress = zipfile.ZIP_STORED if name.endswith('.png') else zipfile.ZIP_DEFLATED
+                zf.writestr(name, data, compress_type=compress)
+        os.replace(tmp, path)
+        return path
+
+    def trim(self):
+        snapshots = sorted(glob.glob(os.path.join(self.path, 'snapshot-*.zip')))
+        sizes = {p: os.path.getsize(p) for p in snapshots}
+        total = sum(sizes.values())
+        while snapshots and (len(snapshots) > self.max_count or total > self.max_bytes):
+            oldest = snapshots.pop(0)
+            total -= sizes[oldest]
+            try:
+                os.remove(oldest)
+            except OSError:
+                pass
@@ -0,0 +1,183 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# INI file store shared by settings and cookies. Updates are applied in
+# memory straight away and written out shortly after (debounced), by
+# re-reading the file under a lock file, applying our pending changes and
+# renaming a temp file over it. Several processes can then update the same
+# file without losing each other's entries or seeing half written files.
+#
+
+import os
+import atexit
+import tempfile
+import threading
+import configparser
+
+import filewatch
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None    # Windows: no cross-process lock, writes are still atomic
+
+
+def atomic_write(path, config):
+    dirname = os.path.dirname(path) or '.'
+    fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(path), dir=dirname)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            config.write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def publish(config, fresh):
+    # swap in the new contents rather than clear and refill in place, so
+    # threads reading config without the lock see the old or the new, never
+    # an empty or half loaded one
+    proxies = {name: configparser.SectionProxy(config, name) for name in fresh._proxies}
+    config._defaults = fresh._defaults
+    config._sections = fresh._sections
+    config._proxies = proxies
+
+
+class FileLock(object):
+    def __init__(self, path):
+        self.path = path + '.lock'
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, 'a')
+        if fcntl:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+class IniStore(object):
+    def __init__(self, path, config=None, write_delay=0.5):
+        self.path = path
+        self.config = config if config is not None else configparser.ConfigParser()
+        self.write_delay = write_delay
+        self.lock = threading.RLock()
+        self.pending = []
+        self.timer = None
+        self.written_mtime = None
+        self.listeners = []
+        self.watcher = None
+        atexit.register(self.flush)
+
+    def read(self):
+        with self.lock:
+            with open(self.path) as f:
+                self.config.read_file(f)
+            # changes not written out yet still win over what's on disk
+            for change in self.pending:
+                self.apply(self.config, change)
+        return os.path.getmtime(self.path)
+
+    def update(self, section, key, value):
+        with self.lock:
+            self.apply(self.config, ('set', section, key, value))
+            self.pending.append(('set', section, key, value))
+            self.schedule()
+
+    def remove(self, section, key):
+        with self.lock:
+            self.apply(self.config, ('remove', section, key, None))
+            self.pending.append(('remove', section, key, None))
+            self.schedule()
+
+    def remove_section(self, section):
+        with self.lock:
+            self.apply(self.config, ('remove_section', section, None, None))
+            self.pending.append(('remove_section', section, None, None))
+            self.schedule()
+
+    def apply(self, config, change):
+        op, section, key, value = change
+        if op == 'set':
+            if not config.has_section(section):
+                config.add_section(section)
+            config.set(section, key, value)
+        elif op == 'remove':
+            if config.has_section(section):
+                config.remove_option(section, key)
+        elif op == 'remove_section':
+            config.remove_section(section)
+
+    def schedule(self):
+        if self.write_delay <= 0:
+            self.flush()
+            return
+        if self.timer is None:
+            self.timer = threading.Timer(self.write_delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            if not self.pending:
+                return
+            pending, self.pending = self.pending, []
+
+            with FileLock(self.path):
+                # start from what's on disk, other processes may have written to it
+                ondisk = configparser.ConfigParser()
+                try:
+                    with open(self.path) as f:
+                        ondisk.read_file(f)
+                except FileNotFoundError:
+                    pass
+                for change in pending:
+                    self.apply(ondisk, change)
+                atomic_write(self.path, ondisk)
+                self.written_mtime = os.path.getmtime(self.path)
+
+    def connect(self, handler):
+        # handler(path) is called from the watcher thread after the file is reloaded
+        self.listeners.append(handler)
+
+    def watch(self):
+        if self.watcher:
+            return
+        self.watcher = filewatch.FileWatcher([self.path], self.changed)
+        self.watcher.start()
+
+    def changed(self, paths):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except FileNotFoundError:
+            return
+        if mtime == self.written_mtime:
+            return  # our own write
+
+        with self.lock:
+            fresh = configparser.ConfigParser()
+            with open(self.path) as f:
+                fresh.read_file(f)
+            for change in self.pending:
+                self.apply(fresh, change)
+            publish(self.config, fresh)
+        for handler in self.listeners:
+            handler(self.path)
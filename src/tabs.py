@@ -0,0 +1,44 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# Named tabs, so one browser can watch several pages. A rule may add
+#
+#   "tab": "orders",                            (default: "main", the first window)
+#   "tabUrl": "https://www.example.com/orders"  (page to open the tab on, default: "url")
+#
+# Each pass runs the rules tab by tab, starting with the tab already in front,
+# so the browser switches windows at most once per tab per pass.
+#
+
+MainTab = 'main'
+
+
+class Tab(object):
+    def __init__(self, name, handle):
+        self.name = name
+        self.handle = handle
+        self.page_head = None     # page state kept while another tab is in front
+        self.last_url = ''
+
+
+def rule_tab(rule):
+    return rule.get('tab') or MainTab
+
+
+def batches(rules, first=None):
+    # enabled rules grouped by tab, in file order, with the tab 'first' moved up front
+    groups = {}
+    for rule in rules:
+        if rule['enable']:
+            groups.setdefault(rule_tab(rule), []).append(rule)
+
+    order = list(groups)
+    if first in groups:
+        order.remove(first)
+        order.insert(0, first)
+    return [(name, groups[name]) for name in order]
@@ -0,0 +1,94 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# Edge triggered actions. By default an action runs whenever its conditions
+# hold ("level"). An action may instead set
+#
+#   "trigger": "rising"     run only when its conditions go from false to true
+#   "trigger": "change"     run only when the watched value changes (and conditions hold)
+#
+# Edges are tracked per rule and action name, so they stay with their action
+# when rules are reordered or reloaded. Repeated names are told apart by
+# occurrence, as for rule reloads.
+#
+# Conditions keep the last value read for their xpath on the current page,
+# and are only evaluated again when it changes. The element is still read on
+# every pass, an earlier action may have changed it.
+#
+
+import rulefile
+
+Triggers = ('level', 'rising', 'change')
+Missing = object()
+
+
+def check(rules):
+    # a typo in a trigger shows up when the rules are loaded, not when the action first passes
+    for rule in rules:
+        for idx, action in enumerate(rule.get('actions', [])):
+            trigger = action.get('trigger', 'level')
+            if trigger not in Triggers:
+                raise SyntaxError(f"Unknown action trigger '{trigger}' in rule "
+                                  f"'{rule.get('name', '(unknown)')}', action #{idx}")
+
+
+def edge_keys(rules):
+    # edge state key of each action, by id
+    keys = {}
+    for rule, rule_key in zip(rules, rulefile.rule_keys(rules)):
+        actions = rule.get('actions', [])
+        for action, action_key in zip(actions, rulefile.rule_keys(actions)):
+            keys[id(action)] = rule_key + action_key
+    return keys
+
+
+class ValueCache(object):
+    # last value and result per condition, for one page generation
+    def __init__(self):
+        self.generation = None
+        self.entries = {}
+
+    def lookup(self, generation, key, value):
+        if generation != self.generation:
+            self.generation = generation
+            self.entries = {}
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == value:
+            return entry[1]
+        return Missing
+
+    def store(self, generation, key, value, result):
+        if generation == self.generation:
+            self.entries[key] = (value, result)
+
+    def clear(self):
+        self.generation = None
+        self.entries = {}
+
+
+class EdgeTracker(object):
+    def __init__(self):
+        self.last = {}
+
+    def fire(self, key, trigger, passed, value):
+        previous = self.last.get(key)
+        self.last[key] = (passed, value)
+        if not passed:
+            return False
+
+        if trigger == 'level':
+            return True
+        elif trigger == 'rising':
+            return previous is None or not previous[0]
+        elif trigger == 'change':
+            return previous is None or previous[1] != value
+        else:
+            raise SyntaxError(f"Unknown action trigger: '{trigger}'")
+
+    def clear(self):
+        self.last = {}
@@ -6,9 +6,24 @@
 #
 
 import types
-import random
 import re
-import time
+
+from clock import SystemClock
+
+
+class Cancelled(Exception):
+    # raised out of a wait when a stop has been requested
+    pass
+
+
+def sleep(seconds, stop_event=None, clock=None):
+    if (clock or SystemClock).wait(seconds, stop_event):
+        raise Cancelled
+
+
+def check_cancel(stop_event):
+    if stop_event is not None and stop_event.is_set():
+        raise Cancelled
 
 
 class WaitValue:
@@ -16,9 +31,9 @@ class WaitValue:
         self.start = int(a)
         self.stop = int(b)
 
-    def value(self):
+    def value(self, clock=None):
         if self.stop:
-            return random.randint(self.start, self.stop)
+            return (clock or SystemClock).randint(self.start, self.stop)
         else:
             return self.start
 
@@ -26,7 +41,7 @@ class WaitValue:
         return self.start, self.stop
 
 
-def wait(spec, counter=None):
+def wait(spec, counter=None, stop_event=None, clock=None):
     if spec == "":
         return
 
@@ -39,13 +54,13 @@ def wait(spec, counter=None):
     else:
         return
 
-    wait_time = WaitValue(start, stop).value()
+    wait_time = WaitValue(start, stop).value(clock)
     if counter:
         counter(str(wait_time))
-    time.sleep(wait_time)
+    sleep(wait_time, stop_event, clock)
 
 
-def get_wait(spec):
+def get_wait(spec, clock=None):
     if type(spec) is int:
         return spec
     elif spec == '':
@@ -60,7 +75,7 @@ def get_wait(spec):
     else:
         return 0
 
-    wait_time = WaitValue(start, stop).value()
+    wait_time = WaitValue(start, stop).value(clock)
     return wait_time
 
 
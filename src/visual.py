@@ -0,0 +1,110 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# Visual change condition, for page state that only shows up in canvas or
+# images. An action may add
+#
+#   "visual": {"xpath": "//canvas[@id='chart']",   (or "region": [x, y, width, height])
+#              "method": "phash",                   (phash or pixel)
+#              "threshold": 0.1,                    (0..1, how different it must be)
+#              "size": 32,                          (downsampled image size)
+#              "interval": 2}                       (seconds between checks on an unchanged page)
+#
+# which holds when the captured image differs from the previous capture by
+# more than the threshold. Canvas and images change without reloading the
+# page, so these actions are also checked every 'interval' seconds while the
+# page stays the same. Needs 'pip install numpy pillow'.
+#
+
+import io
+import functools
+
+Methods = ('phash', 'pixel')
+DefaultInterval = 2
+
+
+def interval(rule):
+    # how often the visual actions of a rule are checked on an unchanged page
+    specs = [action['visual'] for action in rule.get('actions', []) if action.get('visual')]
+    if not specs:
+        return None
+    return min(float(spec.get('interval', DefaultInterval)) for spec in specs)
+
+
+def load_image(png, size, crop=None):
+    import numpy as np
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(png)).convert('L')
+    if crop:
+        image = image.crop(crop)
+    image = image.resize((size, size), Image.BOX)
+    return np.asarray(image, dtype=np.float32)
+
+
+@functools.lru_cache(maxsize=8)
+def dct_matrix(n):
+    import numpy as np
+
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    m = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    m[0, :] = np.sqrt(1.0 / n)
+    return m
+
+
+def phash(pixels, hash_size=8):
+    import numpy as np
+
+    m = dct_matrix(pixels.shape[0])
+    dct = m @ pixels @ m.T
+    low = dct[:hash_size, :hash_size].ravel()
+    return low[1:] > np.median(low[1:])     # skip the DC term, it's just brightness
+
+
+def difference(old, new, method='phash'):
+    import numpy as np
+
+    if method == 'pixel':
+        return float(np.abs(old - new).mean() / 255.0)
+    elif method == 'phash':
+        a, b = phash(old), phash(new)
+        return float(np.count_nonzero(a != b) / a.size)
+    else:
+        raise SyntaxError(f"Unknown visual method: '{method}'")
+
+
+class VisualDetector(object):
+    def __init__(self):
+        self.previous = {}
+        self.before = {}
+        self.captures = {}
+        self.capture_key = None
+
+    def check(self, key, pass_key, grab, method='phash', threshold=0.1):
+        # capture each region once per pass, however many actions look at it,
+        # and compare it with the capture from the pass before
+        if self.capture_key != pass_key:
+            self.captures = {}
+            self.capture_key = pass_key
+        if key not in self.captures:
+            pixels = grab()
+            self.captures[key] = pixels
+            self.before[key] = self.previous.get(key)
+            self.previous[key] = pixels
+
+        old, new = self.before[key], self.captures[key]
+        if old is None or old.shape != new.shape:
+            return False
+        return difference(old, new, method) > threshold
+
+    def clear(self):
+        self.previous = {}
+        self.before = {}
+        self.captures = {}
+        self.capture_key = None
@@ -0,0 +1,99 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# Browser session watchdog. Pings the session on its own connection so a
+# crashed ('Aw, Snap!') or hung browser is noticed without waiting for the
+# rule thread to time out. Configured in app.ini:
+#
+#   [watchdog]
+#   enable = yes
+#   interval = 2        ; seconds between heartbeats
+#   timeout = 15        ; heartbeat timeout (seconds), keep it above the 10s page load
+#                       ; timeout, chromedriver runs the script only once a load is done
+#   failures = 2        ; consecutive failed heartbeats before declaring the session dead
+#   max_attempts = 3    ; recovery attempts before giving up and alerting
+#
+
+import threading
+from selenium.common.exceptions import UnexpectedAlertPresentException
+
+import settings
+import cdp
+from clock import SystemClock
+
+WatchdogSection = 'watchdog'
+
+
+def enabled():
+    return settings.Config.getboolean(WatchdogSection, 'enable', fallback=False)
+
+
+def probe(driver):
+    # CDP: a page blocked by a JavaScript dialog isn't hung
+    if getattr(driver, 'dialog', None):
+        return
+    # answered by chromedriver itself, even mid page load, so a dead
+    # browser or driver shows up without waiting for the timeout
+    driver.window_handles
+    try:
+        driver.execute_script('return 1;')
+    except UnexpectedAlertPresentException:
+        pass
+
+
+class Watchdog(threading.Thread):
+    def __init__(self, driver_factory, clock=None):
+        super().__init__(name='watchdog', daemon=True)
+        cfg = settings.Config
+        self.interval = cfg.getfloat(WatchdogSection, 'interval', fallback=2)
+        self.timeout = cfg.getfloat(WatchdogSection, 'timeout', fallback=15)
+        self.max_failures = cfg.getint(WatchdogSection, 'failures', fallback=2)
+        self.driver_factory = driver_factory
+        self.clock = clock or SystemClock
+        self.stop_event = threading.Event()
+        self.failed = threading.Event()
+        self.reason = ''
+        self.last_ok = self.clock.time()
+        self.driver = None
+
+    def run(self):
+        try:
+            self.driver = self.driver_factory(self.timeout)
+        except Exception as error:
+            self.fail(f'unable to attach heartbeat: {error}')
+            return
+
+        failures = 0
+        try:
+            while not self.clock.wait(self.interval, self.stop_event):
+                try:
+                    probe(self.driver)
+                except Exception as error:
+                    if self.stop_event.is_set():
+                        break
+                    failures += 1
+                    if failures >= self.max_failures:
+                        self.fail(f'{type(error).__name__}: {str(error).strip()}')
+                        return
+                else:
+                    failures = 0
+                    self.last_ok = self.clock.time()
+        finally:
+            cdp.detach(self.driver)
+
+    def fail(self, reason):
+        self.reason = reason
+        self.failed.set()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.driver:
+            cdp.detach(self.driver)     # don't wait for the next heartbeat to let go
+
+    def is_dead(self):
+        return self.failed.is_set()
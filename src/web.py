@@ -8,17 +8,17 @@
 import sys
 import traceback
 import re
-import os.path
 import urllib.parse
-import time
 import json
 import threading
+import urllib3
 from urllib3.exceptions import MaxRetryError
 from urllib.parse import urlparse
 from selenium import webdriver
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.common.by import By
 from selenium.webdriver.remote.webdriver import WebDriver
+from selenium.webdriver.remote.remote_connection import RemoteConnection
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import (
@@ -36,26 +36,86 @@ from selenium.common.exceptions import (
 import notification
 import settings
 import cookies
-from utils import get_wait, dict_gets, to_value
-
+import cdp
+import launch
+import watchdog
+import flags
+import rulefile
+import filewatch
+import triggers
+import export
+import visual
+import memory
+import profiles
+import tabs
+import ratelimit
+import snapshots
+from clock import SystemClock
+from utils import get_wait, dict_gets, to_value, Cancelled, check_cancel
+from flags import to_number
+
+
+class AttachedWebDriver(WebDriver):
+    # WebDriver bound to an already running session, no newSession command is sent
+    def __init__(self, command_executor, session_id):
+        self.attach_session_id = session_id
+        self.commands = 0
+        super().__init__(command_executor=command_executor, desired_capabilities={})
+
+    def execute(self, driver_command, params=None):
+        self.commands += 1
+        return super().execute(driver_command, params)
+
+    def start_session(self, capabilities, browser_profile=None):
+        self.session_id = self.attach_session_id
+        self.capabilities = {}
+        self.w3c = True
+
+    def execute_cdp_cmd(self, cmd, cmd_args):
+        # chromedriver only, same as webdriver.Chrome.execute_cdp_cmd
+        self.command_executor._commands['executeCdpCommand'] = \
+            ('POST', '/session/$sessionId/goog/cdp/execute')
+        return self.execute('executeCdpCommand', {'cmd': cmd, 'params': cmd_args})['value']
+
+
+# keep-alive connections shared by all drivers attached to the same executor
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def get_connection(executor_url, timeout=None):
+    key = (executor_url, timeout)
+    with _connections_lock:
+        conn = _connections.get(key)
+        if conn is None:
+            conn = RemoteConnection(executor_url, keep_alive=True)
+            pool_size = settings.Config.getint('web', 'connection_pool_size', fallback=10)
+            pool_timeout = timeout if timeout is not None else conn._timeout
+            conn._conn = urllib3.PoolManager(maxsize=pool_size, timeout=pool_timeout)
+            _connections[key] = conn
+        return conn
+
+
+def new_window(driver):
+    # open a blank tab with a browser command, page script may be blocked by
+    # popup blockers or CSP. window.open() is left for drivers without one
+    if isinstance(driver, cdp.CdpDriver):
+        return driver.new_window()
+    try:
+        driver.command_executor._commands['newWindow'] = ('POST', '/session/$sessionId/window/new')
+        return driver.execute('newWindow', {'type': 'tab'})['value']['handle']
+    except WebDriverException:
+        pass
+    old_handles = set(driver.window_handles)
+    driver.execute_script("window.open('about:blank', '_blank');")
+    new_handles = set(driver.window_handles) - old_handles
+    return new_handles.pop() if new_handles else None
 
-def attach_to_session(executor_url, session_id):
-    original_execute = WebDriver.execute
 
-    def new_command_execute(self, command, params=None):
-        if command == "newSession":
-            # Mock the response
-            return {'success': 0, 'value': None, 'sessionId': session_id}
-        else:
-            return original_execute(self, command, params)
-
-    # Patch the function before creating the driver object
-    WebDriver.execute = new_command_execute
-    driver = webdriver.Remote(command_executor=executor_url, desired_capabilities={})
-    driver.session_id = session_id
-    # Replace the patched function with original function
-    WebDriver.execute = original_execute
-    return driver
+def attach_to_session(executor_url, session_id, timeout=None):
+    if cdp.is_cdp_url(executor_url):
+        return cdp.attach_cdp(executor_url, session_id, timeout)
+    return AttachedWebDriver(get_connection(executor_url, timeout), session_id)
 
 
 def start_browser(browser=None):
@@ -63,6 +123,10 @@ def start_browser(browser=None):
         browser_config = settings.Config.get('web', 'browser', fallback='chrome').lower()
         browser = settings.Config.get(browser_config, 'browser', fallback='chrome').lower()
 
+    backend = settings.Config.get(browser_config, 'backend', fallback='webdriver').lower()
+    if backend == 'cdp':
+        return cdp.start_cdp(browser_config)
+
     if browser == 'chromium':
         return start_chromium(browser_config)
     elif browser == 'chrome':
@@ -81,26 +145,37 @@ def start_chromium(browser_config):
     options = webdriver.ChromeOptions()
     options.binary_location = settings.Config[browser_config]['exe']
     chromedriver = settings.Config[browser_config]['driver']
-    user_data_dir = settings.Config.get(browser_config, 'user_data_dir', fallback='')
+    user_data_dir = profiles.user_data_dir(browser_config)
     if user_data_dir:
         options.add_argument(f"user-data-dir={user_data_dir}")
     options.add_argument("--allow-running-insecure-content")
     options.add_argument('--ignore-certificate-errors')
-    return webdriver.Chrome(executable_path=chromedriver, options=options)
+    capabilities = launch.apply_chromium_options(options, browser_config)
+    driver = webdriver.Chrome(executable_path=chromedriver, options=options,
+                              desired_capabilities=capabilities)
+    launch.apply_url_blocking(driver, browser_config)
+    return profiles.track(driver, user_data_dir)
 
 
 def start_chrome(browser_config):
     options = webdriver.ChromeOptions()
     chromedriver = settings.Config[browser_config]['driver']
-    user_data_dir = settings.Config.get(browser_config, 'user_data_dir', fallback='')
+    user_data_dir = profiles.user_data_dir(browser_config)
     if user_data_dir:
         options.add_argument(f"user-data-dir={user_data_dir}")
-    return webdriver.Chrome(executable_path=chromedriver, options=options)
+    capabilities = launch.apply_chromium_options(options, browser_config)
+    driver = webdriver.Chrome(executable_path=chromedriver, options=options,
+                              desired_capabilities=capabilities)
+    launch.apply_url_blocking(driver, browser_config)
+    return profiles.track(driver, user_data_dir)
 
 
 def start_firefox(browser_config):
+    options = webdriver.FirefoxOptions()
     geckodriver = settings.Config[browser_config]['driver']
-    return webdriver.Firefox(executable_path=geckodriver)
+    capabilities = launch.apply_firefox_options(options, browser_config)
+    return webdriver.Firefox(executable_path=geckodriver, options=options,
+                             desired_capabilities=capabilities)
 
 
 def start_IE(browser_config):
@@ -117,12 +192,14 @@ def start_msedge(browser_config):
 
     options = EdgeOptions()
     options.use_chromium = True
-    user_data_dir = settings.Config.get(browser_config, 'user_data_dir', fallback='')
+    user_data_dir = profiles.user_data_dir(browser_config)
     if user_data_dir:
         options.add_argument(f'user-data-dir={user_data_dir}')
+    capabilities = launch.apply_chromium_options(options, browser_config)
     edgedriver = settings.Config[browser_config]['driver']
-    driver = Edge(executable_path=edgedriver, options=options)
-    return driver
+    driver = Edge(executable_path=edgedriver, options=options, capabilities=capabilities)
+    launch.apply_url_blocking(driver, browser_config)
+    return profiles.track(driver, user_data_dir)
 
 
 def start_opera(browser_config):
@@ -133,21 +210,76 @@ def start_opera(browser_config):
     return driver
 
 
+def compare_value(ev, operator, uv):
+    op = operator.lower()
+    if op in ('equals', '=='):
+        return ev == uv
+    elif op in ('notequals', '!='):
+        return ev != uv
+    elif op in ('contains', '@'):
+        return uv in ev
+    elif op in ('notcontains', '!@'):
+        return uv not in ev
+    elif op in ('search', '~'):
+        return re.search(uv, ev) is not None
+    elif op in ('notsearch', '!~'):
+        return re.search(uv, ev) is None
+    elif op in ('lessthan', '<'):
+        return to_value(ev) < to_value(uv)
+    elif op in ('lessthanequals', '<='):
+        return to_value(ev) <= to_value(uv)
+    elif op in ('greaterthan', '>'):
+        return to_value(ev) > to_value(uv)
+    elif op in ('greaterthanequals', '>='):
+        return to_value(ev) >= to_value(uv)
+    else:
+        raise Exception(f"Unknown condition operator: '{operator}'")
+
+
 class MyWeb:
-    def __init__(self, postal):
+    def __init__(self, postal, rule_filter=None, session_name=None, clock=None):
         self.url = ""
+        self.clock = clock or SystemClock
         self.postal = postal
+        self.session_name = session_name
         self.started = False
         self.paused = True
         self.rule_file_mtime = None
+        self.rule_filter = rule_filter
         self.rule_data = []
+        self.rule_watch = None
+        self.edge_keys = {}
         self.load_rules()
+        self.start_rule_watch()
         self.last_url = ""
         self.page_head = None
-        self.rule_flags = {}
+        self.tabs = {}
+        self.current_tab = tabs.MainTab
+        self.rule_flags = flags.FlagStore(clock=self.clock)
         self.current_rule = ""
         self.current_action = ""
         self.current_action_index = -1
+        self.watchdog = None
+        self.memory_governor = None
+        self.session_provider = None
+        self.launched_by_recover = False
+        self.recoveries = 0
+        self.stop_event = threading.Event()
+        self.page_generation = 0
+        self.criteria_value = None
+        self.criteria_cache = triggers.ValueCache()
+        self.edges = triggers.EdgeTracker()
+        self.visual = visual.VisualDetector()
+        self.visual_polled = {}
+        self.pass_count = 0
+        self.rate_governor = ratelimit.RateGovernor(self.clock) if ratelimit.enabled() else None
+        self.deferred_rules = {}
+        self.engine_thread = None
+        self.frame_path = []
+        self.last_error = ''
+        self.notify_count = 0
+        self.snapshots = snapshots.SnapshotRecorder(attach_to_session, log=self.show_log) \
+            if snapshots.enabled() else None
 
     def set_url(self):
         if self.rule_data:
@@ -160,6 +292,7 @@ class MyWeb:
         if self.started:
             return
 
+        self.launched_by_recover = False
         if connect:
             exe_url, session_id = connect
             try:
@@ -169,34 +302,248 @@ class MyWeb:
                 raise ConnectionError
         else:
             self.driver = start_browser()
-            self.started = True
-            self.main_window = self.driver.current_window_handle  # save the top window
+
+        self.setup_session()
+
+    def setup_session(self):
+        self.main_window = self.driver.current_window_handle  # save the top window
+        self.tabs = {tabs.MainTab: tabs.Tab(tabs.MainTab, self.main_window)}
+        self.current_tab = tabs.MainTab
 
         # save current session info for future use
         executor_url = self.driver.command_executor._url
         session_id = self.driver.session_id
-        cookies.update('browser', 'session', f'{executor_url} {session_id}')
+        cookies.save_session(f'{executor_url} {session_id}', self.session_name)
 
         # speed up timeout to react faster to issue like 'Aw, Snap!' on Chrome
         self.driver.set_page_load_timeout(10)
         self.driver.set_script_timeout(10)
+        self.apply_launch_profile()
         self.show_log(f"Connected to browser.")
         self.started = True
+        self.start_watchdog()
+        self.start_memory_governor()
+
+    def apply_launch_profile(self):
+        # blocked urls are per tab and per DevTools connection, the launcher's
+        # are gone by the time we attach. CdpDriver applies its own
+        if not isinstance(self.driver, cdp.CdpDriver):
+            launch.apply_url_blocking(self.driver, launch.browser_config())
+
+    def start_watchdog(self):
+        self.stop_watchdog()
+        if not watchdog.enabled():
+            return
+
+        executor_url = self.driver.command_executor._url
+        session_id = self.driver.session_id
+        self.watchdog = watchdog.Watchdog(
+            lambda timeout: attach_to_session(executor_url, session_id, timeout=timeout),
+            clock=self.clock)
+        self.watchdog.start()
+
+    def stop_watchdog(self):
+        if self.watchdog:
+            self.watchdog.stop()
+            self.watchdog = None
+
+    def browser_pid(self):
+        service = getattr(self.driver, 'service', None)
+        if service and service.process:
+            return service.process.pid
+        process = getattr(self.driver, 'process', None)     # CDP backend
+        if process:
+            return process.pid
+        # attached session, find whoever serves the executor port on this host
+        url = urlparse(cdp.http_url(self.driver.command_executor._url))
+        if url.hostname in ('127.0.0.1', 'localhost', '::1') and url.port:
+            return memory.listening_pid(url.port)
+        return None
+
+    def start_memory_governor(self):
+        self.stop_memory_governor()
+        if not memory.enabled():
+            return
+
+        executor_url = self.driver.command_executor._url
+        session_id = self.driver.session_id
+        browser_pid = self.browser_pid()
+        if browser_pid is None:
+            self.show_log('Browser process not found, memory governor only watches the JS heap')
+        self.memory_governor = memory.MemoryGovernor(
+            lambda: attach_to_session(executor_url, session_id, timeout=30),
+            browser_pid=browser_pid, log=self.show_log)
+        self.memory_governor.start()
+
+    def stop_memory_governor(self):
+        if self.memory_governor:
+            self.memory_governor.stop()
+            self.memory_governor = None
+
+    def check_memory(self):
+        # called between rule passes, where it's safe to swap the tab or session
+        governor = self.memory_governor
+        if governor is None or governor.recycle_due is None:
+            return
+
+        reason = governor.recycle_due
+        self.show_log(f'Recycling browser {governor.mode}: {reason}')
+        self.show_log(governor.trend())
+        if governor.mode == 'session':
+            self.recover(f'memory governor, {reason}')
+        else:
+            self.recycle_tab()
+            self.start_memory_governor()    # sample the new tab from scratch
+
+    def recycle_tab(self):
+        url = self.last_url
+        handle = new_window(self.driver)
+        if not handle:
+            self.show_log('Unable to open a new tab, tab not recycled')
+            return
+
+        tab = self.tabs[self.current_tab]
+        self.driver.switch_to.window(tab.handle)
+        self.driver.close()
+        tab.handle = handle
+        if tab.name == tabs.MainTab:
+            self.main_window = tab.handle
+        self.driver.switch_to.window(tab.handle)
+        self.apply_launch_profile()
+        if url:
+            self.driver.get(url)
+        else:
+            self.set_url()
+        self.page_head = None
+
+    def park_tab(self):
+        # keep the page state of the tab in front with the tab
+        tab = self.tabs.get(self.current_tab)
+        if tab:
+            tab.page_head, tab.last_url = self.page_head, self.last_url
+
+    def switch_tab(self, name, rule=None):
+        if name == self.current_tab and name in self.tabs:
+            return True
+
+        self.park_tab()
+        tab = self.tabs.get(name)
+        try:
+            if tab is None:
+                tab = self.open_tab(name, rule)
+            else:
+                self.driver.switch_to.window(tab.handle)
+        except NoSuchWindowException:
+            self.show_log(f"Tab '{name}' was closed, opening it again")
+            self.tabs.pop(name, None)
+            self.driver.switch_to.window(self.driver.window_handles[0])
+            tab = self.open_tab(name, rule)
+        if tab is None:
+            return False
+
+        self.current_tab = name
+        self.page_head, self.last_url = tab.page_head, tab.last_url
+        return True
+
+    def open_tab(self, name, rule):
+        url = dict_gets(rule or {}, ('tabUrl', 'url'), '')
+        handle = new_window(self.driver)
+        if not handle:
+            self.show_log(f"Unable to open tab '{name}'")
+            return None
+
+        tab = tabs.Tab(name, handle)
+        self.tabs[name] = tab
+        self.driver.switch_to.window(tab.handle)
+        self.apply_launch_profile()     # before the first page load
+        if url:
+            self.driver.get(url)
+        self.show_log(f"Opened tab '{name}': {url}")
+        return tab
+
+    def recover(self, reason):
+        # replace a dead session and carry on where we left off
+        self.show_log(f'Browser session lost: {reason}')
+        self.stop_watchdog()
+        self.stop_memory_governor()
+        started = self.clock.time()
+        old_driver = self.driver
+        threading.Thread(target=self.quit_driver, args=(old_driver,), daemon=True).start()
+
+        saved_flags = self.rule_flags.snapshot(expiry=True)
+        self.park_tab()
+        main_tab = self.tabs.get(tabs.MainTab)
+        url = main_tab.last_url if main_tab else self.last_url
+        attempts = settings.Config.getint('watchdog', 'max_attempts', fallback=3)
+        for attempt in range(1, attempts + 1):
+            self.show_log(f'Restoring browser session (attempt {attempt}/{attempts})')
+            try:
+                self.recoveries += 1
+                if self.session_provider:
+                    self.driver = self.session_provider()
+                    self.launched_by_recover = False
+                else:
+                    # a private browser nobody else knows of, end() quits it
+                    self.driver = start_browser()
+                    self.launched_by_recover = True
+                self.setup_session()
+                if url:
+                    self.driver.get(url)
+                else:
+                    self.set_url()
+                self.page_head = None
+                self.rule_flags.restore(saved_flags)
+                self.show_log(f'Browser session restored in {self.clock.time() - started:.1f}s')
+                return True
+            except Exception as error:
+                self.show_log(f'ERROR restoring browser session: {error}')
+                if self.clock.wait(min(2 ** attempt, 10), self.stop_event):
+                    raise Cancelled
+
+        self.send_notification(f"Houston, we have a problem! Unable to restore browser: {reason}")
+        self.send_alert()
+        return False
+
+    def quit_driver(self, driver):
+        try:
+            driver.quit()
+        except Exception:
+            pass
+        profiles.release_driver(driver)
 
     def end(self, quit_session=False):
         if not self.started:
             return
-        if quit_session:
+        self.stop_watchdog()
+        self.stop_memory_governor()
+        self.rule_flags.flush()
+        if quit_session or self.launched_by_recover:
+            self.launched_by_recover = False
             self.driver.quit()
+            profiles.release_driver(self.driver)
 
         self.started = False
 
     def pause(self, enable=True):
         self.paused = enable
 
+    def request_stop(self):
+        # the rule thread notices this at its next wait or between steps
+        self.paused = True
+        self.stop_event.set()
+
+    def reset_stop(self):
+        self.stop_event.clear()
+
     def clear(self):
         self.page_head = None
-        self.rule_flags = {}
+        self.criteria_cache.clear()
+        self.edges.clear()
+        self.visual.clear()
+        self.visual_polled = {}
+        self.deferred_rules = {}
+        if not self.rule_flags.persist:
+            self.rule_flags.clear()
 
     def show_log(self, text):
         self.postal.log(text)
@@ -215,13 +562,40 @@ class MyWeb:
             self.show_status(value_str)
         elif info_type == 'initwait':
             self.countdown(int(value_str))
+        elif info_type == 'timing':
+            self.show_log(value_str)
+
+    def snapshot(self):
+        # plain values only, safe to call from other threads
+        governor = self.memory_governor
+        limits = self.rate_governor.counters() if self.rate_governor else {}
+        return {
+            'started': self.started,
+            'paused': self.paused,
+            'session': self.session_name,
+            'rules': len(self.rule_data),
+            'rule': self.current_rule,
+            'action': self.current_action,
+            'action_index': self.current_action_index,
+            'tab': self.current_tab,
+            'url': self.last_url,
+            'passes': self.pass_count,
+            'recoveries': self.recoveries,
+            'commands': getattr(self.driver, 'commands', 0) if self.started else 0,
+            'notifications': self.notify_count,
+            'last_error': self.last_error,
+            'deferred_rules': len(self.deferred_rules),
+            'rate_limits': {f'{site} {rule or "*"}': counts
+                            for (site, rule), counts in limits.items()},
+            'memory': governor.latest() if governor else None,
+        }
 
     def is_started(self):
         return self.started
 
     def check_rule_file_modified(self):
         file = settings.Config['rules']['rulefile']
-        mtime = os.path.getmtime(file)
+        mtime = rulefile.mtime(file)
         if self.rule_file_mtime is None:
             return True
         elif self.rule_file_mtime < mtime:
@@ -229,27 +603,87 @@ class MyWeb:
         else:
             return False
 
+    def read_rules(self, file):
+        rule_data = rulefile.load(file)
+        if self.rule_filter:
+            # only run the subset of rules assigned to this instance
+            rule_data = [r for r in rule_data if r.get('name') in self.rule_filter]
+        triggers.check(rule_data)
+        return rule_data
+
     def load_rules(self):
         try:
             file = settings.Config['rules']['rulefile']
             self.show_log(f'Loading JSON file \'{file}\'')
-            with open(file) as f:
-                self.rule_data = json.load(f)
-            self.rule_file_mtime = os.path.getmtime(file)
+            rule_data = self.read_rules(file)
+            self.edge_keys = triggers.edge_keys(rule_data)
+            self.rule_data = rule_data
+            self.rule_file_mtime = rulefile.mtime(file)
         except FileNotFoundError as emsg:
             self.show_log(f'ERROR reading JSON file: {emsg}')
             return False
         except json.decoder.JSONDecodeError as emsg:
             self.show_log(f'ERROR reading JSON file: {emsg}')
             return False
+        except SyntaxError as emsg:
+            self.show_log(f'ERROR in JSON file: {emsg}')
+            return False
         else:
             self.show_log(f'JSON file loaded')
 
         return True
 
+    def reload_rules(self, changed_files=None):
+        # runs on the file watcher thread. The rule list is swapped in one
+        # assignment, so a pass in progress finishes with the rules it started
+        # with, and flags and page state are left alone.
+        file = settings.Config['rules']['rulefile']
+        try:
+            rule_data = self.read_rules(file)
+            mtime = rulefile.mtime(file)
+        except (FileNotFoundError, json.decoder.JSONDecodeError, SyntaxError) as emsg:
+            self.show_log(f'ERROR reloading JSON file, keeping current rules: {emsg}')
+            return False
+
+        added, changed, removed = rulefile.diff(self.rule_data, rule_data)
+        rule_data = rulefile.merge(self.rule_data, rule_data)
+        # keys of the rules in a pass still running are kept until the next reload
+        edge_keys = triggers.edge_keys(self.rule_data)
+        edge_keys.update(triggers.edge_keys(rule_data))
+        self.edge_keys = edge_keys
+        self.rule_data = rule_data
+        self.rule_file_mtime = mtime
+        for title, names in (('added', added), ('changed', changed), ('removed', removed)):
+            if names:
+                self.show_log(f'Rules {title}: ' + ', '.join(f"'{n}'" for n in names))
+        return True
+
+    def start_rule_watch(self):
+        self.stop_rule_watch()
+        if not settings.Config.getboolean('rules', 'hot_reload', fallback=False):
+            return
+
+        file = settings.Config['rules']['rulefile']
+        debounce = settings.Config.getfloat('rules', 'reload_debounce', fallback=0.5)
+        self.rule_watch = filewatch.FileWatcher([file], self.reload_rules, debounce=debounce)
+        self.rule_watch.start()
+        self.show_log(f'Watching \'{file}\' for rule changes')
+
+    def stop_rule_watch(self):
+        if self.rule_watch:
+            self.rule_watch.stop()
+            self.rule_watch = None
+
     def process_rules(self):
-        for rule in self.rule_data:
-            self.run_rule(rule)
+        self.pass_count += 1
+        self.run_deferred()
+        for tab, rules in tabs.batches(self.rule_data, self.current_tab):
+            check_cancel(self.stop_event)
+            if not self.switch_tab(tab, rules[0]):
+                continue
+            for rule in rules:
+                check_cancel(self.stop_event)
+                self.run_rule(rule)
 
     def check_page_changed(self):
         # check if the page has changed or reloaded
@@ -269,29 +703,22 @@ class MyWeb:
             return True
 
     def wait_in_page(self, spec):
-        def check_page():
-            while self.keep_wait:
-                if self.check_page_changed():
-                    self.keep_wait = False
-                    wait_event.set()
-                time.sleep(0.5)
-
-        wait_time = get_wait(spec)
+        wait_time = get_wait(spec, self.clock)
         if not wait_time:
             return
 
-        # start waiting until page changed
-        checker = threading.Thread(target=check_page)
-        wait_event = threading.Event()
+        # wait until page changed, time is up or stop is requested
         self.countdown(str(wait_time))
-        self.keep_wait = True
-        checker.start()
-        wait_event.wait(wait_time)
-        self.countdown("0")
-
-        # stop the page changed check
-        self.keep_wait = False
-        checker.join()
+        deadline = self.clock.time() + wait_time
+        try:
+            while not self.check_page_changed():
+                remaining = deadline - self.clock.time()
+                if remaining <= 0:
+                    break
+                if self.clock.wait(min(0.5, remaining), self.stop_event):
+                    raise Cancelled
+        finally:
+            self.countdown("0")
 
     def run_rule(self, rule):
         self.current_rule = rule.get('name', '(unknown)')
@@ -304,53 +731,116 @@ class MyWeb:
 
         if self.check_page_changed():
             self.page_head = self.driver.find_element_by_tag_name('head')
+            self.page_generation += 1
+            self.visual_due(rule)
+        elif self.visual_due(rule):
+            # canvas and images change without a page load
+            self.show_status(f"Checking visual conditions: '{rule['name']}'")
+            self.run_actions(rule, visual_only=True)
+            return
         else:
             return
 
         self.show_status(f"Running Rule: '{rule['name']}'. Initwait: {rule['initWait']}")
         self.wait_in_page(rule['initWait'])
-        for idx, action in enumerate(rule["actions"]):
+        self.run_actions(rule)
+
+    def visual_due(self, rule):
+        every = visual.interval(rule)
+        if every is None:
+            return False
+        key = (self.current_tab, rule.get('name'))
+        now = self.clock.time()
+        if now - self.visual_polled.get(key, -every) < every:
+            return False
+        self.visual_polled[key] = now
+        return True
+
+    def run_actions(self, rule, start=0, resumed=False, visual_only=False):
+        for idx, action in enumerate(rule["actions"][start:], start):
+            check_cancel(self.stop_event)
+            if visual_only and not action.get('visual'):
+                continue
             self.current_action = action.get('name', '(unknown)')
             self.current_action_index = idx
             self.show_status(f"Running Rule: '{rule['name']}'. Initwait: {rule['initWait']} "
                              f"[Action #{idx}: '{self.current_action}'. Initwait: {action['initWait']}]")
-            self.run_action(action)
+            try:
+                self.run_action(action, resumed=resumed and idx == start)
+            except ratelimit.RateLimited as limited:
+                # pick up the rest of the rule from this action on a later pass
+                self.deferred_rules[id(rule)] = (limited.retry_at, rule, idx, visual_only)
+                self.show_status(f"Rate limited: '{rule['name']}' [Action #{idx}] deferred")
+                return
 
-    def run_action(self, action):
+    def run_deferred(self):
+        now = self.clock.time()
+        for key, (retry_at, rule, idx, visual_only) in list(self.deferred_rules.items()):
+            if retry_at > now:
+                continue
+            del self.deferred_rules[key]
+            if not rule['enable'] or not self.switch_tab(tabs.rule_tab(rule), rule):
+                continue
+            # the rule starts over if its page has changed meanwhile
+            if self.check_page_changed() or not self.check_url(rule['url']):
+                continue
+            self.current_rule = rule.get('name', '(unknown)')
+            self.run_actions(rule, idx, resumed=True, visual_only=visual_only)
+
+    def throttle(self):
+        if self.rate_governor:
+            site = urllib.parse.urlparse(self.last_url).netloc
+            self.rate_governor.acquire(site, self.current_rule)
+
+    def run_action(self, action, resumed=False):
         if not action.get('enable', True):
             return
 
         if self.check_page_changed():
             return
 
-        self.wait_in_page(action['initWait'])
-        if self.check_page_changed():
-            return
+        if not resumed:
+            self.wait_in_page(action['initWait'])
+            if self.check_page_changed():
+                return
+        check_cancel(self.stop_event)
 
         try:
             xpath = dict_gets(action, ('xpath', 'elementFinder'))
             elem = self.driver.find_element_by_xpath(xpath)
-            if not self.check_criteria(action) or \
-                    not self.check_flags(action):
+            if resumed:
+                # the conditions passed and the trigger fired before it was deferred,
+                # checking again would apply the flag changes a second time
+                fire = True
+            else:
+                passed = self.check_criteria(action) and self.check_visual(action) \
+                    and self.check_flags(action)
+                trigger = action.get('trigger', 'level')
+                if trigger == 'change' and not dict_gets(action.get('addon', {}), ('xpath', 'elementFinder')):
+                    self.criteria_value = self.element_value(elem)
+                key = self.edge_keys.get(id(action), (self.current_rule, self.current_action))
+                fire = self.edges.fire(key, trigger, passed, self.criteria_value)
+            if not fire:
                 return
 
             value = action['value']
-            if "UserEvent::Notify" in value:
+            if "UserEvent::Extract" in value:
+                rm = re.match(r"UserEvent::Extract\((.*)\)", value)
+                self.extract(action, rm.groups()[0].strip() if rm else None)
+            elif "UserEvent::Notify" in value:
                 msg = "ERROR in UserEvent::Notify call"
                 rm = re.match(r"UserEvent::Notify\((.+)\)", value)
                 if rm:
                     msg = rm.groups()[0]
-                if elem.tag_name == 'input':
-                    ev = elem.get_attribute('value')
-                elif elem.tag_name == 'label':
-                    ev = elem.text
-                else:
-                    ev = elem.text      # for other element type, we do this for now
+                ev = self.element_value(elem)
+                self.throttle()
                 self.send_notification(msg.format(ev))
             elif value:
+                self.throttle()
                 elem.clear()
                 elem.send_keys(action['value'])
             else:
+                self.throttle()
                 if elem.tag_name == 'input' and elem.get_attribute('type') == 'text':
                     elem.send_keys(Keys.ENTER)
                 else:
@@ -367,6 +857,7 @@ class MyWeb:
             pass
 
     def check_criteria(self, action):
+        self.criteria_value = None
         try:
             criterion = action['addon']
             xpath = dict_gets(criterion, ('xpath', 'elementFinder'))
@@ -380,39 +871,77 @@ class MyWeb:
 
         try:
             elem = self.driver.find_element_by_xpath(xpath)
-            if elem.tag_name == 'input':
-                ev = elem.get_attribute('value')
-            elif elem.tag_name == 'label':
-                ev = elem.text
-            else:
-                ev = elem.text
-            op = operator.lower()
-            if op in ('equals', '=='):
-                result = ev == uv
-            elif op in ('notequals', '!='):
-                result = ev != uv
-            elif op in ('contains', '@'):
-                result = uv in ev
-            elif op in ('notcontains', '!@'):
-                result = uv not in ev
-            elif op in ('search', '~'):
-                result = re.search(uv, ev) is not None
-            elif op in ('notsearch', '!~'):
-                result = re.search(uv, ev) is None
-            elif op in ('lessthan', '<'):
-                result = to_value(ev) < to_value(uv)
-            elif op in ('lessthanequals', '<='):
-                result = to_value(ev) <= to_value(uv)
-            elif op in ('greaterthan', '>'):
-                result = to_value(ev) > to_value(uv)
-            elif op in ('greaterthanequals', '>='):
-                result = to_value(ev) >= to_value(uv)
-            else:
-                raise Exception(f"Unknown condition operator: '{operator}'")
+            ev = self.element_value(elem)
+            self.criteria_value = ev
+
+            # evaluate again only when the value has changed on this page
+            key = (xpath, operator, uv)
+            result = self.criteria_cache.lookup(self.page_generation, key, ev)
+            if result is triggers.Missing:
+                result = compare_value(ev, operator, uv)
+                self.criteria_cache.store(self.page_generation, key, ev, result)
         except NoSuchElementException:
             result = False
         return result
 
+    def extract(self, action, sink_name=None):
+        fields = action.get('extract')
+        if not fields:
+            raise SyntaxError("UserEvent::Extract needs an 'extract' map of field names to xpaths")
+
+        values = {}
+        for field, xpath in fields.items():
+            try:
+                values[field] = self.element_value(self.driver.find_element_by_xpath(xpath))
+            except NoSuchElementException:
+                values[field] = None
+        pipeline = export.get_pipeline(sink_name or None, log=self.show_log)
+        pipeline.put(self.current_rule, self.current_action, values)
+
+    def element_value(self, elem):
+        if elem.tag_name == 'input':
+            return elem.get_attribute('value')
+        elif elem.tag_name == 'label':
+            return elem.text
+        else:
+            return elem.text      # for other element type, we do this for now
+
+    def check_visual(self, action):
+        spec = action.get('visual')
+        if not spec:
+            return True
+
+        size = int(spec.get('size', 32))
+        method = spec.get('method', 'phash').lower()
+        threshold = float(spec.get('threshold', 0.1))
+        xpath = dict_gets(spec, ('xpath', 'elementFinder'))
+        region = spec.get('region')
+        if xpath:
+            key = (self.current_tab, 'xpath', xpath, size)
+
+            def grab():
+                elem = self.driver.find_element_by_xpath(xpath)
+                return visual.load_image(elem.screenshot_as_png, size)
+        elif region:
+            key = (self.current_tab, 'region', tuple(region), size)
+
+            def grab():
+                return self.grab_region(region, size)
+        else:
+            raise SyntaxError("visual condition needs either 'xpath' or 'region'")
+
+        try:
+            return self.visual.check(key, (self.page_generation, self.pass_count), grab,
+                                     method, threshold)
+        except NoSuchElementException:
+            return False
+
+    def grab_region(self, region, size):
+        x, y, width, height = region
+        ratio = self.driver.execute_script('return window.devicePixelRatio;') or 1
+        box = tuple(int(v * ratio) for v in (x, y, x + width, y + height))
+        return visual.load_image(self.driver.get_screenshot_as_png(), size, crop=box)
+
     def check_flags(self, action):
         flag = action.get('flag', None)
         if not flag:
@@ -446,13 +975,13 @@ class MyWeb:
         elif op in ('notsearch', '!~'):
             result = re.search(uv, ev) is None
         elif op in ('lessthan', '<'):
-            result = to_value(ev) < to_value(uv)
+            result = self.rule_flags.number(name) < to_number(uv)
         elif op in ('lessthanequals', '<='):
-            result = to_value(ev) <= to_value(uv)
+            result = self.rule_flags.number(name) <= to_number(uv)
         elif op in ('greaterthan', '>'):
-            result = to_value(ev) > to_value(uv)
+            result = self.rule_flags.number(name) > to_number(uv)
         elif op in ('greaterthanequals', '>='):
-            result = to_value(ev) >= to_value(uv)
+            result = self.rule_flags.number(name) >= to_number(uv)
         else:
             raise SyntaxError(f"Unknown flag condition operator: '{operator}'")
 
@@ -479,32 +1008,33 @@ class MyWeb:
             val = todo['value']
             operator = todo['op']
             op = operator.lower()
+            ttl = todo.get('ttl')
             if not name:
                 pass
             elif op in ('set', '='):
-                self.rule_flags[name] = val
+                self.rule_flags.set(name, val, ttl)
             elif op in ('decr', '-='):
-                oldval = to_value(self.rule_flags[name])
-                newval = to_value(val)
-                self.rule_flags[name] = str(oldval - newval)
+                self.rule_flags.decr(name, val, ttl)
             elif op in ('incr', '+='):
-                oldval = to_value(self.rule_flags[name])
-                newval = to_value(val)
-                self.rule_flags[name] = str(oldval + newval)
+                self.rule_flags.incr(name, val, ttl)
             else:
                 raise Exception(f"Unknown flag operator: '{op}'")
 
     def check_url(self, url):
-        if url in self.driver.current_url:
+        current_url = self.driver.current_url
+        self.last_url = current_url
+        if url in current_url:
+            self.frame_path = []
             return True
 
         try:
             self.driver.switch_to.default_content()
             frames = self.driver.find_elements_by_tag_name("frame")
-            for frm in frames:
+            for idx, frm in enumerate(frames):
                 frmurl = self.get_content_url(frm)
                 if url in frmurl:
                     self.driver.switch_to.frame(frm)
+                    self.frame_path = [f'frame[{idx}] {frmurl}']
                     return True
         except NoSuchElementException:
             pass
@@ -523,6 +1053,7 @@ class MyWeb:
 
     def send_notification(self, msg):
         self.show_log(msg)
+        self.notify_count += 1
         notification.send_notifications(msg)
 
     def get_owner_url(self, elem):
@@ -543,31 +1074,74 @@ class MyWeb:
         self.show_log(f"  Rule: '{self.current_rule}'")
         self.show_log(f"  Action: [{self.current_action_index}] '{self.current_action}'")
 
+    def profile_tag(self):
+        return self.current_rule, self.current_action
+
+    def capture_failure(self, error):
+        # only what we already hold, the recorder talks to the browser on its own thread
+        self.last_error = f'{type(error).__name__}: {str(error).strip()}'
+        if not self.snapshots:
+            return
+        self.snapshots.capture({
+            'executor_url': self.driver.command_executor._url,
+            'session_id': self.driver.session_id,
+            'error': self.last_error,
+            'traceback': traceback.format_exc(),
+            'rule': self.current_rule,
+            'action': self.current_action,
+            'action_index': self.current_action_index,
+            'tab': self.current_tab,
+            'url': self.last_url,
+            'frame_path': list(self.frame_path),
+            'flags': self.rule_flags.snapshot(),
+        })
+
+    def engine_done(self):
+        # called by the rule thread on its way out, nothing left to profile
+        if self.engine_thread == threading.get_ident():
+            self.engine_thread = None
+
     def check(self):
         # start monitoring for transaction
+        self.engine_thread = threading.get_ident()
         if not self.started or self.paused:
             return
 
         try:
+            if self.watchdog and self.watchdog.is_dead():
+                self.recover(self.watchdog.reason)
+                return
+
             if self.check_alert():
                 self.show_log("in Alert")
                 return
 
+            self.check_memory()
+
             self.show_status('Running...')
             self.process_rules()
 
+        except Cancelled:
+            pass
         except SeleniumTimeoutException as error:
             self.show_log("TIMEOUT when running rules!")
             self.show_rule_info()
             self.show_log(traceback.format_exc())
+            self.capture_failure(error)
             errmsg = str(error)
             try:
                 self.driver.get_cookies()   # check if browser still healthy
                 self.page_head = None
             except SeleniumTimeoutException:
-                self.send_notification(f"Houston, we have a problem! {errmsg}")
-                self.send_alert()
-        except NoSuchWindowException:
+                if self.watchdog:
+                    try:
+                        self.recover(errmsg)
+                    except Cancelled:
+                        pass
+                else:
+                    self.send_notification(f"Houston, we have a problem! {errmsg}")
+                    self.send_alert()
+        except NoSuchWindowException as error:
             self.show_log('Detected NoSuchWindowException error')
             self.show_log(str(error))
             self.show_rule_info()
@@ -577,6 +1151,7 @@ class MyWeb:
             self.show_log(str(error))
             self.show_rule_info()
             self.show_log(traceback.format_exc())
+            self.capture_failure(error)
         except WebDriverException as error:
             self.show_log('Detected WebDriverException error')
             errmsg = str(error)
@@ -586,7 +1161,9 @@ class MyWeb:
             else:
                 self.show_rule_info()
                 self.show_log(traceback.format_exc())
+                self.capture_failure(error)
         except SyntaxError as error:
+            self.last_error = f'SyntaxError: {error}'
             self.show_log('Error in JSON file: ' + str(error))
             self.show_rule_info()
             self.show_log('Please fix and reload')
@@ -596,6 +1173,7 @@ class MyWeb:
             self.show_log(str(error))
             self.show_rule_info()
             self.show_log(traceback.format_exc())
+            self.capture_failure(error)
 
 if __name__ == '__main__':
     settings.init()
@@ -605,7 +1183,7 @@ if __name__ == '__main__':
         eurl = webdrive.command_executor._url
         sid = webdrive.session_id
         print(eurl, sid)
-        cookies.update('browser', 'session', f'{eurl} {sid}')
+        cookies.save_session(f'{eurl} {sid}')
     except SessionNotCreatedException as error:
         print(f'ERROR when starting browser: {error}')
         sys.exit(1)
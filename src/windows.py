@@ -12,9 +12,9 @@ from PyQt5.QtWidgets import (
     QTextEdit, QLineEdit, QMessageBox, QFrame, QCheckBox
 )
 from PyQt5.QtCore import QThread, pyqtSignal, Qt, QTimer, QProcess
-import time
 import sys
 import re
+import json
 import functools
 from datetime import datetime
 from queue import Queue
@@ -22,6 +22,9 @@ from web import MyWeb
 from settings import AppName
 import settings
 import cookies
+import sessions
+import profiler
+import api
 from notification import notifyrun
 
 
@@ -30,6 +33,9 @@ def dprint(text):
     print(f'[{tm}] {text}')
 
 
+StopLatency = 200           # msecs to wait for the web thread on Stop
+
+
 class WebThread(QThread):
     def __init__(self, myweb):
         super().__init__()
@@ -37,9 +43,13 @@ class WebThread(QThread):
         self.myweb = myweb
 
     def run(self):
-        while True:
-            self.myweb.check()
-            time.sleep(0.1)
+        stop_event = self.myweb.stop_event
+        try:
+            while not stop_event.is_set():
+                self.myweb.check()
+                self.myweb.clock.wait(0.1, stop_event)
+        finally:
+            self.myweb.engine_done()
 
 
 class QueueThread(QThread):
@@ -59,6 +69,12 @@ class Postal(object):
     def __init__(self, win):
         self.window = win
         self.web_queue = win.web_queue
+        self.hub = None     # api.EventHub, when the API is on
+
+    def post(self, mtype, text):
+        self.web_queue.put((mtype, text))
+        if self.hub:
+            self.hub.publish(mtype, text)
 
     def log(self, text, timed=True):
         text = str(text).rstrip()
@@ -68,16 +84,16 @@ class Postal(object):
         else:
             msg = text
 
-        self.web_queue.put(('log', msg))
+        self.post('log', msg)
 
     def status(self, text):
-        self.web_queue.put(('status', text))
+        self.post('status', text)
 
     def countdown(self, seconds):
-        self.web_queue.put(('progress', f"{seconds}\n"))
+        self.post('progress', f"{seconds}\n")
 
     def alert(self):
-        self.web_queue.put(('alert', 'stop'))
+        self.post('alert', 'stop')
 
 
 class Window(QDialog):
@@ -88,13 +104,93 @@ class Window(QDialog):
         self.make_window()
         self.read_config()
         self.myweb = MyWeb(self.postal)
+        self.session_pool = None
+        self.pooled_session = None
+        self.web_thread = None
+        self.start_pending = False
+        self.api_server = None
+        self.start_api()
+        self.start_profiler_switch()
+        self.start_session_pool()
         self.update_connection_info()
         self.set_app_title()
 
+    def start_api(self):
+        if not api.enabled():
+            return
+        hub = api.EventHub()
+        try:
+            self.api_server = api.ControlServer(hub, self.api_status, self.myweb.rule_flags.snapshot,
+                                                self.api_control)
+        except Exception as error:
+            self.postal.log(f'ERROR starting control API: {error}')
+            return
+        self.postal.hub = hub
+        self.api_server.start()
+        self.postal.log(f'Control API listening on {self.api_server.url()}')
+
+    def api_status(self):
+        # runs on an API thread
+        status = self.myweb.snapshot()
+        hub = self.postal.hub
+        status['running'] = self.web_thread is not None and self.web_thread.isRunning()
+        status['connection'] = cookies.get_session(self.myweb.session_name)
+        status['status'] = hub.last('status')[0]
+        countdown, sequence = hub.last('progress', '0')
+        status['countdown'] = countdown.strip()
+        status['countdown_seq'] = sequence
+        return status
+
+    def api_control(self, command, args):
+        # runs on an API thread, the GUI thread carries it out
+        self.web_queue.put(('control', json.dumps(dict(args, command=command))))
+
+    def run_control(self, args):
+        command = args['command']
+        self.postal.log(f"API: {command}")
+        if command == 'start':
+            if not self.myweb.is_started():
+                self.postal.log("Unable to start. Browser not connected")
+            elif not self.stop_button.isEnabled():
+                self.run_web_thread()
+        elif command == 'stop':
+            if self.stop_button.isEnabled():
+                self.stop_progress()
+        elif command == 'reload':
+            self.myweb.reload_rules()
+        elif command == 'attach':
+            if self.stop_button.isEnabled():
+                self.stop_progress()
+            self.myweb.end()
+            error = self.attach_browser(args['session'])
+            if error:
+                self.postal.log(error)
+
+    def start_profiler_switch(self):
+        self.profiler = profiler.ProfilerSwitch(lambda: self.myweb.engine_thread,
+                                                self.myweb.profile_tag, log=self.postal.log)
+        self.profiler.install_signal()
+
+        # Python signal handlers only run when the interpreter gets control
+        self.signal_timer = QTimer()
+        self.signal_timer.timeout.connect(lambda: None)
+        self.signal_timer.start(500)
+
+    def start_session_pool(self):
+        if not sessions.pool_enabled():
+            return
+        self.session_pool = sessions.SessionPool(log=self.postal.log)
+        self.session_pool.start()
+        self.myweb.session_provider = self.acquire_pooled_driver
+        self.postal.log(f'Session pool started with {self.session_pool.size} warm browser(s)')
+
     def read_config(self):
         try:
             settings.init()
             cookies.init()
+            if settings.Config.getboolean('web', 'watch_config', fallback=False):
+                settings.watch(self.config_file_changed)
+                cookies.watch(self.config_file_changed)
         except KeyError as err:
             msg = f'ERROR: {err} is not defined in setting file'
             self.postal.log(msg)
@@ -103,6 +199,10 @@ class Window(QDialog):
         except FileNotFoundError as err:
             self.postal.log(f'ERROR openning ini file: {err}')
 
+    def config_file_changed(self, path):
+        # called from the file watcher thread, hand over to the GUI thread
+        self.web_queue.put(('config', path))
+
     def set_app_title(self):
         project = settings.Config.get('web', 'project', fallback='untitled')
         self.setWindowTitle(f"{AppName} [{project}]")
@@ -181,17 +281,20 @@ class Window(QDialog):
         clear_action = QAction("Clear system log", self)
         clear_action.triggered.connect(self.clear_log_window)
         menu.addAction(clear_action)
+        profile_action = QAction("Profile engine thread", self)
+        profile_action.setCheckable(True)
+        profile_action.setChecked(self.profiler.profiler is not None)
+        profile_action.triggered.connect(self.profiler.toggle)
+        menu.addAction(profile_action)
 
         # show the menu
         menu.exec_(self.mapToGlobal(location))
 
     def update_connection_info(self):
-        try:
-            cookies.refresh()
-            info = cookies.Cookies['browser']['session']
+        cookies.refresh()
+        info = cookies.get_session()
+        if info:
             self.connect_settings.setText(info)
-        except KeyError:
-            pass
 
     def web_queue_dispatch(self, mtype, text):
         if mtype == 'log':
@@ -204,6 +307,13 @@ class Window(QDialog):
             self.status_update(text)
         elif mtype == 'progress':
             self.reset_progress_bar(text)
+        elif mtype == 'control':
+            self.run_control(json.loads(text))
+        elif mtype == 'config':
+            self.postal.log(f"'{text}' modified, reloaded")
+            self.set_app_title()
+            if not self.myweb.is_started():
+                self.update_connection_info()
         else:
             raise Exception(f"Unknown queue type {mtype}")
 
@@ -241,7 +351,8 @@ class Window(QDialog):
             if reply == QMessageBox.Yes:
                 settings.refresh()
 
-        if self.myweb.check_rule_file_modified():
+        # with hot reload on, rule changes are picked up while running
+        if self.myweb.rule_watch is None and self.myweb.check_rule_file_modified():
             if self.myweb.rule_data:
                 msg = 'JSON file has been modified. Reload it?'
             else:
@@ -253,7 +364,24 @@ class Window(QDialog):
                 if not self.myweb.load_rules() and self.myweb.rule_data:
                     self.postal.log("Continue with previously loaded JSON data")
 
+        self.run_web_thread()
+
+    def run_web_thread(self):
+        previous = self.web_thread
+        if self.myweb.rule_data and previous is not None and previous.isRunning():
+            # start once the previous run lets go of the browser, the GUI carries on meanwhile
+            if not self.start_pending:
+                self.start_pending = True
+                previous.finished.connect(self.start_after_previous)
+                self.postal.log("Previous run still busy with the browser, starting when it's done")
+                if previous.isFinished():
+                    QTimer.singleShot(0, self.start_after_previous)     # finished just now
+            self.start_button.setDisabled(True)
+            self.stop_button.setDisabled(False)
+            return
+
         if self.myweb.rule_data:
+            self.myweb.reset_stop()
             self.myweb.clear()
             self.myweb.pause(False)
             self.web_thread = WebThread(self.myweb)
@@ -265,14 +393,27 @@ class Window(QDialog):
         else:
             self.postal.log("Unable to start. JSON data not loaded")
 
+    def start_after_previous(self):
+        if not self.start_pending:
+            return      # stopped again before the previous run was done
+        self.start_pending = False
+        self.run_web_thread()
+
     def stop_progress_bar(self):
         self.progress_enabled = False
         self.timer.stop()
 
+    def wait_web_thread(self, msecs):
+        if self.web_thread is None:
+            return True
+        return self.web_thread.wait(msecs)
+
     def stop_progress(self):
-        self.myweb.pause()
-        self.web_thread.terminate()
-        self.web_thread.wait()
+        self.start_pending = False
+        self.myweb.request_stop()
+        if not self.wait_web_thread(StopLatency):
+            # a browser command is still in flight, the thread exits right after it
+            self.postal.log("Waiting for current browser command to finish")
         self.stop_progress_bar()
         self.start_button.setDisabled(False)
         self.stop_button.setDisabled(True)
@@ -315,6 +456,9 @@ class Window(QDialog):
             if reply != QMessageBox.Yes:
                 return
 
+        if self.session_pool and self.launch_pooled_browser():
+            return
+
         cmd = f'{sys.executable} web.py'
         process = QProcess()
 
@@ -340,6 +484,35 @@ class Window(QDialog):
         process.start(cmd)
         self.browser_process = process
 
+    def acquire_pooled_driver(self):
+        # used by the watchdog to replace a dead session, runs in the web thread
+        session = self.session_pool.acquire(timeout=60)
+        if session is None:
+            raise Exception('no browser available in session pool')
+        if self.pooled_session:
+            self.session_pool.release(self.pooled_session, healthy=False)
+        self.pooled_session = session
+        return session.driver
+
+    def launch_pooled_browser(self):
+        session = self.session_pool.acquire(timeout=0)
+        if session is None:
+            self.postal.log('No warm browser in pool, starting new browser')
+            return False
+
+        # a relaunch means the previous session is no longer wanted
+        if self.pooled_session:
+            self.session_pool.release(self.pooled_session, healthy=False)
+        self.pooled_session = session
+
+        self.myweb.end()
+        self.connect_settings.setText(session.connection())
+        self.connect_browser()
+        self.start_button.setDisabled(False)
+        self.postal.log('Browser started')
+        self.start_progress()
+        return True
+
     def connect_browser(self):
         if self.myweb.is_started():
             reply = QMessageBox.question(self, 'Connect Browser',
@@ -350,19 +523,23 @@ class Window(QDialog):
 
             self.myweb.end()
 
-        conn_string = self.connect_settings.text()
-        rv = re.match(r"(http://\d+\.\d+\.\d+\.\d+:\d+)\s+([\w\-]+)", conn_string)
-        if rv:
-            exe_url, session_id = rv.groups()
-            try:
-                self.myweb.start([exe_url, session_id])
-                self.update_connection_info()
-                self.start_button.setDisabled(False)
-            except ConnectionError:
-                QMessageBox.warning(self, 'Connection Error',
-                                    "Unable to connect. Please check to ensure remote session is active.")
-        else:
-            QMessageBox.warning(self, 'Connection Error', "Invalid connection setting. Please verify.")
+        error = self.attach_browser(self.connect_settings.text())
+        if error:
+            QMessageBox.warning(self, 'Connection Error', error)
+
+    def attach_browser(self, conn_string):
+        rv = re.match(r"((?:http|cdp)://\d+\.\d+\.\d+\.\d+:\d+)\s+([\w\-]+)", conn_string)
+        if not rv:
+            return "Invalid connection setting. Please verify."
+
+        exe_url, session_id = rv.groups()
+        try:
+            self.myweb.start([exe_url, session_id])
+        except ConnectionError:
+            return "Unable to connect. Please check to ensure remote session is active."
+        self.update_connection_info()
+        self.start_button.setDisabled(False)
+        return None
 
     def closeEvent(self, event):
         if self.myweb.is_started():
@@ -371,12 +548,26 @@ class Window(QDialog):
                                          QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
             if reply == QMessageBox.Yes:
                 self.myweb.end()
+                self.profiler.stop()
+                self.stop_api()
+                self.stop_session_pool()
                 event.accept()
             else:
                 event.ignore()
         else:
+            self.profiler.stop()
+            self.stop_api()
+            self.stop_session_pool()
             event.accept()
 
+    def stop_api(self):
+        if self.api_server:
+            self.api_server.stop()
+
+    def stop_session_pool(self):
+        if self.session_pool:
+            self.session_pool.stop()
+
 
 def startwindow():
     app = QApplication(sys.argv)
@@ -0,0 +1,464 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# Supervisor for running several MyWeb workers, each driving its own
+# browser session in a separate process. Workers are defined in app.ini:
+#
+#   [workers]
+#   min_free_mb = 512       ; don't spawn a worker below this much free memory
+#   restart = yes           ; restart crashed/alerted workers automatically
+#   max_restarts = 5
+#   status_interval = 10    ; seconds between status reports (CLI)
+#   state_interval = 1      ; seconds between engine state reports (dashboard)
+#
+#   [worker.account1]
+#   rulefile = ~/rules/account1.json
+#   browser = chrome1       ; browser config section, defaults to [web] browser
+#   rules = Rule A, Rule B  ; optional subset of rules in the file
+#
+# When a session pool is configured (see sessions.py), workers are handed
+# warm browser sessions from the pool instead of launching their own.
+#
+# With a coordinator (see coordinator.py), the [worker.*] sections are
+# registered centrally instead, and this host runs the rule sets it leases.
+#
+
+import os
+import sys
+import time
+import signal
+import threading
+import sqlite3
+import json
+import traceback
+import multiprocessing
+from queue import Empty
+from datetime import datetime
+
+import settings
+import cookies
+import sessions
+import profiler
+import coordinator
+
+WorkerSectionPrefix = 'worker.'
+
+
+class QueuePostal(object):
+    # same interface as windows.Postal, but posts to the supervisor queue
+    def __init__(self, name, queue):
+        self.name = name
+        self.queue = queue
+
+    def log(self, text, timed=True):
+        text = str(text).rstrip()
+        if timed:
+            tm = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            msg = f"[{tm}] {text}\n"
+        else:
+            msg = text
+
+        self.queue.put((self.name, 'log', msg))
+
+    def status(self, text):
+        self.queue.put((self.name, 'status', text))
+
+    def countdown(self, seconds):
+        self.queue.put((self.name, 'progress', f"{seconds}\n"))
+
+    def alert(self):
+        self.queue.put((self.name, 'alert', 'stop'))
+
+    def state(self, snapshot):
+        self.queue.put((self.name, 'state', json.dumps(snapshot, default=str)))
+
+
+def worker_main(name, options, queue, stop_event, cpus=None):
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+
+    # ignore Ctrl-C, the supervisor stops us via stop_event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    postal = QueuePostal(name, queue)
+    try:
+        settings.init()
+        cookies.init()
+
+        # per-worker overrides, applied to this process' copy of the config only
+        if options.get('rulefile'):
+            settings.Config.set('rules', 'rulefile', os.path.expanduser(options['rulefile']))
+        if options.get('browser'):
+            settings.Config.set('web', 'browser', options['browser'])
+        if options.get('flags_database'):
+            # flags shared with the other nodes through the coordinator database,
+            # the rule set's own namespace keeps them apart from other rule sets
+            if not settings.Config.has_section('flags'):
+                settings.Config.add_section('flags')
+            settings.Config.set('flags', 'persist', 'yes')
+            settings.Config.set('flags', 'database', options['flags_database'])
+            settings.Config.set('flags', 'journal_mode', 'DELETE')
+            settings.Config.set('flags', 'namespace', name)
+        rule_filter = [r.strip() for r in options.get('rules', '').split(',') if r.strip()]
+
+        from web import MyWeb
+        myweb = MyWeb(postal, rule_filter=rule_filter or None, session_name=name)
+        if not myweb.rule_data:
+            postal.log("Unable to start. JSON data not loaded")
+            sys.exit(2)
+
+        # sessions handed over by the supervisor's pool are owned by the pool
+        pooled = bool(options.get('session'))
+        if pooled:
+            myweb.start(options['session'].split())
+        else:
+            myweb.start()
+        myweb.clear()
+        myweb.pause(False)
+        postal.log("Control started")
+
+        # 'kill -USR1 <pid>' toggles the profiler on the rule loop
+        profile = profiler.ProfilerSwitch(lambda: myweb.engine_thread, myweb.profile_tag,
+                                          name=name, log=postal.log)
+        profile.install_signal()
+
+        # pass the supervisor's stop on to the rule loop, so waits end early
+        def relay_stop():
+            stop_event.wait()
+            myweb.request_stop()
+        threading.Thread(target=relay_stop, daemon=True).start()
+
+        state_interval = settings.Config.getfloat('workers', 'state_interval', fallback=1)
+        last_state = 0
+        try:
+            while not myweb.stop_event.is_set():
+                myweb.check()
+                if time.time() - last_state >= state_interval:
+                    postal.state(myweb.snapshot())
+                    last_state = time.time()
+                myweb.stop_event.wait(0.1)
+        finally:
+            myweb.engine_done()
+
+        profile.stop()
+        postal.state(myweb.snapshot())      # final command count, for the pool
+        myweb.end(quit_session=not pooled)
+        postal.log("Control stopped")
+    except SystemExit:
+        raise
+    except Exception as error:
+        postal.log(f'Worker crashed: {type(error).__name__}: {error}')
+        postal.log(traceback.format_exc())
+        sys.exit(1)
+
+
+def free_memory_mb():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class WorkerInfo(object):
+    def __init__(self, name, options):
+        self.name = name
+        self.options = options
+        self.process = None
+        self.stop_event = None
+        self.cpus = None
+        self.state = 'idle'
+        self.status = ''
+        self.last_log = ''
+        self.restarts = 0
+        self.started = None
+        self.countdown = 0
+        self.session = None
+        self.engine = {}        # latest MyWeb.snapshot() of the worker
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+
+class Supervisor(object):
+    def __init__(self, context=None):
+        self.mp = context or multiprocessing.get_context('spawn')
+        self.queue = self.mp.Queue()
+        self.workers = {}
+        self.listeners = []
+        self.pool = None
+        self.coordinator = None
+        self.coordinated = 0
+        self.config_changed = False
+        try:
+            self.cpus = sorted(os.sched_getaffinity(0))
+        except AttributeError:
+            self.cpus = list(range(os.cpu_count() or 1))
+
+    def load_config(self):
+        for section in settings.Config.sections():
+            if not section.startswith(WorkerSectionPrefix):
+                continue
+            name = section[len(WorkerSectionPrefix):]
+            options = dict(settings.Config[section])
+            if self.coordinator:
+                self.coordinator.register_ruleset(name, options)
+            elif name in self.workers:
+                self.workers[name].options = options
+            else:
+                self.workers[name] = WorkerInfo(name, options)
+
+    def connect(self, handler):
+        # handler(name, mtype, text) receives every message from the workers
+        self.listeners.append(handler)
+
+    def log(self, text):
+        for handler in self.listeners:
+            handler('supervisor', 'log', text)
+
+    def sync_leases(self):
+        try:
+            leased = self.coordinator.heartbeat()
+        except sqlite3.Error as error:
+            self.log(f'ERROR reaching coordinator: {error}')
+            if time.time() - self.coordinated > self.coordinator.lease_seconds:
+                # our leases have expired, other nodes may be running them by now
+                leased = {}
+            else:
+                return
+        else:
+            self.coordinated = time.time()
+
+        for name in list(self.workers):
+            if name not in leased:
+                self.log(f"Lease on '{name}' lost, stopping worker")
+                self.stop_worker(name)
+                del self.workers[name]
+
+        for name, options in leased.items():
+            if self.coordinator.share_flags:
+                options = dict(options, flags_database=self.coordinator.path)
+            worker = self.workers.get(name)
+            if worker is None:
+                self.log(f"Leased '{name}', starting worker")
+                self.workers[name] = WorkerInfo(name, options)
+                self.start_worker(name)
+            else:
+                worker.options = options    # used from the next restart
+
+    def place(self, worker):
+        # pin the worker to the least used CPU
+        usage = {cpu: 0 for cpu in self.cpus}
+        for w in self.workers.values():
+            if w is not worker and w.is_alive() and w.cpus:
+                for cpu in w.cpus:
+                    if cpu in usage:
+                        usage[cpu] += 1
+        cpu = min(usage, key=lambda c: (usage[c], c))
+        return {cpu}
+
+    def start_worker(self, name):
+        worker = self.workers[name]
+        if worker.is_alive():
+            return True
+
+        min_free = settings.Config.getint('workers', 'min_free_mb', fallback=512)
+        free = free_memory_mb()
+        if free is not None and free < min_free:
+            worker.state = 'waiting'
+            worker.status = f'Waiting for memory ({free}MB free, need {min_free}MB)'
+            return False
+
+        options = dict(worker.options)
+        if self.pool and not options.get('session'):
+            worker.session = self.pool.acquire(timeout=0)
+            if worker.session is None:
+                worker.state = 'waiting'
+                worker.status = 'Waiting for a browser session from the pool'
+                return False
+            options['session'] = worker.session.connection()
+
+        worker.cpus = self.place(worker)
+        worker.stop_event = self.mp.Event()
+        worker.process = self.mp.Process(target=worker_main, name=f'{settings.AppName}-{name}',
+                                         args=(name, options, self.queue,
+                                               worker.stop_event, worker.cpus))
+        worker.engine = {}
+        worker.process.start()
+        worker.state = 'running'
+        worker.started = time.time()
+        return True
+
+    def stop_worker(self, name, timeout=15):
+        worker = self.workers[name]
+        if not worker.is_alive():
+            worker.state = 'stopped'
+            self.release_session(worker)
+            return
+
+        worker.stop_event.set()
+        worker.process.join(timeout)
+        if worker.process.is_alive():
+            worker.process.terminate()
+            worker.process.join()
+        worker.state = 'stopped'
+        self.drain()    # its last messages, the final command count among them
+        self.release_session(worker)
+
+    def release_session(self, worker):
+        if worker.session:
+            # an alerted or crashed worker may have left the browser in a bad state,
+            # and a recovered one has already quit it and run on a browser of its own
+            healthy = worker.state == 'stopped' and worker.process is not None \
+                and worker.process.exitcode == 0 and not worker.engine.get('recoveries')
+            self.pool.release(worker.session, healthy=healthy,
+                              commands=worker.engine.get('commands', 0))
+            worker.session = None
+
+    def restart_worker(self, name):
+        self.stop_worker(name)
+        self.workers[name].restarts += 1
+        return self.start_worker(name)
+
+    def watch_config(self):
+        # new [worker.*] sections are picked up without restarting the supervisor
+        def changed(path):
+            self.config_changed = True
+        settings.watch(changed)
+
+    def start(self):
+        if coordinator.enabled():
+            self.coordinator = coordinator.Coordinator()
+        self.load_config()
+        if sessions.pool_enabled():
+            self.pool = sessions.SessionPool()
+            self.pool.start()
+        if self.coordinator:
+            self.sync_leases()
+        for name in self.workers:
+            self.start_worker(name)
+
+    def stop(self):
+        for name in self.workers:
+            if self.workers[name].is_alive():
+                self.workers[name].stop_event.set()
+        for name in self.workers:
+            self.stop_worker(name)
+        if self.pool:
+            self.pool.stop()
+        if self.coordinator:
+            try:
+                self.coordinator.leave()
+            except sqlite3.Error as error:
+                # the leases expire on their own
+                self.log(f'ERROR leaving coordinator: {error}')
+            self.coordinator.close()
+
+    def dispatch(self, name, mtype, text):
+        worker = self.workers.get(name)
+        if worker is None:
+            return
+
+        if mtype == 'log':
+            worker.last_log = text.strip()
+        elif mtype == 'status':
+            worker.status = text
+        elif mtype == 'progress':
+            worker.countdown = int(text)
+        elif mtype == 'state':
+            worker.engine = json.loads(text)
+        elif mtype == 'alert':
+            worker.state = 'alert'
+            worker.stop_event.set()
+
+        for handler in self.listeners:
+            handler(name, mtype, text)
+
+    def drain(self, timeout=0):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                name, mtype, text = self.queue.get(timeout=max(0.0, deadline - time.time()))
+                self.dispatch(name, mtype, text)
+            except Empty:
+                break
+
+    def poll(self, timeout=0.5):
+        # drain the message queue, then look after dead or waiting workers
+        self.drain(timeout)
+
+        if self.config_changed:
+            self.config_changed = False
+            self.load_config()
+            for name, worker in self.workers.items():
+                if worker.state == 'idle':
+                    self.start_worker(name)
+
+        if self.coordinator and self.coordinator.heartbeat_due():
+            self.sync_leases()
+
+        auto_restart = settings.Config.getboolean('workers', 'restart', fallback=True)
+        max_restarts = settings.Config.getint('workers', 'max_restarts', fallback=5)
+        for name, worker in self.workers.items():
+            if worker.state == 'waiting':
+                self.start_worker(name)
+            elif worker.state in ('running', 'alert') and not worker.is_alive():
+                worker.state = 'exited'
+                self.release_session(worker)
+                if auto_restart and worker.restarts < max_restarts:
+                    worker.restarts += 1
+                    self.start_worker(name)
+
+    def status(self):
+        return [{
+            'name': w.name,
+            'state': w.state,
+            'pid': w.process.pid if w.process else None,
+            'cpus': sorted(w.cpus) if w.cpus else [],
+            'restarts': w.restarts,
+            'uptime': int(time.time() - w.started) if w.is_alive() else 0,
+            'countdown': w.countdown,
+            'status': w.status,
+            'last_log': w.last_log,
+            'engine': w.engine,
+        } for w in self.workers.values()]
+
+
+def print_status(supervisor):
+    tm = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f'[{tm}] {len(supervisor.workers)} worker(s)')
+    for st in supervisor.status():
+        print(f"  {st['name']:<16} {st['state']:<8} pid={st['pid']} cpus={st['cpus']} "
+              f"restarts={st['restarts']} uptime={st['uptime']}s | {st['status']}")
+
+
+if __name__ == '__main__':
+    settings.init()
+    cookies.init()
+    supervisor = Supervisor()
+    supervisor.connect(lambda name, mtype, text: name == 'supervisor' and print(text))
+    supervisor.watch_config()
+    supervisor.start()
+    if not supervisor.workers and not supervisor.coordinator:
+        print(f"ERROR: no '[{WorkerSectionPrefix}<name>]' sections defined in {settings.Configfile}")
+        sys.exit(1)
+
+    interval = settings.Config.getint('workers', 'status_interval', fallback=10)
+    last_report = 0
+    try:
+        while True:
+            supervisor.poll()
+            if time.time() - last_report >= interval:
+                print_status(supervisor)
+                last_report = time.time()
+    except KeyboardInterrupt:
+        print('Stopping workers...')
+        supervisor.stop()
@@ -0,0 +1,33 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+import os
+import sys
+
+import pytest
+
+# the modules live flat in src/, as the app runs them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import settings     # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def config():
+    # each test starts from an empty app.ini, and can fill in what it needs
+    saved = {s: dict(settings.Config[s]) for s in settings.Config.sections()}
+    settings.Config.clear()
+    yield settings.Config
+    settings.Config.clear()
+    settings.Config.read_dict(saved)
+
+
+@pytest.fixture
+def qapp():
+    QtWidgets = pytest.importorskip('PyQt5.QtWidgets')
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
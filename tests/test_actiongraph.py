@@ -0,0 +1,111 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+import time
+import threading
+
+import pytest
+
+pytest.importorskip('PyQt5')
+
+from actiongraph import ActionGraph     # noqa: E402
+from clock import VirtualClock          # noqa: E402
+from rules import Rules                 # noqa: E402
+from utils import Cancelled             # noqa: E402
+
+
+def record(graph):
+    infos = []
+    graph.connect(lambda kind, text: infos.append((kind, text)))
+    return infos
+
+
+def test_runs_on_the_critical_path():
+    clock = VirtualClock()
+    graph = ActionGraph(clock=clock)
+    graph.add('login', lambda: 'token', initwait=1)
+    graph.add('orders', lambda: 2, after=['login'], initwait=2)
+    graph.add('prices', lambda: 3, after=['login'], initwait=5)
+    graph.add('report', lambda orders, prices: orders * prices, after=['orders', 'prices'],
+              results=True)
+    infos = record(graph)
+
+    assert graph.run()
+    assert graph.nodes['report'].result == 6
+    assert clock.elapsed() == 6     # login, then the longer of the two branches
+    assert [n.state for n in graph.nodes.values()] == ['done'] * 4
+    assert infos[-1][0] == 'timing' and 'finished in 6.00s' in infos[-1][1]
+    # login, then orders; prices is due at 6 once orders has gone
+    assert [text for kind, text in infos if kind == 'initwait'] == ['1', '2', '3']
+
+
+def test_failure_blocks_dependents():
+    graph = ActionGraph(clock=VirtualClock())
+    ran = []
+
+    def fail():
+        raise ValueError('no login')
+
+    graph.add('login', fail)
+    graph.add('orders', lambda: ran.append('orders'), after=['login'])
+    graph.add('other', lambda: ran.append('other'))
+    with pytest.raises(ValueError):
+        graph.run()
+    assert ran == ['other']
+    assert graph.nodes['orders'].state == 'blocked'
+
+
+def test_check_rejects_cycles_and_unknown_actions():
+    graph = ActionGraph(clock=VirtualClock())
+    graph.add('a', lambda: None, after=['b'])
+    graph.add('b', lambda: None, after=['a'])
+    with pytest.raises(Exception, match='Cycle'):
+        graph.run()
+
+    graph = ActionGraph(clock=VirtualClock())
+    graph.add('a', lambda: None, after=['missing'])
+    with pytest.raises(Exception, match='unknown action'):
+        graph.run()
+
+
+def test_stop_does_not_wait_forever_on_stuck_actions():
+    stop_event = threading.Event()
+    release = threading.Event()
+    graph = ActionGraph(stop_event=stop_event, clock=VirtualClock(), drain_timeout=0.2)
+
+    def stuck():
+        stop_event.set()
+        release.wait(10)
+
+    graph.add('stuck', stuck)
+    graph.add('later', lambda: None, after=['stuck'])
+    infos = record(graph)
+
+    started = time.monotonic()
+    try:
+        with pytest.raises(Cancelled):
+            graph.run()
+        assert time.monotonic() - started < 5
+    finally:
+        release.set()
+    assert ('status', 'Action graph stopped, still running: stuck') in infos
+    assert graph.nodes['later'].state == 'pending'
+
+
+def test_rules_pass_their_stop_event_and_clock():
+    stop_event = threading.Event()
+    clock = VirtualClock()
+    graph = ActionGraph()
+    graph.add('first', stop_event.set, initwait=1)
+    graph.add('second', lambda: None, after=['first'], initwait=1)
+    rules = Rules(stop_event, clock)
+    rules.add(lambda: True, 'graph', graph)
+
+    assert graph.stop_event is stop_event and graph.clock is clock
+    assert rules.run() is False
+    assert graph.nodes['second'].state == 'waiting'
+    assert clock.elapsed() == 1
@@ -0,0 +1,87 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+import api
+
+
+@pytest.fixture
+def server():
+    commands = []
+    server = api.ControlServer(api.EventHub(), lambda: {'rule': 'A'}, lambda: {'count': 1},
+                               lambda command, args: commands.append((command, args)),
+                               host='127.0.0.1', port=0, token='secret')
+    server.commands = commands
+    server.start()
+    yield server
+    server.stop()
+
+
+def call(server, path, body=None, headers=None, token='secret'):
+    headers = dict(headers or {})
+    if token:
+        headers['X-Selmate-Token'] = token
+    if body is not None and 'Content-Type' not in headers:
+        headers['Content-Type'] = 'application/json'
+    request = urllib.request.Request(server.url() + path, headers=headers,
+                                     data=body.encode() if body is not None else None)
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read())
+
+
+def test_status_and_flags(server):
+    assert call(server, '/status') == (200, {'rule': 'A'})
+    assert call(server, '/flags?token=secret', token=None) == (200, {'count': 1})
+    assert call(server, '/nope')[0] == 404
+
+
+def test_control(server):
+    assert call(server, '/control/stop', '{}') == (202, {'accepted': 'stop'})
+    assert call(server, '/control/attach', '{}')[0] == 400
+    assert call(server, '/control/attach', '{"session": "http://x 1"}')[0] == 202
+    assert call(server, '/control/start', 'not json')[0] == 400
+    assert call(server, '/control/explode', '{}')[0] == 404
+    assert server.commands == [('stop', {}), ('attach', {'session': 'http://x 1'})]
+
+
+def test_rejects_bad_tokens(server):
+    assert call(server, '/status', token=None)[0] == 401
+    assert call(server, '/status', token='secreT')[0] == 401
+    assert call(server, '/control/stop', '{}', token='wrong')[0] == 401
+    assert server.commands == []
+
+
+def test_rejects_browser_pages(server):
+    # what a page in the automated browser could send without a preflight
+    plain = {'Content-Type': 'text/plain'}
+    assert call(server, '/control/stop', '{}', headers=plain)[0] == 415
+    evil = {'Origin': 'http://evil.example'}
+    assert call(server, '/control/stop', '{}', headers=evil)[0] == 403
+    assert call(server, '/status', headers={'Origin': 'http://127.0.0.1:1'})[0] == 403
+    assert call(server, '/status', headers={'Origin': server.url()})[0] == 200
+    assert server.commands == []
+
+
+def test_token_needed_off_loopback():
+    with pytest.raises(Exception, match='needs a token'):
+        api.ControlServer(api.EventHub(), dict, dict, print, host='0.0.0.0', port=0, token='')
+
+
+def test_hub_numbers_each_message():
+    hub = api.EventHub()
+    assert hub.last('progress', '0') == ('0', 0)
+    hub.publish('progress', '30')
+    hub.publish('progress', '30')
+    assert hub.last('progress') == ('30', 2)
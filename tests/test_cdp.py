@@ -0,0 +1,386 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+#
+# CdpDriver against a stub DevTools server: the HTTP /json endpoints plus a
+# websocket that answers the CDP methods the driver uses, over a tiny fake
+# page with a frame and a button that opens an alert.
+#
+
+import os
+import json
+import base64
+import struct
+import hashlib
+import itertools
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+pytest.importorskip('websocket')
+pytest.importorskip('selenium')
+
+import cdp      # noqa: E402
+from selenium.common.exceptions import (    # noqa: E402
+    NoAlertPresentException, NoSuchElementException,
+    TimeoutException as SeleniumTimeoutException, WebDriverException,
+)
+
+WebSocketGUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+ScriptHead, ScriptTail = cdp.SCRIPT_JS.split('%s')
+
+
+class Node(object):
+    def __init__(self, tag, text='', url=None, children=(), onclick=None):
+        self.tag = tag
+        self.text = text
+        self.url = url              # frames: the url of their document
+        self.children = list(children)
+        self.onclick = onclick
+
+    def walk(self):
+        for child in self.children:
+            yield child
+            yield from child.walk()
+
+
+class StubPage(object):
+    # what the stub browser shows, and how it reacts to CDP calls
+    def __init__(self):
+        self.url = 'about:blank'
+        self.title = ''
+        self.hang = False
+        self.blocked = None
+        self.clicks = []
+        self.targets = ['T1']
+        self.inner = Node('html', children=[Node('button', 'In frame', onclick='click')])
+        self.document = Node('html', children=[
+            Node('h1', 'Stub'),
+            Node('button', 'Alert', onclick='alert'),
+            Node('frame', url='http://stub/inner', children=[]),
+        ])
+
+    def frame_document(self, node):
+        return self.inner if node.tag == 'frame' else None
+
+
+class StubSession(object):
+    def __init__(self, page, send):
+        self.page = page
+        self.send = send
+        self.objects = {}
+        self.ids = itertools.count(1)
+        self.context = itertools.count(1)
+
+    def ref(self, value):
+        if isinstance(value, Node):
+            object_id = f'node-{next(self.ids)}'
+            self.objects[object_id] = value
+            return {'type': 'object', 'subtype': 'node', 'objectId': object_id}
+        if isinstance(value, list):
+            object_id = f'array-{next(self.ids)}'
+            self.objects[object_id] = value
+            return {'type': 'object', 'subtype': 'array', 'objectId': object_id}
+        if value is None:
+            return {'type': 'object', 'subtype': 'null', 'value': None}
+        return {'type': type(value).__name__, 'value': value}
+
+    def arg(self, arg):
+        return self.objects[arg['objectId']] if 'objectId' in arg else arg.get('value')
+
+    def new_context(self):
+        self.send({'method': 'Runtime.executionContextCreated', 'params': {'context': {
+            'id': next(self.context), 'auxData': {'isDefault': True, 'frameId': 'F1'}}}})
+
+    def handle(self, method, params):
+        page = self.page
+        if method in ('Page.enable', 'Network.enable', 'Runtime.releaseObject'):
+            return {}
+        if method == 'Runtime.enable':
+            self.new_context()
+            return {}
+        if method == 'Page.getFrameTree':
+            return {'frameTree': {'frame': {'id': 'F1', 'url': page.url}}}
+        if method == 'Page.navigate':
+            page.url = params['url']
+            page.title = f"Title of {params['url']}"
+            if not page.hang:
+                self.send({'method': 'Runtime.executionContextsCleared', 'params': {}})
+                self.new_context()
+                self.send({'method': 'Page.frameNavigated',
+                           'params': {'frame': {'id': 'F1', 'url': page.url}}})
+                self.send({'method': 'Page.loadEventFired', 'params': {}})
+            return {'frameId': 'F1'}
+        if method == 'Runtime.evaluate':
+            expression = {'location.href': page.url, 'document.title': page.title}
+            return {'result': self.ref(expression[params['expression']])}
+        if method == 'Runtime.getProperties':
+            items = self.objects[params['objectId']]
+            return {'result': [{'name': str(i), 'value': self.ref(v)} for i, v in enumerate(items)]}
+        if method == 'Runtime.callFunctionOn':
+            return self.call_function(params)
+        if method == 'DOM.describeNode':
+            return {'node': {'backendNodeId': id(self.objects[params['objectId']])}}
+        if method == 'Page.handleJavaScriptDialog':
+            self.send({'method': 'Page.javascriptDialogClosed', 'params': {}})
+            return {}
+        if method == 'Network.getCookies':
+            return {'cookies': []}
+        if method == 'Network.setBlockedURLs':
+            page.blocked = params['urls']
+            return {}
+        if method == 'Target.createTarget':
+            page.targets.append(f'T{len(page.targets) + 1}')
+            return {'targetId': page.targets[-1]}
+        raise KeyError(method)
+
+    def call_function(self, params):
+        func = params['functionDeclaration']
+        args = [self.arg(a) for a in params.get('arguments', [])]
+        this = self.objects.get(params.get('objectId'))
+
+        if func == cdp.FIND_JS:
+            root, by, query, many = args
+            doc = self.page.frame_document(root) if root else self.page.document
+            tag = query.lstrip('/') if by == 'xpath' else query
+            found = [n for n in doc.walk() if n.tag == tag]
+            value = found if many else (found[0] if found else None)
+        elif func.startswith(ScriptHead):
+            script = func[len(ScriptHead):-len(ScriptTail)].strip()
+            scripts = {
+                'return document.readyState': lambda: 'complete',
+                'return arguments[0].contentWindow.location.href;': lambda: args[0].url,
+                'return arguments[0] + arguments[1];': lambda: args[0] + args[1],
+                'return arguments[0].textContent;': lambda: args[0].text,
+            }
+            if script == 'arguments[0].click();':
+                return {'result': self.ref(self.click(args[0]))}
+            value = scripts[script]()
+        elif 'this.tagName' in func:
+            value = this.tag
+        elif 'innerText' in func:
+            value = this.text
+        elif 'this.click()' in func:
+            value = self.click(this)
+        else:
+            raise KeyError(func)
+        return {'result': self.ref(value)}
+
+    def click(self, node):
+        self.page.clicks.append(node.text)
+        if node.onclick == 'alert':
+            self.send({'method': 'Page.javascriptDialogOpening',
+                       'params': {'type': 'alert', 'message': f'{node.text} clicked'}})
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        host, port = self.server.server_address[:2]
+        if self.path == '/json/list':
+            self.send_json([{'id': target, 'type': 'page', 'url': self.server.page.url,
+                             'webSocketDebuggerUrl': f'ws://{host}:{port}/devtools/page/{target}'}
+                            for target in self.server.page.targets])
+        elif self.path == '/json/version':
+            self.send_json({'webSocketDebuggerUrl': f'ws://{host}:{port}/devtools/browser'})
+        elif self.path.startswith('/devtools/'):
+            self.serve_websocket()
+        else:
+            self.send_error(404)
+
+    def serve_websocket(self):
+        key = self.headers['Sec-WebSocket-Key']
+        accept = base64.b64encode(hashlib.sha1((key + WebSocketGUID).encode()).digest())
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept.decode())
+        self.end_headers()
+        self.close_connection = True
+
+        lock = threading.Lock()
+
+        def send(msg):
+            payload = json.dumps(msg).encode()
+            length = len(payload)
+            if length < 126:
+                header = struct.pack('!BB', 0x81, length)
+            elif length < 65536:
+                header = struct.pack('!BBH', 0x81, 126, length)
+            else:
+                header = struct.pack('!BBQ', 0x81, 127, length)
+            with lock:
+                self.wfile.write(header + payload)
+                self.wfile.flush()
+
+        session = StubSession(self.server.page, send)
+        self.server.sessions.append(session)
+        while True:
+            payload = self.read_frame()
+            if payload is None:
+                break
+            msg = json.loads(payload)
+            try:
+                send({'id': msg['id'], 'result': session.handle(msg['method'], msg['params'])})
+            except KeyError as error:
+                send({'id': msg['id'], 'error': {'code': -32601,
+                                                 'message': f'{error} wasn\'t found'}})
+
+    def read_frame(self):
+        head = self.rfile.read(2)
+        if len(head) < 2 or head[0] & 0x0f == 0x8:
+            return None
+        length = head[1] & 0x7f
+        if length == 126:
+            length = struct.unpack('!H', self.rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self.rfile.read(8))[0]
+        mask = self.rfile.read(4)
+        data = self.rfile.read(length)
+        return bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.page = StubPage()
+    server.sessions = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def driver(stub):
+    port = stub.server_address[1]
+    driver = cdp.attach_cdp(f'cdp://127.0.0.1:{port}', 'T1', timeout=2)
+    yield driver
+    driver.conn.close()
+
+
+def test_get_navigates_and_waits_for_load(driver, stub):
+    driver.get('http://stub/page')
+    assert driver.current_url == 'http://stub/page'
+    assert driver.title == 'Title of http://stub/page'
+    assert driver.session_id == 'T1'
+    assert driver.command_executor._url.startswith('cdp://')
+
+
+def test_get_times_out_without_load_event(driver, stub):
+    stub.page.hang = True
+    driver.set_page_load_timeout(0.2)
+    with pytest.raises(SeleniumTimeoutException):
+        driver.get('http://stub/slow')
+
+
+def test_execute_script_arguments_and_results(driver):
+    assert driver.execute_script('return document.readyState') == 'complete'
+    assert driver.execute_script('return arguments[0] + arguments[1];', 2, 3) == 5
+    heading = driver.find_element_by_tag_name('h1')
+    assert driver.execute_script('return arguments[0].textContent;', heading) == 'Stub'
+
+
+def test_elements(driver, stub):
+    buttons = driver.find_elements_by_xpath('//button')
+    assert [b.text for b in buttons] == ['Alert']
+    assert buttons[0].tag_name == 'button'
+    assert buttons[0] == driver.find_element_by_xpath('//button')
+    with pytest.raises(NoSuchElementException):
+        driver.find_element_by_xpath('//table')
+    assert driver.find_elements_by_xpath('//table') == []
+
+
+def test_frames(driver, stub):
+    frames = driver.find_elements_by_tag_name('frame')
+    assert len(frames) == 1
+    url = driver.execute_script('return arguments[0].contentWindow.location.href;', frames[0])
+    assert url == 'http://stub/inner'
+
+    driver.switch_to.frame(frames[0])
+    inner = driver.find_element_by_xpath('//button')
+    assert inner.text == 'In frame'
+    inner.click()
+    assert stub.page.clicks == ['In frame']
+
+    driver.switch_to.default_content()
+    assert driver.find_element_by_xpath('//button').text == 'Alert'
+    with pytest.raises(WebDriverException):
+        driver.switch_to.frame(0)
+
+
+def test_dialogs(driver, stub):
+    with pytest.raises(NoAlertPresentException):
+        driver.switch_to.alert
+
+    driver.execute_script('arguments[0].click();', driver.find_element_by_xpath('//button'))
+    alert = driver.switch_to.alert
+    assert alert.text == 'Alert clicked'
+    alert.accept()
+    driver.get_cookies()    # a round trip, the dialog closed event comes before its reply
+    with pytest.raises(NoAlertPresentException):
+        driver.switch_to.alert
+
+
+def test_unknown_target(stub):
+    port = stub.server_address[1]
+    with pytest.raises(WebDriverException):
+        cdp.attach_cdp(f'cdp://127.0.0.1:{port}', 'nope')
+
+
+def test_launch_profile_applied_on_attach(stub, config):
+    config.read_dict({'web': {'browser': 'chromium1'},
+                      'chromium1': {'backend': 'cdp', 'blocked_urls': '*ads.example*',
+                                    'block_css': 'yes', 'page_load_strategy': 'eager'}})
+    port = stub.server_address[1]
+    driver = cdp.attach_cdp(f'cdp://127.0.0.1:{port}', 'T1', timeout=2)
+    try:
+        assert stub.page.blocked[:3] == ['*ads.example*', '*.css', '*.css?*']
+        assert driver.page_load_strategy == 'eager'
+
+        stub.page.blocked = None
+        driver.switch_to.window('T1')       # every attach to a tab blocks again
+        assert stub.page.blocked is not None
+    finally:
+        driver.conn.close()
+
+
+def test_commands_are_counted(driver):
+    before = driver.commands
+    driver.get_cookies()
+    assert driver.commands == before + 1
+
+
+def test_new_window_uses_target_domain(driver):
+    import web
+
+    handle = web.new_window(driver)
+    assert handle == 'T2'
+    assert driver.window_handles == ['T1', 'T2']
+    driver.switch_to.window(handle)
+    assert driver.session_id == 'T2'
+
+
+def test_browser_pid_from_debugging_port(stub):
+    pytest.importorskip('psutil')
+    import memory
+
+    assert memory.listening_pid(stub.server_address[1]) == os.getpid()
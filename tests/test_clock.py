@@ -0,0 +1,57 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+import threading
+
+import pytest
+
+from clock import VirtualClock
+from utils import WaitValue, sleep, Cancelled
+
+
+def test_advance_moves_both_clocks():
+    clock = VirtualClock(start=100.0)
+    clock.advance(2.5)
+    clock.advance(-1)           # never backwards
+    assert clock.time() == clock.monotonic() == 102.5
+    assert clock.elapsed() == 2.5
+
+
+def test_wait_advances_instantly_and_records():
+    clock = VirtualClock()
+    assert clock.wait(30) is False
+    assert clock.wait(5, threading.Event()) is False
+    assert clock.waits == [30, 5] and clock.elapsed() == 35
+
+
+def test_wait_with_a_set_stop_event():
+    clock = VirtualClock()
+    stop_event = threading.Event()
+    stop_event.set()
+    assert clock.wait(30, stop_event) is True
+    assert clock.waits == [] and clock.elapsed() == 0
+
+
+def test_randint_is_deterministic_per_seed():
+    a, b = VirtualClock(seed=7), VirtualClock(seed=7)
+    assert [a.randint(1, 1000) for _ in range(20)] == [b.randint(1, 1000) for _ in range(20)]
+    assert all(1 <= a.randint(1, 3) <= 3 for _ in range(50))
+
+
+def test_wait_values_and_sleep_use_the_clock():
+    a, b = VirtualClock(seed=3), VirtualClock(seed=3)
+    waits = WaitValue(1, 60)
+    assert [waits.value(a) for _ in range(10)] == [waits.value(b) for _ in range(10)]
+
+    clock = VirtualClock()
+    sleep(10, None, clock)
+    assert clock.elapsed() == 10
+    stop_event = threading.Event()
+    stop_event.set()
+    with pytest.raises(Cancelled):
+        sleep(10, stop_event, clock)
+    assert clock.elapsed() == 10
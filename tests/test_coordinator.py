@@ -0,0 +1,119 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+import sqlite3
+
+import pytest
+
+import coordinator
+from clock import VirtualClock
+
+
+@pytest.fixture
+def clock():
+    return VirtualClock(start=1000)
+
+
+@pytest.fixture
+def node(tmp_path, clock):
+    nodes = []
+
+    def make(name, slots=4):
+        c = coordinator.Coordinator(path=str(tmp_path / 'coordinator.db'), node=name,
+                                    slots=slots, lease_seconds=30, clock=clock)
+        nodes.append(c)
+        return c
+
+    yield make
+    for c in nodes:
+        c.close()
+
+
+def register(c, *names):
+    for name in names:
+        c.register_ruleset(name, {'rulefile': f'{name}.json'})
+
+
+def test_acquire_and_renew(node, clock):
+    a = node('a')
+    register(a, 'r1', 'r2', 'r3')
+    leased = a.heartbeat()
+    assert sorted(leased) == ['r1', 'r2', 'r3']
+    assert leased['r1'] == {'rulefile': 'r1.json'}
+
+    clock.advance(20)
+    assert sorted(a.heartbeat()) == ['r1', 'r2', 'r3']
+    clock.advance(20)       # past the first lease, renewed by the second heartbeat
+    assert sorted(a.heartbeat()) == ['r1', 'r2', 'r3']
+    assert a.status()['unassigned'] == []
+
+
+def test_slots_limit_leases(node):
+    a = node('a', slots=2)
+    register(a, 'r1', 'r2', 'r3')
+    assert sorted(a.heartbeat()) == ['r1', 'r2']
+    assert a.status()['unassigned'] == ['r3']
+
+
+def test_expired_leases_are_taken_over(node, clock):
+    a, b = node('a'), node('b')
+    register(a, 'r1', 'r2')
+    assert sorted(a.heartbeat()) == ['r1', 'r2']
+    assert b.heartbeat() == {}
+
+    clock.advance(31)       # 'a' stopped heartbeating
+    assert sorted(b.heartbeat()) == ['r1', 'r2']
+    status = b.status()
+    assert [n['alive'] for n in status['nodes']] == [False, True]
+
+
+def test_rebalance_between_nodes(node):
+    a, b = node('a'), node('b')
+    register(a, 'r1', 'r2', 'r3', 'r4')
+    assert len(a.heartbeat()) == 4
+    assert b.heartbeat() == {}          # nothing free yet
+    assert sorted(a.heartbeat()) == ['r1', 'r2']
+    assert sorted(b.heartbeat()) == ['r3', 'r4']
+    assert sorted(a.heartbeat()) == ['r1', 'r2']
+
+
+def test_leave_hands_over_at_once(node):
+    a, b = node('a'), node('b')
+    register(a, 'r1', 'r2')
+    a.heartbeat()
+    a.leave()
+    assert sorted(b.heartbeat()) == ['r1', 'r2']
+    assert [n['name'] for n in b.status()['nodes']] == ['b']
+
+
+def test_unregister_drops_the_lease(node):
+    a = node('a')
+    register(a, 'r1', 'r2')
+    a.heartbeat()
+    a.unregister_ruleset('r2')
+    assert sorted(a.heartbeat()) == ['r1']
+
+
+class LockedCoordinator(object):
+    closed = False
+
+    def leave(self):
+        raise sqlite3.OperationalError('database is locked')
+
+    def close(self):
+        self.closed = True
+
+
+def test_supervisor_stop_survives_a_locked_database():
+    workers = pytest.importorskip('workers')
+    supervisor = workers.Supervisor()
+    supervisor.coordinator = LockedCoordinator()
+    logged = []
+    supervisor.connect(lambda name, mtype, text: logged.append(text))
+    supervisor.stop()
+    assert supervisor.coordinator.closed
+    assert logged == ['ERROR leaving coordinator: database is locked']
@@ -0,0 +1,92 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+import json
+import time
+import threading
+
+import pytest
+
+pytest.importorskip('PyQt5')
+
+import dashboard    # noqa: E402
+
+
+def test_engine_created_once_across_threads():
+    board = dashboard.EngineBoard(log_lines=10)
+    start = threading.Barrier(8)
+    seen = []
+
+    def feed():
+        start.wait()
+        seen.append(board.engine('w1', 'local'))
+
+    threads = [threading.Thread(target=feed) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set(map(id, seen))) == 1
+    assert board.all_engines() == [seen[0]]
+
+
+def test_handle_updates_engine():
+    board = dashboard.EngineBoard(log_lines=2)
+    board.handle('w1', 'log', 'one\n')
+    board.handle('w1', 'log', 'ERROR two')
+    board.handle('w1', 'log', 'three')
+    board.handle('w1', 'state', json.dumps({'rule': 'A', 'passes': 5}))
+    board.handle('supervisor', 'status', 'ok')
+    engine = board.engine('w1', 'local')
+    assert list(engine.logs) == ['ERROR two', 'three'] and engine.log_total == 3
+    assert engine.last_error == 'ERROR two' and engine.rule == 'A'
+    assert board.take_changes() == (['(supervisor)', 'w1'], {'(supervisor)', 'w1'})
+    assert board.take_changes() == (['(supervisor)', 'w1'], set())
+
+
+def test_remote_countdown_rearms_on_a_new_message_only():
+    board = dashboard.EngineBoard(log_lines=10)
+    url = 'http://w1:8765'
+    board.update_remote(url, {'running': True, 'countdown': '30', 'countdown_seq': 4})
+    engine = board.engine(url, url)
+    assert engine.countdown_end > 0
+
+    engine.countdown_end = 0        # ran out, the remote still reports the same message
+    board.update_remote(url, {'running': True, 'countdown': '30', 'countdown_seq': 4})
+    assert engine.countdown_end == 0
+
+    board.update_remote(url, {'running': True, 'countdown': '5', 'countdown_seq': 5})
+    assert 0 < engine.countdown(time.time()) <= 5
+
+
+def test_row_runs():
+    assert dashboard.row_runs([]) == []
+    assert dashboard.row_runs([5, 0, 1, 3, 1, 4]) == [(0, 1), (3, 5)]
+
+
+def test_model_refresh_emits_changed_rows_only(qapp):
+    board = dashboard.EngineBoard(log_lines=10)
+    for name in ('a', 'b', 'c', 'd', 'e'):
+        board.engine(name, 'local')
+    model = dashboard.EngineTableModel(board)
+    resets = []
+    changed = []
+    model.modelReset.connect(lambda: resets.append(True))
+    model.dataChanged.connect(lambda first, last, roles=None: changed.append((first.row(), last.row())))
+
+    model.refresh()
+    assert resets and model.rowCount() == 5
+    assert model.data(model.index(2, 0), dashboard.Qt.UserRole) == 'c'
+
+    for name in ('a', 'b', 'e'):
+        board.touch(name)
+    model.refresh()
+    assert changed == [(0, 1), (4, 4)]
+
+    changed.clear()
+    model.refresh()
+    assert changed == []
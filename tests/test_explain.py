@@ -0,0 +1,68 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+import explain
+
+
+def rule(name, url='example.com', initWait='', actions=(), **extra):
+    return dict({'name': name, 'url': url, 'enable': True, 'initWait': initWait,
+                 'actions': list(actions)}, **extra)
+
+
+def action(name, **extra):
+    return dict({'name': name, 'xpath': '//button', 'initWait': '', 'value': ''}, **extra)
+
+
+def test_single_rule_trips():
+    report = explain.analyze([rule('A', actions=[action('click')])])
+    costs = report['rules'][0]
+    assert costs['steady_trips'] == explain.UrlCheck + explain.PageCheck
+    # check + keep <head>, then page check, find and click
+    assert costs['fire_trips'] == 3 + explain.PageCheck + 1 + explain.Click
+    assert report['steady_trips'] == 1 + costs['steady_trips']
+
+
+def test_rule_init_wait_polls_the_page():
+    quick = explain.analyze([rule('A')])['rules'][0]
+    slow = explain.analyze([rule('A', initWait='3')])['rules'][0]
+    assert slow['worst_wait'] == 3
+    assert slow['fire_trips'] - quick['fire_trips'] == 3 * explain.PagePolls
+
+
+def test_rules_for_other_pages_scan_frames():
+    rules = [rule('A', url='example.com/a'), rule('B', url='example.com/b'),
+             rule('C', url='example.com/b')]
+    report = explain.analyze(rules, frames=4)
+    miss = explain.UrlCheckFrames + 4 * explain.FrameUrl
+    assert report['rules'][0]['miss_trips'] == miss
+    steady = explain.UrlCheck + explain.PageCheck
+    # worst page is 'a': one rule runs its checks, two scan the frames
+    assert report['steady_trips'] == 1 + steady + 2 * miss
+
+
+def test_tabs_are_costed_apart():
+    rules = [rule('A', url='example.com/a'), rule('B', url='other.com', tab='other')]
+    report = explain.analyze(rules, latency=10)
+    steady = explain.UrlCheck + explain.PageCheck
+    assert report['tabs'] == 2
+    assert report['steady_trips'] == 1 + 2 * steady + 2      # plus a tab switch each
+    assert report['steady_ms'] == report['steady_trips'] * 10
+
+
+def test_warnings_and_errors():
+    rules = [rule('A', actions=[
+        action('regex', addon={'xpath': '//body', 'condition': '~', 'value': '(a+)+$'}),
+        action('bad', addon={'xpath': '//p', 'condition': 'search', 'value': '('}),
+        action('flags', flag={'name': 'x', 'value': '1', 'condition': '==',
+                              'and': {'name': 'y', 'value': '1', 'condition': '=='},
+                              'or': {'name': 'z', 'value': '1', 'condition': '=='}}),
+    ])]
+    costs = explain.analyze(rules)['rules'][0]
+    assert any('the whole page' in w for w in costs['warnings'])
+    assert any('nested quantifier' in w for w in costs['warnings'])
+    assert any('invalid regex' in e for e in costs['errors'])
+    assert any("both 'and' and 'or'" in e for e in costs['errors'])
@@ -0,0 +1,107 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+import csv
+import glob
+import threading
+
+import export
+
+
+def read_csv(path):
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def test_csv_rotates_on_new_fields(tmp_path):
+    path = str(tmp_path / 'prices.csv')
+    sink = export.CsvSink(path)
+    sink.write([{'rule': 'r', 'price': '1'}])
+    sink.write([{'rule': 'r', 'price': '2'}])
+    sink.write([{'rule': 'r', 'queue': '7'}])
+
+    rotated = glob.glob(str(tmp_path / 'prices-*.csv'))
+    assert len(rotated) == 1
+    assert read_csv(rotated[0]) == [{'rule': 'r', 'price': '1'}, {'rule': 'r', 'price': '2'}]
+    assert read_csv(path) == [{'rule': 'r', 'price': '', 'queue': '7'}]
+
+    # rows with fewer fields fit the wider header
+    sink.write([{'rule': 'r', 'price': '3'}])
+    assert len(glob.glob(str(tmp_path / 'prices-*.csv'))) == 1
+    assert read_csv(path)[-1] == {'rule': 'r', 'price': '3', 'queue': ''}
+
+
+def test_csv_reuses_existing_header(tmp_path):
+    path = str(tmp_path / 'prices.csv')
+    export.CsvSink(path).write([{'rule': 'r', 'price': '1'}])
+    export.CsvSink(path).write([{'price': '2', 'rule': 'r'}])
+    assert read_csv(path) == [{'rule': 'r', 'price': '1'}, {'rule': 'r', 'price': '2'}]
+    assert not glob.glob(str(tmp_path / 'prices-*.csv'))
+
+
+def test_write_errors_go_to_log(tmp_path):
+    logged = []
+    sink = export.JsonlSink(str(tmp_path / 'missing' / 'out.jsonl'))
+    pipeline = export.Pipeline(sink, flush_interval=60, log=logged.append)
+    pipeline.put('rule', 'action', {'price': '1'})
+    pipeline.close()
+    assert pipeline.written == 0
+    assert logged and logged[0].startswith('ERROR writing extracted values')
+
+
+class FlakySink(object):
+    def __init__(self, failures=1):
+        self.failures = failures
+        self.rows = []
+
+    def write(self, rows):
+        if self.failures:
+            self.failures -= 1
+            raise ValueError('bad row')
+        self.rows.extend(rows)
+
+    def close(self):
+        pass
+
+
+def test_any_write_error_leaves_the_thread_running():
+    logged = []
+    sink = FlakySink()
+    pipeline = export.Pipeline(sink, batch_size=1, flush_interval=60, log=logged.append)
+    pipeline.put('rule', 'action', {'price': '1'})
+    pipeline.put('rule', 'action', {'price': '2'})
+    pipeline.close()
+    assert logged == ['ERROR writing extracted values: ValueError: bad row']
+    assert [row['price'] for row in sink.rows] == ['2']
+
+
+class BlockedSink(FlakySink):
+    def __init__(self):
+        super().__init__(failures=0)
+        self.writing = threading.Event()
+        self.release = threading.Event()
+
+    def write(self, rows):
+        self.writing.set()
+        self.release.wait(10)
+        super().write(rows)
+
+
+def test_full_queue_drops_and_counts():
+    logged = []
+    sink = BlockedSink()
+    pipeline = export.Pipeline(sink, batch_size=1, flush_interval=60, log=logged.append,
+                               queue_size=2)
+    pipeline.put('rule', 'action', {'price': '0'})
+    assert sink.writing.wait(5)
+    for price in range(1, 6):
+        pipeline.put('rule', 'action', {'price': str(price)})
+    sink.release.set()
+    pipeline.close()
+    assert pipeline.dropped == 3 and pipeline.written == 3
+    assert logged == ['ERROR export queue full, dropping rows (1 so far)']
+    assert [row['price'] for row in sink.rows] == ['0', '1', '2']
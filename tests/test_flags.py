@@ -0,0 +1,160 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+import time
+import sqlite3
+
+import pytest
+
+from flags import FlagStore
+from clock import VirtualClock
+
+
+def test_values_keep_their_type():
+    store = FlagStore()
+    store.set('count', 5)
+    store.set('name', 'abc')
+    assert store.get('count') == 5 and store['count'] == 5
+    assert store.text('count') == '5'
+    assert store.number('count') == 5
+    assert store.get('name') == 'abc'
+    assert store.get('missing', '') == ''
+    with pytest.raises(ValueError):
+        store.number('name')
+
+
+def test_incr_decr_store_text():
+    # as the plain dict of old did: str(old + delta)
+    store = FlagStore()
+    store.set('n', '5')
+    store.incr('n', 2)
+    assert store.get('n') == '7'
+    store.decr('n', '10')
+    assert store.get('n') == '-3'
+    with pytest.raises(KeyError):
+        store.incr('missing', 1)
+
+
+def test_ttl_expires():
+    store = FlagStore()
+    store.set('short', 'x', ttl=0.05)
+    store.set('long', 'y', ttl=60)
+    assert 'short' in store
+    time.sleep(0.1)
+    assert 'short' not in store
+    assert store.text('short') == ''
+    assert store.snapshot() == {'long': 'y'}
+
+
+def test_incr_keeps_ttl():
+    store = FlagStore()
+    store.set('n', 1, ttl=60)
+    expires = store.lookup('n').expires
+    store.incr('n', 1)
+    assert store.lookup('n').expires == pytest.approx(expires, abs=0.5)
+
+
+def test_restore_keeps_expiry_and_values():
+    store = FlagStore()
+    store.set('ttl', 1, ttl=60)
+    store.set('gone', 1, ttl=0.05)
+    store.set('forever', 'x')
+    saved = store.snapshot(expiry=True)
+    time.sleep(0.1)
+
+    store.clear()
+    store.restore(saved)
+    assert store.get('ttl') == 1
+    assert store.lookup('ttl').expires is not None
+    assert store.lookup('forever').expires is None
+    assert 'gone' not in store
+
+
+def test_persist_and_sync(tmp_path):
+    path = str(tmp_path / 'flags.db')
+    one = FlagStore(path=path, namespace='a', persist=True, flush_interval=60)
+    two = FlagStore(path=path, namespace='a', persist=True, flush_interval=60)
+    other = FlagStore(path=path, namespace='b', persist=True, flush_interval=60)
+    try:
+        one.set('count', 5)
+        one.set('ttl', 'x', ttl=60)
+        one.flush()
+        two.flush()     # picks up what the others wrote since
+        other.flush()
+        assert two.get('count') == 5
+        assert two.lookup('ttl').expires == pytest.approx(one.lookup('ttl').expires)
+        assert 'count' not in other
+
+        two.clear()
+        two.flush()
+        one.flush()
+        assert 'count' not in one
+    finally:
+        for store in (one, two, other):
+            store.close()
+
+    reopened = FlagStore(path=path, namespace='a', persist=True, flush_interval=60)
+    try:
+        assert reopened.snapshot() == {}
+    finally:
+        reopened.close()
+
+
+def test_ttl_follows_the_clock():
+    clock = VirtualClock(start=1000)
+    store = FlagStore(clock=clock)
+    store.set('n', 1, ttl=10)
+    clock.advance(5)
+    store.incr('n', 1)
+    assert store.lookup('n').expires == 1010
+    clock.advance(5)
+    assert 'n' not in store
+
+
+def test_sync_does_not_depend_on_clocks(tmp_path):
+    # a write stamped earlier than the reader's last look still gets through
+    path = str(tmp_path / 'flags.db')
+    late = FlagStore(path=path, namespace='a', persist=True, flush_interval=60,
+                     clock=VirtualClock(start=0))
+    reader = FlagStore(path=path, namespace='a', persist=True, flush_interval=60,
+                       clock=VirtualClock(start=10000))
+    try:
+        reader.set('mine', 1)
+        reader.flush()
+        late.set('count', 5)
+        late.flush()
+        reader.flush()
+        assert reader.get('count') == 5
+        late.set('count', 6)
+        late.flush()
+        reader.flush()
+        assert reader.get('count') == 6
+    finally:
+        late.close()
+        reader.close()
+
+
+def test_old_database_is_upgraded(tmp_path):
+    path = str(tmp_path / 'flags.db')
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE flags (namespace TEXT, name TEXT, value TEXT, expires REAL, '
+               'updated REAL, writer TEXT, PRIMARY KEY (namespace, name))')
+    db.execute("INSERT INTO flags VALUES ('default', 'old', '3', NULL, 0, 'x')")
+    db.commit()
+    db.close()
+
+    store = FlagStore(path=path, persist=True, flush_interval=60)
+    other = FlagStore(path=path, persist=True, flush_interval=60)
+    try:
+        assert store.get('old') == 3
+        store.set('new', 'y')
+        store.flush()
+        other.flush()
+        assert other.get('new') == 'y'
+    finally:
+        store.close()
+        other.close()
@@ -0,0 +1,68 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+import time
+
+import pytest
+
+pytest.importorskip('selenium')
+
+import cdp          # noqa: E402
+import memory       # noqa: E402
+
+
+class StubConnection(object):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class StubCdpDriver(cdp.CdpDriver):
+    # no browser, a JS heap that grows by 1MB a sample
+    def __init__(self):
+        self.conn = StubConnection()
+        self.calls = []
+
+    def execute_cdp_cmd(self, cmd, cmd_args):
+        self.calls.append(cmd)
+        heap = self.calls.count('Performance.getMetrics') * memory.MB
+        return {'metrics': [{'name': 'JSHeapUsedSize', 'value': heap}]}
+
+
+def test_governor_samples_and_detaches(config):
+    config.read_dict({'memory': {'interval': '0.01', 'heap_mb': '3', 'log_every': '0'}})
+    driver = StubCdpDriver()
+    governor = memory.MemoryGovernor(lambda: driver, log=lambda text: None)
+    governor.start()
+    deadline = time.time() + 5
+    while governor.recycle_due is None and time.time() < deadline:
+        time.sleep(0.01)
+    governor.stop()
+    governor.join(5)
+
+    assert governor.recycle_due == 'JS heap 4MB over limit'
+    assert driver.calls.count('Performance.enable') == 1
+    assert driver.calls.count('Performance.getMetrics') >= 4
+    assert driver.conn.closed
+    assert governor.latest()['heap_mb'] >= 4
+
+
+def test_attach_failure_is_logged(config):
+    logged = []
+
+    def attach():
+        raise ConnectionRefusedError('refused')
+
+    governor = memory.MemoryGovernor(attach, log=logged.append)
+    governor.run()
+    assert logged == ['Memory governor unable to attach: refused']
+
+
+def test_listening_pid_of_unused_port():
+    pytest.importorskip('psutil')
+    assert memory.listening_pid(1) is None
@@ -0,0 +1,114 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+import threading
+
+import pytest
+
+import profiler
+from clock import VirtualClock
+
+
+@pytest.fixture
+def switch(tmp_path, monkeypatch, config):
+    monkeypatch.setattr(profiler, 'ProfileDir', str(tmp_path))
+    config.read_dict({'profiler': {'interval_ms': '1'}})
+    logged = []
+    engine = {'thread': None}
+    sw = profiler.ProfilerSwitch(lambda: engine['thread'], lambda: ('rule A', 'click'),
+                                 log=logged.append)
+    sw.engine = engine
+    sw.logged = logged
+    yield sw
+    sw.stop()
+
+
+def busy(release):
+    while not release.wait(0.001):
+        pass
+
+
+def test_refuses_without_a_live_engine_thread(switch):
+    switch.start()
+    assert switch.profiler is None
+
+    thread = threading.Thread(target=lambda: None)
+    thread.start()
+    thread.join()
+    switch.engine['thread'] = thread.ident      # left behind by a thread that has exited
+    switch.start()
+    assert switch.profiler is None
+    assert switch.logged == ['Profiler: engine thread is not running'] * 2
+
+
+def test_samples_the_engine_thread(switch, tmp_path):
+    release = threading.Event()
+    thread = threading.Thread(target=busy, args=(release,))
+    thread.start()
+    try:
+        switch.engine['thread'] = thread.ident
+        switch.start()
+        assert switch.is_running()
+        for _ in range(200):
+            if switch.profiler.samples >= 5:
+                break
+            release.wait(0.01)
+        path = switch.stop()
+    finally:
+        release.set()
+        thread.join()
+
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert lines and all(line.startswith('rule: rule A;action: click;') for line in lines)
+    assert any('busy (test_profiler.py:' in line for line in lines)
+
+
+def test_stops_sampling_when_the_thread_exits(switch):
+    release = threading.Event()
+    thread = threading.Thread(target=busy, args=(release,))
+    thread.start()
+    switch.engine['thread'] = thread.ident
+    switch.start()
+    release.set()
+    thread.join()
+    switch.profiler.join(5)
+    assert not switch.is_running()
+    assert switch.stop() is not None
+
+
+class Postal(object):
+    def log(self, text):
+        pass
+
+    def status(self, text):
+        pass
+
+
+def test_engine_thread_cleared_on_exit(config, tmp_path):
+    web = pytest.importorskip('web')
+    rules = tmp_path / 'rules.json'
+    rules.write_text('[]')
+    config.read_dict({'rules': {'rulefile': str(rules)}})
+    myweb = web.MyWeb(Postal(), clock=VirtualClock())
+    seen = []
+
+    def loop():
+        try:
+            myweb.check()
+            seen.append(myweb.engine_thread)
+        finally:
+            myweb.engine_done()
+
+    thread = threading.Thread(target=loop)
+    thread.start()
+    thread.join()
+    assert seen == [thread.ident] and myweb.engine_thread is None
+
+    myweb.engine_thread = thread.ident
+    myweb.engine_done()             # another thread's, left alone
+    assert myweb.engine_thread == thread.ident
@@ -0,0 +1,106 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+import os
+import errno
+import socket
+
+import pytest
+
+import profiles
+
+
+@pytest.fixture
+def template(tmp_path):
+    root = tmp_path / 'golden'
+    (root / 'Default' / 'Cache').mkdir(parents=True)
+    (root / 'Default' / 'Cache' / 'data_0').write_bytes(b'cached')
+    (root / 'Default' / 'Preferences').write_text('{"prefs": 1}')
+    (root / 'Default' / 'Cookies').write_bytes(b'sqlite')
+    (root / 'ShaderCache').mkdir()
+    (root / 'lockfile').write_text('')
+    (root / 'Local State').write_text('{}')
+    os.symlink('host-1', root / 'SingletonLock')
+    os.symlink('Preferences', root / 'Default' / 'Prefs')
+    return str(root)
+
+
+def listing(path):
+    found = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        rel = os.path.relpath(dirpath, path)
+        found += [os.path.normpath(os.path.join(rel, name)) for name in dirnames + filenames]
+    return sorted(found)
+
+
+def test_clone_leaves_out_caches_and_locks(template, tmp_path):
+    path = profiles.clone(template, str(tmp_path / 'clones'))
+    try:
+        assert listing(path) == ['.selmate-clone', 'Default', 'Default/Cookies',
+                                 'Default/Preferences', 'Default/Prefs', 'Local State']
+        assert os.readlink(os.path.join(path, 'Default', 'Prefs')) == 'Preferences'
+        with open(os.path.join(path, 'Default', 'Preferences')) as f:
+            assert f.read() == '{"prefs": 1}'
+    finally:
+        profiles.release(path)
+    assert not os.path.exists(path)
+
+
+def test_copy_falls_back_when_reflink_is_unsupported(tmp_path, monkeypatch):
+    calls = []
+
+    def reflink(src, dst):
+        calls.append(src)
+        raise OSError(errno.EOPNOTSUPP, 'Operation not supported')
+
+    monkeypatch.setattr(profiles, 'reflink', reflink)
+    for name in ('a', 'b'):
+        (tmp_path / name).write_text(name)
+    cloner = profiles.Cloner()
+    cloner.use_reflink = True
+    cloner.copy_file(str(tmp_path / 'a'), str(tmp_path / 'a2'))
+    cloner.copy_file(str(tmp_path / 'b'), str(tmp_path / 'b2'))
+    assert (tmp_path / 'a2').read_text() == 'a' and (tmp_path / 'b2').read_text() == 'b'
+    assert len(calls) == 1 and not cloner.use_reflink     # not tried again
+
+
+def test_other_reflink_errors_are_raised(tmp_path, monkeypatch):
+    def reflink(src, dst):
+        raise OSError(errno.ENOSPC, 'No space left on device')
+
+    monkeypatch.setattr(profiles, 'reflink', reflink)
+    (tmp_path / 'a').write_text('a')
+    cloner = profiles.Cloner()
+    cloner.use_reflink = True
+    with pytest.raises(OSError):
+        cloner.copy_file(str(tmp_path / 'a'), str(tmp_path / 'a2'))
+
+
+def test_missing_template():
+    with pytest.raises(Exception, match='not found'):
+        profiles.clone('/nonexistent/golden', '/tmp')
+
+
+def test_collect_removes_orphaned_clones(template, tmp_path, monkeypatch):
+    root = str(tmp_path / 'clones')
+    mine = profiles.clone(template, root)
+    orphan = profiles.clone(template, root)
+    held = profiles.clone(template, root)
+    try:
+        for path in (orphan, held):
+            profiles.Active.discard(path)       # as if a crashed process made them
+            with open(os.path.join(path, profiles.CloneMarker), 'w') as f:
+                f.write('999999\n')
+        os.symlink(f'{socket.gethostname()}-{os.getpid()}', os.path.join(held, 'SingletonLock'))
+        monkeypatch.setattr(profiles, 'pid_alive', lambda pid: pid == os.getpid())
+
+        profiles.collect(root)
+        assert os.path.isdir(mine) and os.path.isdir(held)      # ours, and a live browser's
+        assert not os.path.exists(orphan)
+    finally:
+        for path in (mine, orphan, held):
+            profiles.release(path)
@@ -0,0 +1,129 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+import pytest
+
+import ratelimit
+from clock import VirtualClock
+
+
+def test_bucket_refills_up_to_burst():
+    bucket = ratelimit.TokenBucket(rate=2, burst=3, now=0)
+    assert [bucket.take(0) for _ in range(4)] == [True, True, True, False]
+    assert bucket.next_token(0) == pytest.approx(0.5)
+    assert bucket.take(0.5)
+    assert not bucket.take(0.5)
+    bucket.refill(100)
+    assert bucket.tokens == 3
+
+
+def test_bucket_without_rate_never_refills():
+    bucket = ratelimit.TokenBucket(rate=0, burst=1, now=0)
+    assert bucket.take(0)
+    assert not bucket.take(1000)
+    assert bucket.next_token(1000) == float('inf')
+
+
+def test_governor_defers_with_retry_time(config):
+    config.read_dict({'ratelimit': {'rate': '1', 'burst': '2'},
+                      'ratelimit.slow.example': {'rate': '0.1', 'burst': '1'}})
+    clock = VirtualClock(start=1000)
+    governor = ratelimit.RateGovernor(clock)
+    governor.acquire('fast.example')
+    governor.acquire('fast.example')
+    with pytest.raises(ratelimit.RateLimited) as limited:
+        governor.acquire('fast.example')
+    assert limited.value.retry_at == pytest.approx(1001)
+
+    governor.acquire('slow.example')
+    with pytest.raises(ratelimit.RateLimited) as limited:
+        governor.acquire('slow.example')
+    assert limited.value.retry_at == pytest.approx(1010)
+
+    clock.advance(1)
+    governor.acquire('fast.example')
+    assert governor.counters() == {('fast.example', None): {'allowed': 3, 'deferred': 1},
+                                   ('slow.example', None): {'allowed': 1, 'deferred': 1}}
+
+
+def test_governor_per_rule_buckets(config):
+    config.read_dict({'ratelimit': {'rate': '0', 'burst': '1', 'per_rule': 'yes'}})
+    governor = ratelimit.RateGovernor(VirtualClock())
+    governor.acquire('site', 'one')
+    governor.acquire('site', 'two')
+    with pytest.raises(ratelimit.RateLimited):
+        governor.acquire('site', 'one')
+    governor.reset()
+    governor.acquire('site', 'one')
+
+
+class Postal(object):
+    def log(self, text):
+        pass
+
+    def status(self, text):
+        pass
+
+    def countdown(self, text):
+        pass
+
+
+class Element(object):
+    tag_name = 'button'
+
+    def get_attribute(self, name):
+        return None
+
+
+class Driver(object):
+    current_url = 'http://site.example/page'
+
+    def __init__(self):
+        self.head = Element()
+        self.clicks = 0
+
+    def find_element_by_tag_name(self, name):
+        return self.head
+
+    def find_element_by_xpath(self, xpath):
+        return Element()
+
+    def execute_script(self, script, *args):
+        self.clicks += 1
+
+
+def test_resumed_action_applies_flags_once(config, tmp_path):
+    web = pytest.importorskip('web')
+    rules = tmp_path / 'rules.json'
+    rules.write_text('[]')
+    config.read_dict({'rules': {'rulefile': str(rules)},
+                      'ratelimit': {'enable': 'yes', 'rate': '1', 'burst': '1'}})
+    clock = VirtualClock(start=1000)
+    myweb = web.MyWeb(Postal(), clock=clock)
+    myweb.driver = Driver()
+    myweb.page_head = myweb.driver.head
+    myweb.last_url = myweb.driver.current_url
+    myweb.current_rule = 'count'
+    myweb.rule_flags.set('clicks', 0)
+
+    action = {'name': 'click', 'xpath': '//button', 'initWait': '', 'value': '', 'addon': {},
+              'flag': {'name': '', 'value': '', 'condition': '==',
+                       'true': [{'name': 'clicks', 'value': '1', 'op': '+='}]}}
+    rule = {'name': 'count', 'url': 'site.example', 'enable': True, 'initWait': '',
+            'actions': [action, dict(action, name='again')]}
+
+    myweb.run_actions(rule)
+    assert myweb.driver.clicks == 1
+    assert myweb.rule_flags.number('clicks') == 2
+    assert len(myweb.deferred_rules) == 1
+
+    clock.advance(1)
+    (retry_at, _, idx, _), = myweb.deferred_rules.values()
+    assert (retry_at, idx) == (1001, 1)
+    myweb.run_actions(rule, idx, resumed=True)
+    assert myweb.driver.clicks == 2
+    assert myweb.rule_flags.number('clicks') == 2
@@ -0,0 +1,46 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+import json
+
+import rulefile
+
+
+def rule(name, **kw):
+    return dict({'name': name, 'enable': True, 'url': 'http://a/', 'actions': []}, **kw)
+
+
+def test_diff():
+    old = [rule('A'), rule('B'), rule('C')]
+    new = [rule('A'), rule('B', url='http://b/'), rule('D')]
+    assert rulefile.diff(old, new) == (['D'], ['B'], ['C'])
+    assert rulefile.diff(old, [dict(r) for r in old]) == ([], [], [])
+
+
+def test_diff_repeated_names():
+    old = [rule('A'), rule('A', url='http://x/')]
+    new = [rule('A'), rule('A', url='http://y/'), rule('A')]
+    added, changed, removed = rulefile.diff(old, new)
+    assert (added, changed, removed) == (['A'], ['A'], [])
+
+
+def test_merge_keeps_unchanged_objects():
+    old = [rule('A'), rule('B')]
+    new = [rule('B', url='http://b/'), rule('A'), rule('C')]
+    merged = rulefile.merge(old, new)
+    assert [r['name'] for r in merged] == ['B', 'A', 'C']
+    assert merged[1] is old[0]          # unchanged, state hanging off it survives
+    assert merged[0] is new[0]
+    assert merged[2] is new[2]
+
+
+def test_load_directory_in_name_order(tmp_path):
+    (tmp_path / 'b.json').write_text(json.dumps([rule('B')]))
+    (tmp_path / 'a.json').write_text(json.dumps([rule('A')]))
+    (tmp_path / 'notes.txt').write_text('not rules')
+    assert [r['name'] for r in rulefile.load(str(tmp_path))] == ['A', 'B']
+    assert rulefile.mtime(str(tmp_path)) >= (tmp_path / 'b.json').stat().st_mtime
@@ -0,0 +1,102 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+import itertools
+
+import pytest
+
+sessions = pytest.importorskip('sessions')
+
+
+class Executor(object):
+    _url = 'http://127.0.0.1:9515'
+
+
+class FakeDriver(object):
+    ids = itertools.count(1)
+
+    def __init__(self):
+        self.command_executor = Executor()
+        self.session_id = f's{next(self.ids)}'
+        self.alive = True
+        self.quit_called = False
+
+    @property
+    def current_window_handle(self):
+        if not self.alive:
+            raise ConnectionRefusedError('browser gone')
+        return 'CDwindow-1'
+
+    def quit(self):
+        self.quit_called = True
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    # cookies.ini stands aside, the pool's records land here
+    live = {}
+    monkeypatch.setattr(sessions.cookies, 'update', lambda s, key, value: live.update({key: value}))
+    monkeypatch.setattr(sessions.cookies, 'remove', lambda s, key: live.pop(key, None))
+    return live
+
+
+def make_pool(**options):
+    options = dict(dict(size=1, max_age=0, max_commands=0, health_interval=0), **options)
+    return sessions.SessionPool(launcher=FakeDriver, log=lambda text: None, **options)
+
+
+def test_checkout_and_release(registry):
+    pool = make_pool(size=2)
+    pool.start()
+    try:
+        session = pool.acquire(timeout=5)
+        assert session is not None and session.in_use
+        assert pool.find(session.connection()) is session
+        pool.release(session, commands=7)
+        assert not session.in_use and session.commands == 7
+        assert session in pool.idle
+    finally:
+        pool.stop()
+    assert registry == {}       # spares closed and unregistered
+    assert session.driver.quit_called
+
+
+def test_acquire_times_out_on_an_empty_pool(registry):
+    pool = make_pool()
+    assert pool.acquire(timeout=0) is None
+
+
+def test_unhealthy_sessions_are_retired(registry):
+    pool = make_pool()
+    session = pool.launch()
+    pool.idle.append(session)
+    assert session.session_id in registry
+
+    pool.check_idle()
+    assert pool.idle == [session]
+    session.driver.alive = False
+    pool.check_idle()
+    assert pool.idle == [] and session.session_id not in registry
+
+
+def test_release_recycles_by_health_and_commands(registry):
+    pool = make_pool(max_commands=10)
+    for healthy, commands, kept in ((True, 5, True), (False, 0, False), (True, 11, False)):
+        session = pool.launch()
+        session.in_use = True
+        pool.busy.append(session)
+        pool.release(session, healthy=healthy, commands=commands)
+        assert (session in pool.idle) == kept
+        assert pool.busy == []
+
+
+def test_old_sessions_expire(registry):
+    pool = make_pool(max_age=60)
+    session = pool.launch()
+    assert not pool.is_expired(session)
+    session.created -= 61
+    assert pool.is_expired(session)
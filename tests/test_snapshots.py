@@ -0,0 +1,150 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+import os
+import json
+import time
+import zipfile
+
+import pytest
+
+pytest.importorskip('selenium')
+
+import cdp          # noqa: E402
+import snapshots    # noqa: E402
+
+
+def recorder(tmp_path, config, attach=None, **options):
+    config.read_dict({'snapshots': {k: str(v) for k, v in options.items()}})
+    return snapshots.SnapshotRecorder(attach, path=str(tmp_path), log=lambda text: None)
+
+
+def make_snapshot(path, name, size):
+    with open(os.path.join(path, f'snapshot-{name}.zip'), 'wb') as f:
+        f.write(b'x' * size)
+
+
+def test_trim_keeps_the_newest_by_count(tmp_path, config):
+    ring = recorder(tmp_path, config, max_count=2)
+    for name in ('20200101-000001', '20200101-000003', '20200101-000002'):
+        make_snapshot(str(tmp_path), name, 10)
+    (tmp_path / 'other.zip').write_bytes(b'keep')
+    ring.trim()
+    assert sorted(os.listdir(tmp_path)) == ['other.zip', 'snapshot-20200101-000002.zip',
+                                            'snapshot-20200101-000003.zip']
+
+
+def test_trim_by_size(tmp_path, config):
+    ring = recorder(tmp_path, config, max_mb=0.5)
+    for i in range(4):
+        make_snapshot(str(tmp_path), f'2020010{i}', 200 * 1024)
+    ring.trim()
+    assert sorted(os.listdir(tmp_path)) == ['snapshot-20200102.zip', 'snapshot-20200103.zip']
+
+
+class StubConnection(object):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class StubCdpDriver(cdp.CdpDriver):
+    # no browser, just the calls the recorder makes
+    def __init__(self, fail=()):
+        self.conn = StubConnection()
+        self.script_timeout = 30
+        self.timeouts = []
+        self.fail = fail
+
+    def set_script_timeout(self, seconds):
+        self.timeouts.append(seconds)
+
+    def step(self, name, value):
+        if name in self.fail:
+            raise cdp.SeleniumTimeoutException(f'CDP command {name} timed out')
+        return value
+
+    @property
+    def page_source(self):
+        return self.step('page_source', '<html></html>')
+
+    @property
+    def current_url(self):
+        return self.step('current_url', 'http://site/page')
+
+    def get_screenshot_as_png(self):
+        return self.step('screenshot', b'png')
+
+
+def test_fetch_uses_the_budget_and_detaches(tmp_path, config):
+    driver = StubCdpDriver(fail=('screenshot',))
+    attached = []
+
+    def attach(executor_url, session_id, timeout):
+        attached.append(timeout)
+        return driver
+
+    ring = recorder(tmp_path, config, attach, budget=5)
+    files, missing = ring.fetch({'executor_url': 'cdp://127.0.0.1:9222', 'session_id': 'T1'})
+    assert attached == [5]
+    assert len(driver.timeouts) == 3 and all(0 < t <= 5 for t in driver.timeouts)
+    assert files == {'page.html': b'<html></html>', 'current_url.txt': b'http://site/page'}
+    assert missing == ['screenshot.png: TimeoutException: Message: CDP command screenshot timed out']
+    for _ in range(100):
+        if driver.conn.closed:
+            break
+        time.sleep(0.01)
+    assert driver.conn.closed
+
+    path = ring.write({'time': 0, 'rule': 'r'}, (files, missing))
+    with zipfile.ZipFile(path) as zf:
+        assert sorted(zf.namelist()) == ['current_url.txt', 'meta.json', 'page.html']
+        assert json.loads(zf.read('meta.json'))['missing'] == missing
+
+
+def test_fetch_reports_attach_errors(tmp_path, config):
+    def attach(executor_url, session_id, timeout):
+        raise ConnectionRefusedError('refused')
+
+    ring = recorder(tmp_path, config, attach)
+    assert ring.fetch({'executor_url': 'http://x', 'session_id': 's'}) == ({}, ['attach: refused'])
+
+
+class SlowDriver(object):
+    # a WebDriver session that takes its time over the page source
+    current_url = 'http://site/page'
+
+    @property
+    def page_source(self):
+        time.sleep(1)
+        return '<html></html>'
+
+    def get_screenshot_as_png(self):
+        return b'png'
+
+
+def test_fetch_stops_waiting_at_the_deadline(tmp_path, config):
+    ring = recorder(tmp_path, config, lambda url, session, timeout: SlowDriver(), budget=0.2)
+    start = time.time()
+    files, missing = ring.fetch({'executor_url': 'http://x', 'session_id': 's'})
+    assert time.time() - start < 0.6
+    assert files == {}
+    assert missing == ['page.html: out of time', 'screenshot.png: out of time',
+                       'current_url.txt: out of time']
+
+
+def test_fetch_counts_a_slow_attach_against_the_budget(tmp_path, config):
+    def attach(executor_url, session_id, timeout):
+        time.sleep(1)
+        return SlowDriver()
+
+    ring = recorder(tmp_path, config, attach, budget=0.2, screenshot='no')
+    start = time.time()
+    assert ring.fetch({'executor_url': 'http://x', 'session_id': 's'}) == \
+        ({}, ['attach: out of time', 'page.html: out of time', 'current_url.txt: out of time'])
+    assert time.time() - start < 0.6
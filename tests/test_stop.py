@@ -0,0 +1,117 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+import time
+import threading
+
+import pytest
+
+import utils
+from utils import Cancelled
+from clock import SystemClock, VirtualClock
+
+pytest.importorskip('PyQt5')
+
+from actions import ActionList      # noqa: E402
+from rules import Rules             # noqa: E402
+
+Latency = 0.2       # windows.StopLatency, in seconds
+
+
+def stop_soon(stop_event, delay=0.05):
+    threading.Timer(delay, stop_event.set).start()
+
+
+def test_sleep_ends_on_stop():
+    stop_event = threading.Event()
+    stop_soon(stop_event)
+    started = time.monotonic()
+    with pytest.raises(Cancelled):
+        utils.wait('30', stop_event=stop_event)
+    assert time.monotonic() - started < Latency
+
+
+def test_action_list_stops_between_actions():
+    stop_event = threading.Event()
+    ran = []
+    actions = ActionList(stop_event, VirtualClock())
+    actions.add(lambda: ran.append('first'), 'first')
+    actions.add(stop_event.set, 'stop')
+    actions.add(lambda: ran.append('never'), 'never')
+    assert actions.run() is False
+    assert ran == ['first']
+
+
+def test_rules_stop_in_an_initwait():
+    stop_event = threading.Event()
+    ran = []
+    actions = ActionList(stop_event, SystemClock)
+    actions.add(lambda: ran.append('action'), 'action', initwait=30)
+    rules = Rules(stop_event, SystemClock)
+    rules.add(lambda: True, 'rule', actions)
+    rules.add(lambda: ran.append('second rule'), 'second')
+
+    stop_soon(stop_event)
+    started = time.monotonic()
+    assert rules.run() is False
+    assert time.monotonic() - started < Latency
+    assert ran == []
+
+
+class Engine(object):
+    # MyWeb.check in a rule's initwait, as the web thread sees it
+    def __init__(self):
+        self.stop_event = threading.Event()
+        self.clock = SystemClock
+        self.checks = 0
+
+    def check(self):
+        self.checks += 1
+        try:
+            utils.sleep(30, self.stop_event)
+        except Cancelled:
+            pass
+
+    def engine_done(self):
+        pass
+
+
+def test_web_thread_exits_within_stop_latency(qapp):
+    windows = pytest.importorskip('windows')
+    engine = Engine()
+    thread = windows.WebThread(engine)
+    thread.start()
+    time.sleep(0.05)
+    engine.stop_event.set()
+    assert thread.wait(windows.StopLatency)
+    assert engine.checks == 1
+
+
+class Postal(object):
+    def log(self, text):
+        pass
+
+    def status(self, text):
+        pass
+
+    def countdown(self, text):
+        pass
+
+
+def test_wait_in_page_ends_on_stop(config, tmp_path):
+    web = pytest.importorskip('web')
+    rules = tmp_path / 'rules.json'
+    rules.write_text('[]')
+    config.read_dict({'rules': {'rulefile': str(rules)}})
+    myweb = web.MyWeb(Postal())
+    myweb.check_page_changed = lambda: False
+
+    stop_soon(myweb.stop_event)
+    started = time.monotonic()
+    with pytest.raises(Cancelled):
+        myweb.wait_in_page('30')
+    assert time.monotonic() - started < Latency
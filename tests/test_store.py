@@ -0,0 +1,78 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+import threading
+import configparser
+
+from store import IniStore
+
+
+def write_ini(path, text):
+    path.write_text(text)
+
+
+def test_update_is_written_and_merged(tmp_path):
+    path = tmp_path / 'app.ini'
+    write_ini(path, '[web]\nbrowser = chrome\n')
+    store = IniStore(str(path), write_delay=0)
+    store.read()
+    store.update('web', 'project', 'demo')
+
+    # another process changed the file meanwhile, both changes survive
+    other = IniStore(str(path), write_delay=0)
+    other.read()
+    other.update('pool', 'size', '2')
+    ondisk = configparser.ConfigParser()
+    ondisk.read(str(path))
+    assert ondisk['web']['project'] == 'demo'
+    assert ondisk['pool']['size'] == '2'
+
+
+def test_reload_keeps_pending_changes(tmp_path):
+    path = tmp_path / 'app.ini'
+    write_ini(path, '[web]\nbrowser = chrome\n')
+    store = IniStore(str(path), write_delay=60)
+    store.read()
+    store.update('web', 'project', 'pending')
+
+    write_ini(path, '[web]\nbrowser = firefox\n[new]\nkey = 1\n')
+    store.changed([str(path)])
+    assert store.config['web']['browser'] == 'firefox'
+    assert store.config['web']['project'] == 'pending'
+    assert store.config.getint('new', 'key') == 1
+    store.timer.cancel()
+
+
+def test_readers_never_see_a_half_loaded_config(tmp_path):
+    path = tmp_path / 'app.ini'
+    text = ''.join(f'[section{i}]\nkey = {i}\n' for i in range(50))
+    write_ini(path, text)
+    store = IniStore(str(path), write_delay=0)
+    store.read()
+
+    errors = []
+    stop = threading.Event()
+
+    def reader():
+        while not stop.is_set():
+            try:
+                for i in range(50):
+                    assert store.config.get(f'section{i}', 'key') == str(i)
+                    assert store.config[f'section{i}']['key'] == str(i)
+            except Exception as error:
+                errors.append(error)
+                return
+
+    threads = [threading.Thread(target=reader) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for _ in range(100):
+        store.changed([str(path)])
+    stop.set()
+    for thread in threads:
+        thread.join()
+    assert errors == []
@@ -0,0 +1,78 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+import pytest
+
+import tabs
+
+
+def rule(name, tab=None, enable=True):
+    r = {'name': name, 'enable': enable}
+    if tab:
+        r['tab'] = tab
+    return r
+
+
+def names(batches):
+    return [(tab, [r['name'] for r in rules]) for tab, rules in batches]
+
+
+Rules = [rule('a'), rule('b', 'orders'), rule('c'), rule('d', 'orders'),
+         rule('e', 'prices', enable=False), rule('f', 'main')]
+
+
+def test_batches_group_by_tab_in_file_order():
+    assert names(tabs.batches(Rules)) == [('main', ['a', 'c', 'f']), ('orders', ['b', 'd'])]
+
+
+def test_batches_start_with_the_tab_in_front():
+    assert names(tabs.batches(Rules, 'orders')) == [('orders', ['b', 'd']), ('main', ['a', 'c', 'f'])]
+    assert names(tabs.batches(Rules, 'prices')) == names(tabs.batches(Rules))     # no enabled rules
+    assert tabs.batches([]) == []
+
+
+class SwitchTo(object):
+    def __init__(self):
+        self.windows = []
+
+    def window(self, handle):
+        self.windows.append(handle)
+
+
+class Driver(object):
+    def __init__(self):
+        self.switch_to = SwitchTo()
+
+
+class Postal(object):
+    def log(self, text):
+        pass
+
+    def status(self, text):
+        pass
+
+
+def test_one_switch_per_tab_per_pass(config, tmp_path):
+    web = pytest.importorskip('web')
+    rulefile = tmp_path / 'rules.json'
+    rulefile.write_text('[]')
+    config.read_dict({'rules': {'rulefile': str(rulefile)}})
+    myweb = web.MyWeb(Postal())
+    myweb.driver = Driver()
+    myweb.tabs = {'main': tabs.Tab('main', 'w-main'), 'orders': tabs.Tab('orders', 'w-orders')}
+    myweb.current_tab = 'orders'
+    myweb.page_head = 'orders head'
+    myweb.rule_data = Rules
+    ran = []
+    myweb.run_rule = lambda r: ran.append((myweb.current_tab, r['name']))
+
+    myweb.process_rules()
+    myweb.process_rules()
+    assert ran == [('orders', 'b'), ('orders', 'd'), ('main', 'a'), ('main', 'c'), ('main', 'f'),
+                   ('main', 'a'), ('main', 'c'), ('main', 'f'), ('orders', 'b'), ('orders', 'd')]
+    assert myweb.driver.switch_to.windows == ['w-main', 'w-orders']
+    assert myweb.tabs['orders'].page_head == 'orders head'     # kept while main was in front
@@ -0,0 +1,78 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+import pytest
+
+import triggers
+
+
+def test_level_fires_while_passed():
+    edges = triggers.EdgeTracker()
+    key = ('rule', 'action')
+    assert edges.fire(key, 'level', True, 'a')
+    assert edges.fire(key, 'level', True, 'a')
+    assert not edges.fire(key, 'level', False, 'a')
+
+
+def test_rising_fires_once_per_edge():
+    edges = triggers.EdgeTracker()
+    key = ('rule', 'action')
+    assert edges.fire(key, 'rising', True, None)
+    assert not edges.fire(key, 'rising', True, None)
+    assert not edges.fire(key, 'rising', False, None)
+    assert edges.fire(key, 'rising', True, None)
+
+
+def test_change_fires_on_new_value():
+    edges = triggers.EdgeTracker()
+    key = ('rule', 'action')
+    assert edges.fire(key, 'change', True, '1')
+    assert not edges.fire(key, 'change', True, '1')
+    assert edges.fire(key, 'change', True, '2')
+
+
+def test_edge_keys_follow_names_and_occurrence():
+    first, second, unnamed, unnamed2 = {'name': 'first'}, {'name': 'second'}, {}, {}
+    again = {'name': 'first'}
+    rules = [{'name': 'rule', 'actions': [first, second, unnamed, unnamed2]},
+             {'name': 'rule', 'actions': [again]}]
+    keys = triggers.edge_keys(rules)
+    assert keys[id(first)] == ('rule', 1, 'first', 1)
+    assert keys[id(unnamed2)] == ('rule', 1, '(unknown)', 2)
+    assert keys[id(again)] == ('rule', 2, 'first', 1)
+    assert len(set(keys.values())) == 5
+
+    # reordering actions keeps each edge with its action
+    reordered = triggers.edge_keys([{'name': 'rule', 'actions': [second, first, unnamed, unnamed2]}])
+    assert reordered[id(first)] == keys[id(first)] and reordered[id(second)] == keys[id(second)]
+
+    edges = triggers.EdgeTracker()
+    assert edges.fire(keys[id(unnamed)], 'rising', True, None)
+    assert edges.fire(keys[id(unnamed2)], 'rising', True, None)
+    assert not edges.fire(keys[id(unnamed)], 'rising', True, None)
+
+
+def test_value_cache_per_page_generation():
+    cache = triggers.ValueCache()
+    key = ('//span', '==', '1')
+    assert cache.lookup(1, key, '1') is triggers.Missing
+    cache.store(1, key, '1', True)
+    assert cache.lookup(1, key, '1') is True
+    assert cache.lookup(1, key, '2') is triggers.Missing
+    cache.store(1, key, '2', False)
+    assert cache.lookup(1, key, '2') is False
+    assert cache.lookup(2, key, '2') is triggers.Missing     # new page
+    cache.store(1, key, '2', False)                         # late store for the old page
+    assert cache.lookup(2, key, '2') is triggers.Missing
+
+
+def test_check_rejects_unknown_trigger():
+    rules = [{'name': 'ok', 'actions': [{'name': 'a'}, {'name': 'b', 'trigger': 'change'}]}]
+    triggers.check(rules)
+    rules.append({'name': 'bad', 'actions': [{'name': 'a', 'trigger': 'raising'}]})
+    with pytest.raises(SyntaxError, match="'raising' in rule 'bad'"):
+        triggers.check(rules)
@@ -0,0 +1,82 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+import io
+
+import pytest
+
+import visual
+
+Image = pytest.importorskip('PIL.Image')
+ImageDraw = pytest.importorskip('PIL.ImageDraw')
+pytest.importorskip('numpy')
+
+
+def chart(bars, background=255):
+    # a small bar chart, the kind of thing drawn in a canvas
+    image = Image.new('L', (160, 120), background)
+    draw = ImageDraw.Draw(image)
+    for i, height in enumerate(bars):
+        draw.rectangle([10 + i * 30, 110 - height, 30 + i * 30, 110], fill=background - 200)
+    buf = io.BytesIO()
+    image.save(buf, 'PNG')
+    return buf.getvalue()
+
+
+Bars = [20, 60, 40, 90, 30]
+
+
+def test_same_image_has_no_difference():
+    a = visual.load_image(chart(Bars), 32)
+    b = visual.load_image(chart(Bars), 32)
+    assert visual.difference(a, b, 'phash') == 0
+    assert visual.difference(a, b, 'pixel') == 0
+
+
+def test_phash_ignores_brightness():
+    a = visual.load_image(chart(Bars), 32)
+    b = visual.load_image(chart(Bars, background=230), 32)
+    assert visual.difference(a, b, 'phash') == 0
+    assert visual.difference(a, b, 'pixel') > 0.05
+
+
+def test_changed_chart_is_different():
+    a = visual.load_image(chart(Bars), 32)
+    b = visual.load_image(chart(list(reversed(Bars))), 32)
+    assert visual.difference(a, b, 'phash') > 0.1
+    assert visual.difference(a, b, 'pixel') > 0.05
+
+
+def test_crop_and_unknown_method():
+    pixels = visual.load_image(chart(Bars), 16, crop=(0, 0, 80, 60))
+    assert pixels.shape == (16, 16)
+    with pytest.raises(SyntaxError):
+        visual.difference(pixels, pixels, 'ssim')
+
+
+def test_detector_captures_once_per_pass():
+    detector = visual.VisualDetector()
+    images = iter([chart(Bars), chart(list(reversed(Bars)))])
+    grabs = []
+
+    def grab():
+        grabs.append(1)
+        return visual.load_image(next(images), 32)
+
+    assert not detector.check('chart', 1, grab)
+    assert not detector.check('chart', 1, grab)
+    assert len(grabs) == 1
+    assert detector.check('chart', 2, grab)
+    assert detector.check('chart', 2, grab)
+    assert len(grabs) == 2
+
+
+def test_interval():
+    assert visual.interval({'actions': [{'name': 'a'}]}) is None
+    rule = {'actions': [{'visual': {'xpath': '//canvas'}}, {'visual': {'region': [0, 0, 9, 9], 'interval': 0.5}}]}
+    assert visual.interval(rule) == 0.5
+    assert visual.interval({'actions': [{'visual': {'xpath': '//canvas'}}]}) == visual.DefaultInterval
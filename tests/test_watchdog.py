@@ -0,0 +1,91 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+import pytest
+
+watchdog = pytest.importorskip('watchdog')
+
+from selenium.common.exceptions import UnexpectedAlertPresentException   # noqa: E402
+from clock import VirtualClock      # noqa: E402
+
+
+class Driver(object):
+    # answers heartbeats by a script of True (ok) and exceptions
+    def __init__(self, answers=(), dialog=None, alert=False):
+        self.answers = list(answers)
+        self.dialog = dialog        # a CDP driver's open JavaScript dialog
+        self.alert = alert
+        self.probes = 0
+
+    @property
+    def window_handles(self):
+        self.probes += 1
+        answer = self.answers.pop(0) if self.answers else True
+        if isinstance(answer, Exception):
+            raise answer
+        return ['w1']
+
+    def execute_script(self, script):
+        if self.alert:
+            raise UnexpectedAlertPresentException('alert open')
+        return 1
+
+
+def run(driver, config, clock=None, failures=2):
+    config.read_dict({'watchdog': {'interval': '2', 'failures': str(failures)}})
+    dog = watchdog.Watchdog(lambda timeout: driver, clock=clock or VirtualClock())
+    dog.run()       # on this thread, returns once the session is declared dead
+    return dog
+
+
+def test_consecutive_failures_declare_the_session_dead(config):
+    clock = VirtualClock()
+    driver = Driver([True, True, ConnectionError('gone'), ConnectionError('gone')])
+    dog = run(driver, config, clock)
+    assert dog.is_dead() and dog.reason == 'ConnectionError: gone'
+    assert driver.probes == 4 and clock.elapsed() == 8
+    assert dog.last_ok == 4       # the clock's time at the last good heartbeat
+
+
+def test_a_good_heartbeat_resets_the_count(config):
+    gone = ConnectionError('gone')
+    driver = Driver([gone, True, gone, True, gone, gone])
+    dog = run(driver, config)
+    assert dog.is_dead() and driver.probes == 6
+
+
+def test_attach_failure(config):
+    config.read_dict({'watchdog': {'timeout': '7'}})
+    timeouts = []
+
+    def factory(timeout):
+        timeouts.append(timeout)
+        raise ConnectionRefusedError('refused')
+
+    dog = watchdog.Watchdog(factory, clock=VirtualClock())
+    dog.run()
+    assert timeouts == [7] and dog.is_dead()
+    assert dog.reason == 'unable to attach heartbeat: refused'
+
+
+def test_probe_passes_dialogs():
+    driver = Driver(dialog='alert')
+    watchdog.probe(driver)      # a page held by a dialog isn't hung
+    assert driver.probes == 0
+    driver = Driver(alert=True)
+    watchdog.probe(driver)
+    assert driver.probes == 1
+
+
+def test_stop_ends_the_thread(config):
+    config.read_dict({'watchdog': {'interval': '0.01'}})
+    driver = Driver()
+    dog = watchdog.Watchdog(lambda timeout: driver)
+    dog.start()
+    dog.stop()
+    dog.join(5)
+    assert not dog.is_alive() and not dog.is_dead()
@@ -0,0 +1,152 @@
+#
+# Copyright 2020 TK Soh <teekaysoh@gmail.com>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+#
+
+import queue
+import threading
+
+import pytest
+
+workers = pytest.importorskip('workers')
+
+
+class FakeProcess(object):
+    # a worker process that is alive until the test says otherwise
+    pids = iter(range(100, 1000))
+
+    def __init__(self, target, name, args):
+        self.name = name
+        self.args = args
+        self.pid = None
+        self.alive = False
+        self.exitcode = None
+
+    def start(self):
+        self.pid = next(self.pids)
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+    def exit(self, code):
+        self.alive = False
+        self.exitcode = code
+
+    def join(self, timeout=None):
+        if self.alive and self.args[3].is_set():    # stop_event
+            self.exit(0)
+
+    def terminate(self):
+        self.exit(-15)
+
+
+class FakeContext(object):
+    Queue = queue.Queue
+    Event = threading.Event
+    Process = FakeProcess
+
+
+@pytest.fixture
+def supervisor(config, monkeypatch):
+    monkeypatch.setattr(workers, 'free_memory_mb', lambda: 4096)
+    sup = workers.Supervisor(FakeContext())
+    sup.cpus = [0, 1]
+    return sup
+
+
+def add_workers(config, sup, *names):
+    config.read_dict({f'worker.{name}': {'rulefile': f'{name}.json'} for name in names})
+    sup.load_config()
+
+
+def test_workers_spread_over_cpus(config, supervisor):
+    add_workers(config, supervisor, 'a', 'b', 'c')
+    for name in ('a', 'b', 'c'):
+        assert supervisor.start_worker(name)
+    assert [supervisor.workers[n].cpus for n in ('a', 'b', 'c')] == [{0}, {1}, {0}]
+    assert supervisor.workers['a'].process.args[4] == {0}
+
+    supervisor.workers['b'].process.exit(1)
+    supervisor.workers['c'].process.exit(1)
+    config.read_dict({'workers': {'restart': 'no'}})
+    supervisor.poll(timeout=0)
+    add_workers(config, supervisor, 'd')
+    supervisor.start_worker('d')
+    assert supervisor.workers['d'].cpus == {1}
+
+
+def test_crashed_workers_restart_up_to_the_limit(config, supervisor):
+    config.read_dict({'workers': {'max_restarts': '2'}})
+    add_workers(config, supervisor, 'a')
+    supervisor.start()
+    worker = supervisor.workers['a']
+
+    pids = [worker.process.pid]
+    for _ in range(3):
+        worker.process.exit(1)
+        supervisor.poll(timeout=0)
+        pids.append(worker.process.pid)
+    assert worker.restarts == 2
+    assert worker.state == 'exited' and not worker.is_alive()
+    assert len(set(pids)) == 3      # the third crash isn't restarted
+
+
+def test_alert_stops_the_worker_then_restarts_it(config, supervisor):
+    add_workers(config, supervisor, 'a')
+    supervisor.start()
+    worker = supervisor.workers['a']
+    first = worker.process
+    supervisor.queue.put(('a', 'alert', ''))
+    supervisor.poll(timeout=0)
+    assert worker.state == 'alert' and worker.stop_event.is_set()
+
+    first.exit(0)
+    supervisor.poll(timeout=0)
+    assert worker.state == 'running' and worker.process is not first
+    assert worker.restarts == 1 and not worker.stop_event.is_set()
+
+
+def test_waits_for_memory(config, supervisor, monkeypatch):
+    free = {'mb': 100}
+    monkeypatch.setattr(workers, 'free_memory_mb', lambda: free['mb'])
+    add_workers(config, supervisor, 'a')
+    assert not supervisor.start_worker('a')
+    assert supervisor.workers['a'].state == 'waiting'
+
+    free['mb'] = 1024
+    supervisor.poll(timeout=0)
+    assert supervisor.workers['a'].state == 'running'
+
+
+class FakePool(object):
+    def __init__(self):
+        self.released = []
+
+    def acquire(self, timeout=None):
+        return FakeSession()
+
+    def release(self, session, healthy, commands):
+        self.released.append((healthy, commands))
+
+
+class FakeSession(object):
+    def connection(self):
+        return 'http://127.0.0.1:9515 abc'
+
+
+def test_pool_sessions_released_by_health(config, supervisor):
+    config.read_dict({'workers': {'restart': 'no'}})
+    supervisor.pool = FakePool()
+    add_workers(config, supervisor, 'a', 'b')
+    supervisor.start_worker('a')
+    supervisor.start_worker('b')
+    assert supervisor.workers['a'].process.args[1]['session'] == 'http://127.0.0.1:9515 abc'
+
+    supervisor.workers['a'].engine = {'commands': 12}
+    supervisor.stop_worker('a')
+    supervisor.workers['b'].process.exit(1)
+    supervisor.poll(timeout=0)
+    assert supervisor.pool.released == [(True, 12), (False, 0)]